@@ -15,8 +15,14 @@
 #   limitations under the License.
    
 import datetime
+import marshal
+import mmap
+import multiprocessing
+import re
+import time
 import unicodedata
 from xml import sax
+from xml.parsers import expat
 
 import tilutil.systemutils as su
 
@@ -24,6 +30,25 @@ import tilutil.systemutils as su
 #APPLE_BASE = time.mktime((2001, 1, 1, 0, 0, 0, 0, 0, -1))
 APPLE_BASE = 978307200 # 2001/1/1
 
+# Size of the pieces of the XML file that are passed to expat.
+_PARSE_CHUNK_SIZE = 1024 * 1024
+
+# Elements whose text content is collected.
+_TEXT_ELEMENTS = frozenset(("key", "string", "integer", "real", "date", "data",
+                            "true", "false"))
+
+# Wrappers that turn parts of a file into a complete document for
+# iter_applexml_parallel().
+_SECTION_HEADER = '<plist version="1.0"><dict><key>%s</key><dict>'
+_SECTION_FOOTER = '</dict></dict></plist>'
+_PREFIX_FOOTER = '</dict></plist>'
+
+# The start or end of a dictionary.
+_DICT_TAG = re.compile(r'</?dict>')
+
+# Strings without characters from U+0300 on are already in NFC form.
+_MAYBE_NOT_NFC = re.compile(u'[^\u0000-\u02ff]')
+
 def getappletime(value):
     '''Converts a numeric Apple time stamp into a date and time'''
     try:
@@ -32,6 +57,12 @@ def getappletime(value):
         # bad time stamp in database, default to "now"
         return datetime.datetime.now()
 
+def getappletimestamp(value):
+    '''Converts a date and time into a numeric Apple time stamp (the inverse
+    of getappletime())'''
+    return (time.mktime(value.timetuple()) + value.microsecond / 1e6 -
+            APPLE_BASE)
+
 class AppleXMLResolver(sax.handler.EntityResolver): #IGNORE:W0232
     '''Helper to deal with XML entity resolving'''
 
@@ -132,22 +163,495 @@ class AppleXMLHandler(sax.handler.ContentHandler):
         return self.top_node[0]
 
 
+def _normalize(value):
+    """Returns a string in Unicode Normalization Form C."""
+    if _MAYBE_NOT_NFC.search(value):
+        return unicodedata.normalize("NFC", value)
+    return value
+
+
+def _read_chunks(filename, start=0, end=None):
+    """Yields the content of a file, or of the byte range [start, end) of it,
+    in pieces, reading it through a memory map."""
+    xml_file = open(filename, 'rb')
+    try:
+        try:
+            data = mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+            return
+        try:
+            if end is None:
+                end = len(data)
+            for pos in xrange(start, end, _PARSE_CHUNK_SIZE):
+                yield data[pos:min(end, pos + _PARSE_CHUNK_SIZE)]
+        finally:
+            data.close()
+    finally:
+        xml_file.close()
+
+
+class AppleXMLParser(object):
+    '''Parses an Apple XML file with pyexpat, without going through the SAX
+    layer. Builds the same tree as AppleXMLHandler, but collects text in lists,
+    shares the string objects of repeated dictionary keys, and looks up the
+    element handlers in tables.
+    '''
+
+    def __init__(self):
+        self._stack = []
+        self._container = None
+        self._key = None
+        self._text = None
+        self._keys = {}
+        self._parser = None
+        self.top_node = None
+        # Elements with text content are handled in _start_element().
+        self._start_handlers = {
+            'dict': self._start_dict,
+            'array': self._start_array,
+            'plist': self._start_plist,
+        }
+        self._end_handlers = {
+            'key': self._end_key,
+            'string': self._end_string,
+            'integer': self._end_value,
+            'real': self._end_value,
+            'date': self._end_value,
+            'data': self._end_data,
+            'true': self._end_true,
+            'false': self._end_false,
+            'dict': self._end_container,
+            'array': self._end_container,
+            'plist': self._end_plist,
+        }
+
+    def _create_parser(self):
+        parser = expat.ParserCreate()
+        self._parser = parser
+        parser.buffer_text = True
+        parser.buffer_size = 65536
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._character_data
+        return parser
+
+    def parse_file(self, filename):
+        '''Parses a file, reading it through a memory map.
+
+        Raises:
+            xml.parsers.expat.ExpatError: if the file is not valid XML.
+        '''
+        parser = self._create_parser()
+        for chunk in _read_chunks(filename):
+            parser.Parse(chunk, False)
+        parser.Parse('', True)
+        return self
+
+    def parse_string(self, data):
+        '''Parses XML data.
+
+        Raises:
+            xml.parsers.expat.ExpatError: if the data is not valid XML.
+        '''
+        self._create_parser().Parse(data, True)
+        return self
+
+    def gettopnode(self):
+        '''Returns the root of the parsed data tree'''
+        return self.top_node[0]
+
+    def _add_object(self, xml_object):
+        container = self._container
+        if container.__class__ is list:
+            container.append(xml_object)
+        else:
+            container[self._key] = xml_object
+
+    def _start_element(self, name, _attributes):
+        if name in _TEXT_ELEMENTS:
+            self._text = []
+            return
+        handler = self._start_handlers.get(name)
+        if handler:
+            handler()
+        else:
+            print "unrecognized element in XML data: " + name
+
+    def _start_dict(self):
+        new_dict = {}
+        self._add_object(new_dict)
+        self._stack.append(new_dict)
+        self._container = new_dict
+
+    def _start_array(self):
+        new_array = []
+        self._add_object(new_array)
+        self._stack.append(new_array)
+        self._container = new_array
+
+    def _start_plist(self):
+        self._container = []
+        self._stack.append(self._container)
+
+    def _character_data(self, data):
+        text = self._text
+        if text is not None:
+            text.append(data)
+
+    def _end_element(self, name):
+        handler = self._end_handlers.get(name)
+        if handler:
+            handler(self._text)
+        else:
+            print "unrecognized element in XML data: " + name
+        self._text = None
+
+    def _end_key(self, text):
+        key = u''.join(text) if text else None
+        self._key = self._keys.setdefault(key, key)
+
+    def _end_string(self, text):
+        self._add_object(_normalize(u''.join(text)) if text else u'')
+
+    def _end_value(self, text):
+        self._add_object(u''.join(text) if text else None)
+
+    def _end_data(self, text):
+        # Strip the line breaks and indentation of <data> elements.
+        if text:
+            self._add_object(u''.join([
+                line.strip() for line in u''.join(text).splitlines()]))
+        else:
+            self._add_object(None)
+
+    def _end_true(self, _text):
+        self._add_object(True)
+
+    def _end_false(self, _text):
+        self._add_object(False)
+
+    def _end_container(self, _text):
+        stack = self._stack
+        stack.pop()
+        self._container = stack[-1]
+
+    def _end_plist(self, _text):
+        self.top_node = self._stack.pop()
+        self._container = None
+
+
+class AppleXMLStreamParser(AppleXMLParser):
+    '''Parses an Apple XML file with a dictionary at the top, and hands out
+    the values of the top level dictionary while they are parsed.
+
+    The entries of the top level containers named in sections (for example
+    the images of the "Master Image List") are removed from the tree as soon
+    as they are complete, so the whole file is never in memory at once.
+    '''
+
+    def __init__(self, sections, entry_filter=None):
+        '''Creates a parser.
+
+        Args:
+            sections: names of the top level containers to stream.
+            entry_filter: optional function that takes the section name and
+                key of an entry, and returns False for entries that should be
+                skipped. Skipped entries are not built and not returned.
+        '''
+        AppleXMLParser.__init__(self)
+        self._sections = frozenset(sections)
+        self._entry_filter = entry_filter
+        self._skip_depth = 0
+        self._top = None
+        self._top_key = None
+        self._section = None
+        self._section_name = None
+        self._entry_key = None
+        self._pending = []
+        self._start_handlers['dict'] = self._start_stream_dict
+        self._start_handlers['array'] = self._start_stream_array
+        self._end_handlers['key'] = self._end_stream_key
+        self._end_handlers['dict'] = self._end_stream_container
+        self._end_handlers['array'] = self._end_stream_container
+        self._end_handlers['plist'] = self._end_stream_plist
+
+    def iterparse_file(self, filename):
+        '''Parses a file, and yields (section, key, value) tuples. For the
+        entries of the streamed sections, section is the name of the section,
+        and key is the dictionary key of the entry (None for the entries of
+        an array). All other values of the top level dictionary are returned
+        with a section of None after they are complete.
+
+        Raises:
+            xml.parsers.expat.ExpatError: if the file is not valid XML.
+        '''
+        return self.iterparse(_read_chunks(filename))
+
+    def iterparse(self, chunks):
+        '''Parses XML data that is passed in pieces, and yields
+        (section, key, value) tuples like iterparse_file().
+
+        Raises:
+            xml.parsers.expat.ExpatError: if the data is not valid XML.
+        '''
+        parser = self._create_parser()
+        pending = self._pending
+        for chunk in chunks:
+            parser.Parse(chunk, False)
+            for entry in pending:
+                yield entry
+            del pending[:]
+        parser.Parse('', True)
+        for entry in pending:
+            yield entry
+        del pending[:]
+
+    def _start_stream_dict(self):
+        self._start_dict()
+        self._started_container()
+
+    def _start_stream_array(self):
+        self._start_array()
+        self._started_container()
+
+    def _started_container(self):
+        stack = self._stack
+        depth = len(stack)
+        if depth == 2:
+            self._top = self._container
+        elif depth == 3:
+            if stack[1] is self._top and self._key in self._sections:
+                self._section = self._container
+                self._section_name = self._key
+        elif depth == 4 and stack[2] is self._section:
+            if self._section.__class__ is list:
+                self._entry_key = None
+            else:
+                self._entry_key = self._key
+            entry_filter = self._entry_filter
+            if entry_filter and not entry_filter(self._section_name,
+                                                 self._entry_key):
+                self._skip_entry()
+
+    def _skip_entry(self):
+        '''Ignores the rest of the entry that was just started, by switching
+        the expat handlers to handlers that only count nesting levels.'''
+        parser = self._parser
+        self._skip_depth = 1
+        parser.StartElementHandler = self._skip_start_element
+        parser.EndElementHandler = self._skip_end_element
+        parser.CharacterDataHandler = None
+
+    def _skip_start_element(self, name, _attributes):
+        if name == 'dict' or name == 'array':
+            self._skip_depth += 1
+
+    def _skip_end_element(self, name):
+        if name != 'dict' and name != 'array':
+            return
+        self._skip_depth -= 1
+        if self._skip_depth:
+            return
+        parser = self._parser
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._character_data
+        # Drop the empty entry without returning it.
+        self._end_container(None)
+        section = self._section
+        if section.__class__ is list:
+            section.pop()
+        else:
+            del section[self._entry_key]
+        self._text = None
+
+    def _end_stream_key(self, text):
+        self._end_key(text)
+        if self._container is self._top:
+            # The value of the previous key is complete.
+            self._emit_top_value()
+            self._top_key = self._key
+
+    def _emit_top_value(self):
+        key = self._top_key
+        if key is not None and key not in self._sections:
+            self._pending.append((None, key, self._top.get(key)))
+
+    def _end_stream_container(self, text):
+        entry = self._container
+        self._end_container(text)
+        section = self._section
+        if self._container is not section or section is None:
+            if entry is section:
+                self._section = None
+            return
+        if section.__class__ is list:
+            section.pop()
+            self._pending.append((self._section_name, None, entry))
+        else:
+            key = self._entry_key
+            del section[key]
+            self._pending.append((self._section_name, key, entry))
+
+    def _end_stream_plist(self, text):
+        if self._top is not None:
+            self._emit_top_value()
+        self._end_plist(text)
+
+
 def read_applexml(filename):
     '''Reads the named file, and parses it as an Apple XML file. Returns the
     top node.'''
-    parser = sax.make_parser()
-    handler = AppleXMLHandler()
-    parser.setContentHandler(handler)
-    parser.setEntityResolver(AppleXMLResolver())
-    parser.parse(filename)
-    return handler.gettopnode()
+    return AppleXMLParser().parse_file(filename).gettopnode()
 
 def read_applexml_string(data):
     '''Parses the data as Apple XML format. Returns the top node.'''
+    return AppleXMLParser().parse_string(data).gettopnode()
+
+def iter_applexml(filename, sections, entry_filter=None):
+    '''Reads the named file, and parses it as an Apple XML file. Yields the
+    entries of the named top level sections, and the other top level values,
+    as (section, key, value) tuples while they are parsed (see
+    AppleXMLStreamParser.iterparse_file()). Entries for which
+    entry_filter(section, key) returns False are skipped.'''
+    return AppleXMLStreamParser(sections, entry_filter).iterparse_file(
+        filename)
+
+def _parse_range(args):
+    '''Parses the entries of a dictionary section that are in the byte range
+    [start, end) of a file. Runs in the worker processes of
+    iter_applexml_parallel(). Returns the marshalled entries, which are much
+    faster to pass back than pickled ones.'''
+    filename, sections, section, start, end = args
+    chunks = [_SECTION_HEADER % (section.encode('utf-8'))]
+    chunks.extend(_read_chunks(filename, start, end))
+    if end is not None:
+        chunks.append(_SECTION_FOOTER)
+    entries = list(AppleXMLStreamParser(sections).iterparse(chunks))
+    return marshal.dumps(entries, 2)
+
+def _find_section_ranges(data, section, count):
+    '''Locates the dictionary that is the value of the top level key section,
+    and splits its content into up to count byte ranges at the keys of its
+    entries. Returns the start of the key of the section, and the list of
+    (start, end) ranges. The last range ends at the end of the file (None),
+    so that it includes the top level values after the section.
+    Returns None, None if the section is not found.'''
+    match = re.compile(r'<key>%s</key>\s*<dict>' % (
+        re.escape(section.encode('utf-8')))).search(data)
+    if not match:
+        return None, None
+    start = match.end()
+    # Find the entries of the section itself: not the dictionaries nested in
+    # its entries, and nothing after the end of the section.
+    entries = []
+    end = len(data)
+    depth = 1
+    for tag in _DICT_TAG.finditer(data, start):
+        if tag.group() == '</dict>':
+            depth -= 1
+            if depth == 0:
+                end = tag.start()
+                break
+            continue
+        if depth == 1:
+            entries.append(tag.start())
+        depth += 1
+    step = max(_PARSE_CHUNK_SIZE, (end - start) / count)
+    splits = [start]
+    for entry in entries:
+        if len(splits) == count:
+            break
+        if entry >= splits[-1] + step:
+            # The entry starts at its key.
+            splits.append(data.rfind('<key>', start, entry))
+    return match.start(), zip(splits, splits[1:] + [None])
+
+def iter_applexml_parallel(filename, sections, section, processes,
+                           entry_filter=None):
+    '''Reads the named file like iter_applexml(), but parses the entries of
+    the top level dictionary section in worker processes.
+
+    The content of the section is split into byte ranges at the keys of its
+    entries, found by following the nesting of the dictionaries (not by
+    their indentation). If a range still cannot be parsed, the whole file is
+    parsed in this process. The entries are returned after all workers are
+    done.
+
+    Args:
+        filename: name of the Apple XML file.
+        sections: names of the top level sections to stream. Must include
+            section.
+        section: name of a top level dictionary to split.
+        processes: number of worker processes.
+        entry_filter: optional function that tests if an entry should be
+            returned, see iter_applexml(). Only used when the file is parsed
+            in one process, because the workers start before the entries
+            before the section have been returned.
+    '''
+    if processes > 1:
+        entries = _parse_parallel(filename, sections, section, processes)
+        if entries is not None:
+            return entries
+    return iter_applexml(filename, sections, entry_filter)
+
+def _parse_parallel(filename, sections, section, processes):
+    xml_file = open(filename, 'rb')
+    try:
+        try:
+            data = mmap.mmap(xml_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None
+        try:
+            if len(data) < _PARSE_CHUNK_SIZE * processes:
+                return None
+            prefix_end, ranges = _find_section_ranges(data, section, processes)
+            if not ranges:
+                return None
+            prefix = data[:prefix_end]
+        finally:
+            data.close()
+    finally:
+        xml_file.close()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map_async(_parse_range, [
+            (filename, sections, section, start, end)
+            for start, end in ranges])
+        try:
+            # The part before the section is parsed while the workers run.
+            entries = list(AppleXMLStreamParser(sections).iterparse(
+                [prefix, _PREFIX_FOOTER]))
+            del prefix
+            range_entries = results.get()
+        except expat.ExpatError, e:
+            su.perr(u'Cannot split %s for parallel parsing (%s), parsing it '
+                    u'in one process.' % (filename, e))
+            return None
+    finally:
+        pool.terminate()
+        pool.join()
+    return _chain_entries(entries, range_entries)
+
+def _chain_entries(entries, range_entries):
+    '''Yields the entries, followed by the unmarshalled entries of each
+    range. Each range is released after it has been returned.'''
+    for entry in entries:
+        yield entry
+    del entries[:]
+    range_entries.reverse()
+    while range_entries:
+        for entry in marshal.loads(range_entries.pop()):
+            yield entry
+
+def read_applexml_sax(filename):
+    '''Reads the named file with the SAX based AppleXMLHandler. Returns the
+    top node.'''
     parser = sax.make_parser()
     handler = AppleXMLHandler()
     parser.setContentHandler(handler)
     parser.setEntityResolver(AppleXMLResolver())
-    parser.parseString(data)
+    parser.parse(filename)
     return handler.gettopnode()
-
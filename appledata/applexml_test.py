@@ -0,0 +1,203 @@
+"""This module tests applexml.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import appledata.applexml as applexml
+import appledata.benchmark as benchmark
+
+_DOCTYPE = ('<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+            '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n')
+
+_PLIST = """<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0">
+<dict>
+	<key>Application Version</key>
+	<string>8.1.2 (424)</string>
+	<key>Master Image List</key>
+	<dict>
+		<key>42</key>
+		<dict>
+			<key>Caption</key>
+			<string>Cafe\xcc\x81 &amp; Bar</string>
+			<key>Comment</key>
+			<string></string>
+			<key>Rating</key>
+			<integer>3</integer>
+			<key>DateAsTimerInterval</key>
+			<real>265680000.000000</real>
+			<key>Keywords</key>
+			<array>
+				<string>1</string>
+				<string>2</string>
+			</array>
+			<key>Flagged</key>
+			<true/>
+			<key>Hidden</key>
+			<false/>
+			<key>Modified</key>
+			<date>2010-05-06T07:08:09Z</date>
+			<key>Thumb</key>
+			<data>
+			AQEAAwAAAAIAAAAZAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+			AAAAAA==
+			</data>
+			<key>Empty</key>
+			<data></data>
+		</dict>
+	</dict>
+	<key>List of Albums</key>
+	<array>
+		<dict>
+			<key>AlbumName</key>
+			<string>Photos</string>
+			<key>KeyList</key>
+			<array>
+				<string>42</string>
+			</array>
+		</dict>
+	</array>
+</dict>
+</plist>
+"""
+
+class AppleXMLTest(unittest.TestCase):
+    """Unit tests for applexml.py code."""
+
+    def test_read_applexml(self):
+        """Tests that the expat and SAX parsers build the same tree."""
+        tmpfd, path = tempfile.mkstemp()
+        try:
+            os.write(tmpfd, _PLIST)
+            os.close(tmpfd)
+            expected = applexml.read_applexml_sax(path)
+            result = applexml.read_applexml(path)
+        finally:
+            os.remove(path)
+        self.assertEquals(expected, result)
+        # The SAX parser would fetch the DTD, expat does not.
+        self.assertEquals(result, applexml.read_applexml_string(
+            _PLIST.replace('<plist', _DOCTYPE + '<plist', 1)))
+
+        image = result['Master Image List']['42']
+        self.assertEquals(u'Caf\xe9 & Bar', image['Caption'])
+        self.assertEquals(u'', image['Comment'])
+        self.assertEquals(u'3', image['Rating'])
+        self.assertEquals([u'1', u'2'], image['Keywords'])
+        self.assertEquals(True, image['Flagged'])
+        self.assertEquals(False, image['Hidden'])
+        self.assertEquals(u'AQEAAwAAAAIAAAAZAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+                          u'AAAAAAAAAAAAAAAAAA==', image['Thumb'])
+        self.assertEquals(None, image['Empty'])
+
+    def test_iter_applexml(self):
+        """Tests that the stream parser returns the entries of the tree."""
+        tmpfd, path = tempfile.mkstemp()
+        try:
+            os.write(tmpfd, _PLIST)
+            os.close(tmpfd)
+            expected = applexml.read_applexml(path)
+            entries = list(applexml.iter_applexml(
+                path, ('Master Image List', 'List of Albums')))
+        finally:
+            os.remove(path)
+        self.assertEquals([
+            (None, u'Application Version', u'8.1.2 (424)'),
+            (u'Master Image List', u'42',
+             expected['Master Image List']['42']),
+            (u'List of Albums', None, expected['List of Albums'][0])],
+                          entries)
+
+    def test_iter_applexml_filter(self):
+        """Tests that the stream parser skips filtered entries."""
+        tmpfd, path = tempfile.mkstemp()
+        os.close(tmpfd)
+        try:
+            benchmark.write_library(path, 20)
+            sections = ('Master Image List', 'List of Rolls')
+            expected = [entry for entry in applexml.iter_applexml(
+                path, sections) if entry[1] not in (u'3', u'17')]
+            entries = list(applexml.iter_applexml(
+                path, sections,
+                lambda section, key: key not in (u'3', u'17')))
+        finally:
+            os.remove(path)
+        self.assertEquals(expected, entries)
+        self.assertEquals(18, len([entry for entry in entries
+                                   if entry[0] == 'Master Image List']))
+
+    def test_iter_applexml_parallel(self):
+        """Tests that parsing in several processes returns the same entries
+        as parsing in one process."""
+        tmpfd, path = tempfile.mkstemp()
+        os.close(tmpfd)
+        chunk_size = applexml._PARSE_CHUNK_SIZE
+        applexml._PARSE_CHUNK_SIZE = 4096
+        try:
+            benchmark.write_library(path, 200)
+            sections = ('Master Image List', 'List of Rolls')
+            expected = list(applexml.iter_applexml(path, sections))
+            self.assertEquals(expected, list(applexml.iter_applexml_parallel(
+                path, sections, 'Master Image List', 3)))
+            # The rolls are an array, so the file is parsed in one process.
+            self.assertEquals(expected, list(applexml.iter_applexml_parallel(
+                path, sections, 'List of Rolls', 3)))
+        finally:
+            applexml._PARSE_CHUNK_SIZE = chunk_size
+            os.remove(path)
+
+    def test_iter_applexml_parallel_nested(self):
+        """Tests that the image list is only split at its own entries, when
+        the images contain dictionaries and another dictionary of
+        dictionaries follows it."""
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<plist version="1.0">'
+                 '\n<dict>\n<key>Master Image List</key>\n<dict>\n']
+        for image_id in xrange(40):
+            parts.append('<key>%d</key>\n<dict>\n<key>Caption</key>'
+                         '<string>image%d</string>\n<key>Extra</key>\n'
+                         '<dict><key>%d</key><dict><key>a</key><string>b'
+                         '</string></dict><key>Empty</key><dict/></dict>\n'
+                         '</dict>\n' % (image_id, image_id, image_id))
+        parts.append('</dict>\n<key>List of Faces</key>\n<dict>\n')
+        for face_id in xrange(200):
+            parts.append('<key>%d</key>\n<dict><key>name</key>'
+                         '<string>face%d</string></dict>\n' % (face_id,
+                                                              face_id))
+        parts.append('</dict>\n</dict>\n</plist>\n')
+        tmpfd, path = tempfile.mkstemp()
+        os.write(tmpfd, ''.join(parts))
+        os.close(tmpfd)
+        chunk_size = applexml._PARSE_CHUNK_SIZE
+        applexml._PARSE_CHUNK_SIZE = 256
+        try:
+            sections = ('Master Image List', 'List of Faces')
+            expected = list(applexml.iter_applexml(path, sections))
+            self.assertEquals(240, len(expected))
+            data = open(path, 'rb').read()
+            _, ranges = applexml._find_section_ranges(
+                data, u'Master Image List', 4)
+            self.assertEquals(4, len(ranges))
+            self.assertTrue(ranges[-1][0] < data.index('List of Faces'))
+            self.assertEquals(expected, list(applexml.iter_applexml_parallel(
+                path, sections, 'Master Image List', 4)))
+        finally:
+            applexml._PARSE_CHUNK_SIZE = chunk_size
+            os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Compares the speed of the AlbumData.xml parsers and the library cache.
+
+usage: python -m appledata.benchmark [--images N] [AlbumData.xml]
+
+Without a file argument, a synthetic library with N images is generated.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import appledata.applexml as applexml
+import appledata.iphotodata as iphotodata
+import appledata.librarycache as librarycache
+
+_IMAGE = u"""		<key>%(id)d</key>
+		<dict>
+			<key>MediaType</key>
+			<string>Image</string>
+			<key>Caption</key>
+			<string>IMG_%(id)04d</string>
+			<key>Comment</key>
+			<string>Cafe\u0301 au lait, photo %(id)d</string>
+			<key>GUID</key>
+			<string>%(id)08X-0000-0000-0000-000000000000</string>
+			<key>Roll</key>
+			<integer>%(roll)d</integer>
+			<key>Rating</key>
+			<integer>%(rating)d</integer>
+			<key>ImagePath</key>
+			<string>/Users/me/Pictures/iPhoto Library/Masters/2010/%(roll)d/IMG_%(id)04d.JPG</string>
+			<key>ThumbPath</key>
+			<string>/Users/me/Pictures/iPhoto Library/Thumbnails/2010/%(roll)d/IMG_%(id)04d.jpg</string>
+			<key>DateAsTimerInterval</key>
+			<real>%(date)d.000000</real>
+			<key>ModDateAsTimerInterval</key>
+			<real>%(date)d.000000</real>
+			<key>latitude</key>
+			<real>37.%(id)06d</real>
+			<key>longitude</key>
+			<real>-122.%(id)06d</real>
+			<key>Keywords</key>
+			<array>
+				<string>%(keyword)d</string>
+			</array>
+		</dict>
+"""
+
+
+def write_library(path, images):
+    """Writes a synthetic AlbumData.xml with the given number of images."""
+    output = open(path, 'wb')
+    output.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<plist version="1.0">\n<dict>\n'
+                 '\t<key>Application Version</key>\n'
+                 '\t<string>8.1.2 (424)</string>\n'
+                 '\t<key>List of Keywords</key>\n\t<dict>\n')
+    for keyword in xrange(20):
+        output.write('\t\t<key>%d</key>\n\t\t<string>Keyword %d</string>\n' % (
+            keyword, keyword))
+    output.write('\t</dict>\n\t<key>Master Image List</key>\n\t<dict>\n')
+    for image_id in xrange(images):
+        output.write((_IMAGE % {'id': image_id, 'roll': image_id / 100,
+                                'rating': image_id % 6,
+                                'date': 265680000 + image_id * 60,
+                                'keyword': image_id % 20}).encode('utf-8'))
+    output.write('\t</dict>\n\t<key>List of Rolls</key>\n\t<array>\n')
+    for roll in xrange((images + 99) / 100):
+        output.write('\t\t<dict>\n\t\t\t<key>RollID</key>\n'
+                     '\t\t\t<integer>%d</integer>\n'
+                     '\t\t\t<key>RollName</key>\n'
+                     '\t\t\t<string>Roll %d</string>\n'
+                     '\t\t\t<key>RollDateAsTimerInterval</key>\n'
+                     '\t\t\t<real>%d.000000</real>\n'
+                     '\t\t\t<key>KeyList</key>\n\t\t\t<array>\n' % (
+                         roll, roll, 265680000 + roll * 6000))
+        for image_id in xrange(roll * 100, min(images, roll * 100 + 100)):
+            output.write('\t\t\t\t<string>%d</string>\n' % (image_id))
+        output.write('\t\t\t</array>\n\t\t</dict>\n')
+    output.write('\t</array>\n</dict>\n</plist>\n')
+    output.close()
+
+
+def time_call(function, *args):
+    """Returns the result of function(*args), and the seconds it took."""
+    start_time = time.time()
+    result = function(*args)
+    return result, time.time() - start_time
+
+
+def get_object_size(value, seen):
+    """Returns the bytes used by value and by the objects it references, not
+    counting objects whose id is in seen. Adds the ids of the counted objects
+    to seen."""
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            size += get_object_size(key, seen) + get_object_size(item, seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += get_object_size(item, seen)
+    elif hasattr(value, '__dict__') or hasattr(value, '__slots__'):
+        if hasattr(value, '__dict__'):
+            size += get_object_size(value.__dict__, seen)
+        for cls in type(value).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if hasattr(value, name):
+                    size += get_object_size(getattr(value, name), seen)
+    return size
+
+
+def get_bytes_per_image(data):
+    """Returns the average memory used by an IPhotoImage of the library. Does
+    not count the objects that are shared with the rest of the library, like
+    the albums, the keyword and face names and the folder names."""
+    seen = set()
+    get_object_size(data.keywords, seen)
+    get_object_size(data.face_names, seen)
+    get_object_size(data.tables, seen)
+    for album in data.albums.values() + data.rolls:
+        seen.add(id(album))
+    images = data.images_by_id.values()
+    total = 0
+    for image in images:
+        total += get_object_size(image, seen)
+    return total / max(1, len(images))
+
+
+def main(args):
+    """Runs the benchmark."""
+    parser = OptionParser(usage=__doc__.strip().split('\n')[2])
+    parser.add_option('--images', type='int', default=20000,
+                      help='Number of images in the synthetic library.')
+    (options, args) = parser.parse_args(args)
+
+    tmp_path = None
+    if args:
+        path = args[0]
+    else:
+        tmpfd, tmp_path = tempfile.mkstemp(suffix='.xml')
+        os.close(tmpfd)
+        write_library(tmp_path, options.images)
+        path = tmp_path
+    try:
+        print 'Parsing %s (%.1f MB)' % (path,
+                                        os.path.getsize(path) / 1048576.0)
+        sax_tree, sax_seconds = time_call(applexml.read_applexml_sax, path)
+        print 'SAX AppleXMLHandler:   %.2f s' % (sax_seconds)
+        expat_tree, expat_seconds = time_call(applexml.read_applexml, path)
+        print 'expat AppleXMLParser:  %.2f s (%.1fx)' % (
+            expat_seconds, sax_seconds / max(expat_seconds, 0.001))
+        if sax_tree != expat_tree:
+            print 'ERROR: the parsers returned different trees.'
+            return 1
+        del sax_tree, expat_tree
+        cache_folder = tempfile.mkdtemp()
+        try:
+            cache = librarycache.LibraryCache(cache_folder, 'benchmark')
+            data, parse_seconds = time_call(iphotodata.get_iphoto_data,
+                                             path, cache)
+            print 'IPhotoData from XML:   %.2f s' % (parse_seconds)
+            data, cache_seconds = time_call(iphotodata.get_iphoto_data,
+                                             path, cache)
+            print 'IPhotoData from cache: %.2f s (%.1fx)' % (
+                cache_seconds, parse_seconds / max(cache_seconds, 0.001))
+            print 'IPhotoImage memory:    %d bytes per image' % (
+                get_bytes_per_image(data))
+        finally:
+            shutil.rmtree(cache_folder)
+    finally:
+        if tmp_path:
+            os.remove(tmp_path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
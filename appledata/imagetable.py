@@ -0,0 +1,198 @@
+"""Columnar view of the images of an iPhoto library.
+
+An ImageTable keeps one NumPy array per image property, so that selections
+and statistics over large libraries are computed with array operations
+instead of a loop over IPhotoImage objects. Conditions are expressed as
+boolean masks, which can be combined with & and |, and select() turns a
+mask into image ids:
+
+    table = data.get_image_table()
+    mask = (table.rating_mask(4) & table.date_mask(start, end) &
+            table.gps_mask(south, west, north, east))
+    image_ids = table.select(mask)
+
+Requires NumPy. If it is not installed, numpy is None in this module.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import appledata.applexml as applexml
+
+_QUARTER_HOUR = 900.0
+
+# Fields of the rows passed to ImageTable, in this order.
+COLUMNS = ('image_id', 'date', 'mod_date', 'rating', 'latitude', 'longitude',
+           'is_movie', 'roll', 'file_size')
+
+
+def _float_column(values):
+    return numpy.array([numpy.nan if v is None else v for v in values],
+                       dtype=numpy.float64)
+
+
+def _int_column(values, dtype):
+    return numpy.array([-1 if v is None else v for v in values], dtype=dtype)
+
+
+class ImageTable(object):
+    """Arrays of image properties, one entry per image.
+
+    Attributes (all arrays have one entry per image):
+      image_ids: ids of the images.
+      date, mod_date: Apple time stamps (seconds since 2001/1/1), NaN if the
+          image has no date.
+      rating: rating, -1 if not rated.
+      latitude, longitude: GPS location, NaN if the image has none.
+      is_movie: True for movies.
+      roll: index of the event (roll) id in roll_ids, -1 for none.
+      file_size: size of the image file in bytes, -1 if unknown.
+      roll_ids: event (roll) ids that the roll column refers to.
+    """
+
+    def __init__(self, rows):
+        """Creates a table.
+
+        Args:
+          rows: list of tuples with the values in COLUMNS. Missing values are
+              None.
+        """
+        if numpy is None:
+            raise ImportError('NumPy is needed for an ImageTable.')
+        columns = zip(*rows) if rows else [()] * len(COLUMNS)
+        (image_ids, dates, mod_dates, ratings, latitudes, longitudes,
+         movies, rolls, file_sizes) = columns
+        self.image_ids = numpy.array(image_ids, dtype=object)
+        self.date = _float_column(dates)
+        self.mod_date = _float_column(mod_dates)
+        self.rating = _int_column(ratings, numpy.int8)
+        self.latitude = _float_column(latitudes)
+        self.longitude = _float_column(longitudes)
+        self.is_movie = numpy.array(movies, dtype=bool)
+        self.file_size = _int_column(file_sizes, numpy.int64)
+
+        self.roll_ids = []
+        roll_index = {}
+        codes = []
+        for roll in rolls:
+            if roll is None:
+                codes.append(-1)
+                continue
+            code = roll_index.get(roll)
+            if code is None:
+                code = roll_index[roll] = len(self.roll_ids)
+                self.roll_ids.append(roll)
+            codes.append(code)
+        self._roll_index = roll_index
+        self.roll = numpy.array(codes, dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def all_mask(self):
+        """Returns a mask that selects all images."""
+        return numpy.ones(len(self), dtype=bool)
+
+    def date_mask(self, start=None, end=None):
+        """Selects the images taken from start (included) to end (excluded).
+           start and end are datetimes, or None for no limit. Images without
+           a date are never selected."""
+        mask = ~numpy.isnan(self.date)
+        if start is not None:
+            mask &= self.date >= applexml.getappletimestamp(start)
+        if end is not None:
+            mask &= self.date < applexml.getappletimestamp(end)
+        return mask
+
+    def rating_mask(self, min_rating, max_rating=None):
+        """Selects the images with a rating from min_rating to max_rating."""
+        mask = self.rating >= min_rating
+        if max_rating is not None:
+            mask &= self.rating <= max_rating
+        return mask
+
+    def gps_mask(self, south, west, north, east):
+        """Selects the images with a GPS location inside a box. The box may
+           cross the 180th meridian (west > east)."""
+        # Comparisons with NaN are false, so images without a location are
+        # left out.
+        mask = (self.latitude >= south) & (self.latitude <= north)
+        if west <= east:
+            mask &= (self.longitude >= west) & (self.longitude <= east)
+        else:
+            mask &= (self.longitude >= west) | (self.longitude <= east)
+        return mask
+
+    def roll_mask(self, roll_ids):
+        """Selects the images of some events (rolls)."""
+        codes = [self._roll_index[roll] for roll in roll_ids
+                 if roll in self._roll_index]
+        return numpy.in1d(self.roll, numpy.array(codes, dtype=numpy.int32))
+
+    def select(self, mask=None):
+        """Returns the ids of the images selected by a mask."""
+        if mask is None:
+            return list(self.image_ids)
+        return list(self.image_ids[mask])
+
+    def count_by_roll(self, mask=None):
+        """Returns a map from event (roll) id to the number of (selected)
+           images in the event."""
+        rolls = self.roll if mask is None else self.roll[mask]
+        counts = numpy.bincount(rolls[rolls >= 0],
+                                minlength=len(self.roll_ids))
+        return dict([(roll, int(count)) for roll, count
+                     in zip(self.roll_ids, counts) if count])
+
+    def count_by_month(self, mask=None):
+        """Returns a list of (year, month, image count, total file size)
+           tuples for the (selected) images with a date, in date order. Files
+           of unknown size are not counted in the total size."""
+        if mask is None:
+            mask = self.all_mask()
+        mask = mask & ~numpy.isnan(self.date)
+        dates = self.date[mask]
+        sizes = self.file_size[mask]
+        # Months since year 0, in local time like the image dates. Local
+        # months start at a multiple of a quarter hour in all time zones, so
+        # only one time stamp per quarter hour needs to be converted.
+        quarters, quarter_index = numpy.unique(
+            numpy.floor(dates / _QUARTER_HOUR), return_inverse=True)
+        quarter_months = numpy.array(
+            [_get_month(quarter * _QUARTER_HOUR) for quarter in quarters],
+            dtype=numpy.int32)
+        months = quarter_months[quarter_index]
+        result = []
+        unique_months, month_index = numpy.unique(months, return_inverse=True)
+        counts = numpy.bincount(month_index, minlength=len(unique_months))
+        totals = numpy.bincount(month_index, weights=numpy.maximum(sizes, 0),
+                                minlength=len(unique_months))
+        for month, count, total in zip(unique_months, counts, totals):
+            result.append((int(month) // 12, int(month) % 12 + 1, int(count),
+                           int(total)))
+        return result
+
+
+def _get_month(apple_time):
+    """Returns the local month of an Apple time stamp, as months since year 0.
+    """
+    local_time = time.localtime(applexml.APPLE_BASE + apple_time)
+    return local_time.tm_year * 12 + local_time.tm_mon - 1
@@ -0,0 +1,87 @@
+"""This module tests imagetable.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import appledata.imagetable as imagetable
+import appledata.iphotodata as iphotodata
+import appledata.iphotodata_test as iphotodata_test
+
+
+@unittest.skipIf(imagetable.numpy is None, 'NumPy is not installed')
+class ImageTableTest(unittest.TestCase):
+    """Unit tests for imagetable.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        path = os.path.join(self.folder, 'AlbumData.xml')
+        xml_file = open(path, 'wb')
+        xml_file.write(iphotodata_test.make_library())
+        xml_file.close()
+        self.data = iphotodata.get_iphoto_data(path)
+        self.table = self.data.get_image_table()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _select(self, mask):
+        return sorted(self.table.select(mask))
+
+    def test_masks(self):
+        """Tests the selection of images."""
+        table = self.table
+        self.assertEquals(5, len(table))
+        self.assertEquals(['10', '11', '12', '20', '21'],
+                          self._select(table.all_mask()))
+        self.assertEquals(['10', '20'], self._select(table.rating_mask(4)))
+        self.assertEquals(['11', '21'],
+                          self._select(table.rating_mask(2, 3)))
+        self.assertEquals(['12'], self._select(table.is_movie))
+        self.assertEquals(['20', '21'],
+                          self._select(table.roll_mask([u'2', u'9'])))
+        self.assertEquals(['10', '11'],
+                          self._select(table.gps_mask(37, -123, 38, -122)))
+        self.assertEquals([], self._select(table.gps_mask(37, -122, 38, 0)))
+        # Box across the 180th meridian.
+        self.assertEquals(['10', '11', '20'],
+                          self._select(table.gps_mask(30, 7, 50, -122)))
+        start = self.data.images_by_id['11'].date
+        end = datetime.datetime(2011, 1, 1)
+        self.assertEquals(['11', '12'],
+                          self._select(table.date_mask(start, end)))
+        self.assertEquals(['20'], self._select(
+            table.date_mask(end) & table.rating_mask(4) &
+            table.gps_mask(46, 7, 47, 8)))
+
+    def test_counts(self):
+        """Tests the statistics."""
+        table = self.data.get_image_table(file_sizes=True)
+        self.assertEquals({u'1': 3, u'2': 2}, table.count_by_roll())
+        self.assertEquals({u'1': 1},
+                          table.count_by_roll(table.rating_mask(4) &
+                                              ~table.roll_mask([u'2'])))
+        expected = {}
+        for image in self.data.images:
+            month = (image.date.year, image.date.month)
+            expected[month] = expected.get(month, 0) + 1
+        self.assertEquals(sorted([(year, month, count, 0) for
+                                  (year, month), count in expected.items()]),
+                          table.count_by_month())
+        self.assertEquals([], table.count_by_month(table.rating_mask(6)))
@@ -21,6 +21,11 @@ SpecialRoll -  "Last Import"
 Event - this type does not exist in the XML file, but we use it in this code
         to allow us to treat events just like any other album
 Face - Face album (does not exist in iPhoto, only in this code).
+Keyword - Keyword album (does not exist in iPhoto, only in this code).
+Date - Album for a month or other period (does not exist in iPhoto, only in
+       this code).
+Location - Album for images taken near each other (does not exist in iPhoto,
+       only in this code).
 None - should not really happen
 '''
 
@@ -39,11 +44,18 @@ None - should not really happen
 #   limitations under the License.
 
 
+import bisect
 import datetime
+import multiprocessing.pool
 import os
+import re
 import sys
+import time
+import unicodedata
 
 import appledata.applexml as applexml
+import appledata.imagetable as imagetable
+import tilutil.geoindex as geoindex
 import tilutil.imageutils as imageutils
 import tilutil.systemutils as sysutils
 
@@ -62,6 +74,15 @@ def parse_face_rectangle(string_data):
         print >> sys.stderr, 'Failed to parse rectangle ' + string_data
         return [ 0.4, 0.4, 0.2, 0.2 ]
 
+def _get_apple_timestamp(value):
+    """Converts a numeric Apple time stamp string into a float. Bad values
+       are replaced with the current time, like applexml.getappletime()
+       does."""
+    try:
+        return float(value)
+    except ValueError:
+        return time.time() - applexml.APPLE_BASE
+
 def _get_aperture_master_path(preview_path):
     """Given a path to a Aperture preview image, return the folder where the
        Master would be stored if it is in the library."""
@@ -72,56 +93,243 @@ def _get_aperture_master_path(preview_path):
     folder = os.path.dirname(folder)
     return folder.replace('/Previews/', '/Masters/', 1)
     
+# Threads for scanning the Masters folder of an Aperture library.
+_MASTER_SCAN_THREADS = 4
+
+# Top level sections of AlbumData.xml that are read entry by entry.
+_IMAGE_LIST = "Master Image List"
+_ALBUM_LIST = "List of Albums"
+_ROLL_LIST = "List of Rolls"
+STREAMED_SECTIONS = (_IMAGE_LIST, _ALBUM_LIST, _ROLL_LIST)
+
+
+def _iter_tree(xml_data):
+    """Returns the content of a parsed AlbumData.xml tree in the
+       (section, key, value) form of applexml.iter_applexml()."""
+    for key, value in xml_data.items():
+        if key not in STREAMED_SECTIONS:
+            yield None, key, value
+    for section in (_ALBUM_LIST, _ROLL_LIST):
+        for value in xml_data.get(section) or []:
+            yield section, None, value
+    image_data = xml_data.get(_IMAGE_LIST)
+    if image_data:
+        for key, value in image_data.items():
+            yield _IMAGE_LIST, key, value
+
+
+class ImageSelection(object):
+    """Limits the images that IPhotoData loads to the images of some albums.
+
+    The albums and events come before the image list in AlbumData.xml, so the
+    selection is known before the first image is read, and the other images
+    can be skipped while parsing.
+    """
+
+    def __init__(self, album_filter):
+        """Creates a selection.
+
+        Args:
+          album_filter: function that takes the root album, with all albums
+              and events but without their images, and returns the albums and
+              events whose images are needed.
+        """
+        self.album_filter = album_filter
+        self.image_ids = None
+
+    def select(self, root_album):
+        """Collects the image ids of the albums that album_filter picks."""
+        self.image_ids = set()
+        for album in self.album_filter(root_album):
+            self.image_ids.update(album.keylist)
+
+    def wants(self, section, key):
+        """Tests if an entry of a streamed section is needed."""
+        return (section != _IMAGE_LIST or self.image_ids is None or
+                key in self.image_ids)
+
+    def skipped(self, key):
+        """Tests if the image with this id is left out on purpose."""
+        return self.image_ids is not None and key not in self.image_ids
+
+
+def find_albums(albums, album_types, includes, excludes=None,
+                folder_prefix=u'', matched=False):
+    """Finds the albums of an album tree that are exported for a pattern.
+
+    Folders, and other albums with sub-albums, are not exported themselves,
+    but their albums are searched. An album matches if its type is in
+    album_types, its name or the name of a folder it is in matches includes,
+    and its name does not match excludes.
+
+    Args:
+      albums: list of IPhotoContainer objects.
+      album_types: list of the types of the albums to return.
+      includes: regular expression for the names of the albums to export.
+      excludes: optional regular expression for the names of the albums to
+          leave out.
+      folder_prefix: export folder path of the albums, ending in "/" unless
+          empty. The names of folders are added to it for their albums.
+      matched: True if a folder that contains the albums matches includes.
+    Returns:
+      list of (album, folder prefix) tuples, in the order of the tree.
+    """
+    include_pattern = re.compile(sysutils.unicode_string(includes))
+    exclude_pattern = None
+    if excludes:
+        exclude_pattern = re.compile(sysutils.unicode_string(excludes))
+    result = []
+    _find_albums(albums, album_types, include_pattern, exclude_pattern,
+                 folder_prefix, matched, result)
+    return result
+
+def _find_albums(albums, album_types, include_pattern, exclude_pattern,
+                 folder_prefix, matched, result):
+    for album in albums:
+        name = album.name or "xxx"
+        if album.albumtype == "Folder" or album.albums:
+            sub_prefix = folder_prefix
+            if album.albumtype == "Folder":
+                sub_prefix += imageutils.make_foldername(name) + "/"
+            _find_albums(album.albums, album_types, include_pattern,
+                         exclude_pattern, sub_prefix,
+                         matched or bool(include_pattern.match(name)), result)
+        elif album.albumtype == "None" or album.albumtype not in album_types:
+            continue
+        elif not matched and not include_pattern.match(name):
+            continue
+        elif exclude_pattern and exclude_pattern.match(name):
+            continue
+        else:
+            result.append((album, folder_prefix))
+
+
 class IPhotoData(object):
     """top level iPhoto data node."""
 
-    def __init__(self, xml_data, is_aperture):
-        """# call with results of readAppleXML."""
-        self.data = xml_data
+    def __init__(self, xml_data, is_aperture, selection=None):
+        """Call with the result of applexml.read_applexml(), or with the
+           entries returned by applexml.iter_applexml(STREAMED_SECTIONS).
+
+           With the entries, each image is converted as soon as it has been
+           parsed, and its dictionary is released.
+
+           With a selection (ImageSelection), only the images of the selected
+           albums and events are loaded. The albums and events that are not
+           selected are still there, but contain only the loaded images.
+        """
+        if isinstance(xml_data, dict):
+            self.data = xml_data
+            entries = _iter_tree(xml_data)
+        else:
+            self.data = {}
+            entries = xml_data
         self.aperture = is_aperture
+        self.selection = selection
 
         self.albums = {}
         self.face_albums = None
+        self._index = None
+        self._geo_index = None
+        self._image_table = None
+        self._image_table_sizes = False
+        self.root_album = None
+        self._rolls = {}
 
         # Master map of keywords
-        self.keywords = self.data.get("List of Keywords")
-
+        self.keywords = None
         self.face_names = {}  # Master map of faces
-        face_list = self.data.get("List of Faces")
+        self.tables = LibraryTables()
+        self.images_by_id = {}
+
+        # iPhoto writes the top level keys in sorted order, so the albums,
+        # events, keyword and face lists come before the image list. Images
+        # that show up before the keyword list are kept until it has been
+        # read.
+        waiting_images = []
+        album_data = []
+        roll_data = []
+        for section, key, value in entries:
+            if section == _IMAGE_LIST:
+                if selection and self.root_album is None:
+                    if album_data or roll_data:
+                        self._add_albums(album_data, roll_data)
+                        album_data = []
+                        roll_data = []
+                    else:
+                        # The albums come later, so we need all images.
+                        selection = None
+                if selection and selection.skipped(key):
+                    continue
+                if self.keywords is None:
+                    waiting_images.append((key, value))
+                else:
+                    self._add_image(key, value)
+            elif section == _ALBUM_LIST:
+                album_data.append(value)
+            elif section == _ROLL_LIST:
+                roll_data.append(value)
+            else:
+                if self.data is not xml_data:
+                    self.data[key] = value
+                if key == "List of Keywords":
+                    self.keywords = value
+                    self.tables.add_keywords(value)
+                    for image_key, image_data in waiting_images:
+                        self._add_image(image_key, image_data)
+                    waiting_images = []
+                elif key == "List of Faces":
+                    self._add_face_names(value)
+        if self.keywords is None:
+            self.keywords = {}
+        for image_key, image_data in waiting_images:
+            self._add_image(image_key, image_data)
+        del waiting_images
+
+        if self.root_album is None:
+            self.selection = selection = None
+        # Albums and events after the image list only get the images that
+        # were loaded.
+        self._add_albums(album_data, roll_data)
+        del album_data, roll_data
+        skipped = selection and selection.skipped
+        for album in self.albums.values():
+            album.resolve_images(self.images_by_id, skipped)
+        for roll in self._rolls.values():
+            roll.resolve_images(self.images_by_id, skipped)
+
+        self.images_by_base_name = None
+        self.images_by_file_name = None
+
+    def _add_albums(self, album_data, roll_data):
+        """Creates the albums and events, without their images. The first
+           call applies the selection."""
+        first_call = self.root_album is None
+        if first_call:
+            self.root_album = IPhotoContainer("", "Root", None, None)
+        for data in album_data:
+            album = IPhotoAlbum(data, None, self.albums, self.root_album)
+            self.albums[album.albumid] = album
+
+        for roll in roll_data:
+            roll = IPhotoRoll(roll, None)
+            self._rolls[roll.albumid] = roll
+            self.root_album.addalbum(roll)
+        if first_call and self.selection:
+            self.selection.select(self.root_album)
+
+    def _add_face_names(self, face_list):
         if face_list:
             for face_entry in face_list.values():
                 face_key = face_entry.get("key")
                 face_name = face_entry.get("name")
                 self.face_names[face_key] = face_name
+                self.tables.add_face(face_key, face_name)
                 # Other keys in face_entry: image, key image face index,
                 # PhotoCount, Order
 
-        self.images_by_id = {}
-        image_data = self.data.get("Master Image List")
-        if image_data:
-            for key in image_data:
-                image = IPhotoImage(image_data.get(key), self.keywords,
-                                    self.face_names)
-                self.images_by_id[key] = image
-
-        album_data = self.data.get("List of Albums")
-
-        self.root_album = IPhotoContainer("", "Root", None, None)
-        for data in album_data:
-            album = IPhotoAlbum(data, self.images_by_id, self.albums,
-                                self.root_album)
-            self.albums[album.albumid] = album
-
-        roll_data = self.data.get("List of Rolls")
-        self._rolls = {}
-        if roll_data:
-            for roll in roll_data:
-                roll = IPhotoRoll(roll, self.images_by_id)
-                self._rolls[roll.albumid] = roll
-                self.root_album.addalbum(roll)
-
-        self.images_by_base_name = None
-        self.images_by_file_name = None
+    def _add_image(self, key, image_data):
+        self.images_by_id[key] = IPhotoImage(image_data, self.tables)
 
     def _build_image_name_list(self):
         self.images_by_base_name = {}
@@ -185,13 +393,44 @@ class IPhotoData(object):
                 image_map[image.originalpath] = image
         return image_map
 
+    def get_image_table(self, file_sizes=False):
+        """Returns an imagetable.ImageTable of the images. Requires NumPy.
+
+           Args:
+             file_sizes: if True, the sizes of the image files are read too.
+        """
+        table = self._image_table
+        # A table with file sizes also serves requests without them.
+        if table is None or (file_sizes and not self._image_table_sizes):
+            rows = []
+            for key, image in self.images_by_id.iteritems():
+                latitude, longitude = image.getlatlong() or (None, None)
+                file_size = None
+                if file_sizes:
+                    try:
+                        file_size = os.path.getsize(image.image_path)
+                    except OSError:
+                        pass
+                rows.append((key, image._date, image._mod_date, image.rating,
+                             latitude, longitude, image._is_movie, image.roll,
+                             file_size))
+            table = self._image_table = imagetable.ImageTable(rows)
+            self._image_table_sizes = file_sizes
+        return table
+
     def checkalbumsizes(self, max_size):
         """Prints a message for any event or album that has too many images."""
         messages = []
+        if imagetable.numpy:
+            roll_sizes = self.get_image_table().count_by_roll()
+        else:
+            roll_sizes = dict([(roll.albumid, roll.size)
+                               for roll in self._rolls.values()])
         for album in self._rolls.values():
-            if album.size > max_size:
+            size = roll_sizes.get(album.albumid, 0)
+            if size > max_size:
                 messages.append("%s: event too large (%d)" % (album.name, 
-                                                              album.size))
+                                                              size))
         for album in self.albums.values():
             if album.albumtype == "Regular" and album.size > max_size:
                 messages.append("%s: album too large (%d)" % (album.name, 
@@ -200,13 +439,29 @@ class IPhotoData(object):
         for message in messages:
             print message
 
-    def load_aperture_originals(self):
+    def reportbymonth(self, movies=True):
+        """Prints the number of images and their total file size for each
+           month. Requires NumPy."""
+        table = self.get_image_table(file_sizes=True)
+        mask = table.all_mask()
+        if not movies:
+            mask &= ~table.is_movie
+        for year, month, count, size in table.count_by_month(mask):
+            print "%04d-%02d: %6d images, %8.1f MB" % (year, month, count,
+                                                      size / 1048576.0)
+
+    def load_aperture_originals(self, threads=_MASTER_SCAN_THREADS):
         """Attempts to locate the original image files (Masters). Only works if
-           the masters are stored in the library."""
+           the masters are stored in the library.
+
+           The masters of an image are looked up when its originalpath is
+           first used, so only the images that are exported are resolved. The
+           Masters folder is scanned once, with one thread per top level
+           folder (up to the given number of threads).
+        """
         if not self.aperture:
             return
-        for image in self.images_by_id.values():
-            image.find_aperture_original()
+        self.tables.masters = ApertureMasters(threads)
 
         
 
@@ -251,6 +506,20 @@ class IPhotoData(object):
         for message in messages:
             print message
 
+    def _getindex(self):
+        if self._index is None:
+            self._index = ImageIndex(self.images_by_id.values(), self.tables)
+        return self._index
+    index = property(_getindex, doc="ImageIndex of the images, built on "
+                     "first use")
+
+    def query(self, keywords=None, faces=None, rolls=None, date_range=None,
+              min_rating=None):
+        """Returns the images that match all the given conditions, sorted by
+           date. See ImageIndex.query()."""
+        return self.index.query(keywords, faces, rolls, date_range,
+                                min_rating)
+
     def getfacealbums(self):
         """Returns a map of albums for faces."""
         if self.face_albums:
@@ -259,69 +528,556 @@ class IPhotoData(object):
         # Build the albums on first call
         self.face_albums = {}
 
-        for image in self.images:
-            for face in image.getfaces():
-                face_album = self.face_albums.get(face)
-                if not face_album:
-                    face_album = IPhotoFace(face)
-                    self.face_albums[face] = face_album
+        index = self.index
+        for face, images in index.images_by_face.items():
+            face_album = IPhotoFace(self.tables.faces.strings[face])
+            for image in images:
                 face_album.addimage(image)
+            self.face_albums[face_album.name] = face_album
         return self.face_albums.values()
 
+    def _getgeoindex(self):
+        if self._geo_index is None:
+            points = []
+            for image in self.index.images_by_date + self.index.undated:
+                location = image.getlatlong()
+                # iPhoto stores 0, 0 for images without a location.
+                if location and location != (0.0, 0.0):
+                    points.append((location[0], location[1], image))
+            self._geo_index = geoindex.GeoIndex(points)
+        return self._geo_index
+    geo_index = property(_getgeoindex, doc="geoindex.GeoIndex of the images "
+                         "with a GPS location, in date order, built on first "
+                         "use")
+
+    def getlocationalbums(self, radius_km):
+        """Returns a list of albums of images taken near each other, in date
+           order. Each album has the images within radius_km of its first
+           image (see geoindex.GeoIndex.clusters()). Albums are named after
+           the event that most of their images belong to."""
+        albums = []
+        names = {}
+        for images in self.geo_index.clusters(radius_km):
+            events = {}
+            event_names = []
+            for image in images:
+                if image.event_name not in events:
+                    events[image.event_name] = 0
+                    event_names.append(image.event_name)
+                events[image.event_name] += 1
+            # On a tie, max() keeps the first event in date order.
+            name = max(event_names, key=events.get)
+            if not name:
+                location = images[0].gps
+                name = u"%.3f %s %.3f %s" % (
+                    abs(location.latitude), location.latitude_ref(),
+                    abs(location.longitude), location.longitude_ref())
+            count = names[name] = names.get(name, 0) + 1
+            if count > 1:
+                name = u"%s (%d)" % (name, count)
+            album = IPhotoVirtualAlbum(name, "Location")
+            for image in images:
+                album.addimage(image)
+            albums.append(album)
+        return albums
+
+    def getkeywordalbums(self):
+        """Returns a list of albums, one for each keyword that is used."""
+        albums = []
+        strings = self.tables.keywords.strings
+        for keyword, images in self.index.images_by_keyword.items():
+            if strings[keyword] is None:
+                continue
+            album = IPhotoVirtualAlbum(strings[keyword], "Keyword")
+            for image in images:
+                album.addimage(image)
+            albums.append(album)
+        return albums
+
+    def getdatealbums(self, date_format="%Y-%m"):
+        """Returns a list of albums for the images taken in the same period,
+           in date order. Images are grouped by the date formatted with
+           date_format (by month by default), which is also the album name.
+        """
+        albums = []
+        album = None
+        for image in self.index.images_by_date:
+            name = image.date.strftime(date_format)
+            if album is None or album.name != name:
+                album = IPhotoVirtualAlbum(name, "Date")
+                albums.append(album)
+            album.addimage(image)
+        return albums
+
+
+class StringTable(object):
+    """Numbers strings, so that they can be referenced by small ints. Each
+       string is stored once."""
+
+    def __init__(self):
+        self.strings = []
+        self._ids = {}
+
+    def add(self, value):
+        """Returns the id of a string, adding it if it is new."""
+        string_id = self._ids.get(value)
+        if string_id is None:
+            string_id = self._ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+    def get_id(self, value):
+        """Returns the id of a string, or None if it is not in the table."""
+        return self._ids.get(value)
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class LibraryTables(object):
+    """Tables shared by the images of a library: keyword and face names,
+       numbered by StringTables, and the folders of image files."""
+
+    def __init__(self):
+        self.keywords = StringTable()
+        self.faces = StringTable()
+        # Maps the keyword ids and face keys of AlbumData.xml to table ids.
+        self.keyword_ids = {}
+        self.face_ids = {}
+        # Unknown keyword ids used to become None, and still do.
+        self.unknown_keyword = self.keywords.add(None)
+        self._folders = {}
+        # ApertureMasters for finding the originals of Aperture images.
+        self.masters = None
+
+    def add_keywords(self, keyword_map):
+        """Adds the "List of Keywords" map of AlbumData.xml."""
+        for key, name in keyword_map.items():
+            self.keyword_ids[key] = self.keywords.add(name)
+
+    def add_face(self, face_key, name):
+        """Adds an entry of the "List of Faces" of AlbumData.xml."""
+        self.face_ids[face_key] = self.faces.add(name)
+
+    def split_path(self, path):
+        """Splits a path into a shared folder string (with the trailing
+           separator), and the file name. Returns (None, None) for None."""
+        if path is None:
+            return None, None
+        folder, separator, name = path.rpartition('/')
+        folder += separator
+        return self._folders.setdefault(folder, folder), name
+
+
+class ImageIndex(object):
+    """Indexes of the images of a library by keyword, face, event, date and
+       rating."""
+
+    def __init__(self, images, tables):
+        """Builds the indexes.
+
+        Args:
+          images: list of IPhotoImage.
+          tables: LibraryTables of the images.
+        """
+        self.tables = tables
+        self.images = images
+        # Keyword and face ids in the tables to lists of images.
+        self.images_by_keyword = {}
+        self.images_by_face = {}
+        self.images_by_roll = {}
+        self.images_by_rating = {}
+        dated = []
+        self.undated = []
+        for image in images:
+            for keyword in image._keywords:
+                self.images_by_keyword.setdefault(keyword, []).append(image)
+            if image._face_data is not None:
+                image._decode_faces()
+            for face in image._faces:
+                self.images_by_face.setdefault(face, []).append(image)
+            self.images_by_roll.setdefault(image.roll, []).append(image)
+            self.images_by_rating.setdefault(image.rating, []).append(image)
+            if image._date is not None:
+                dated.append((image._date, image))
+            else:
+                self.undated.append(image)
+        # Images with a date, sorted by date, and their time stamps.
+        dated.sort(key=lambda entry: entry[0])
+        self.dates = [entry[0] for entry in dated]
+        self.images_by_date = [entry[1] for entry in dated]
+
+    def get_date_range(self, start=None, end=None):
+        """Returns the images taken from start (included) to end (excluded),
+           in date order. start and end are datetimes, or None for no limit.
+        """
+        first = 0
+        last = len(self.dates)
+        if start is not None:
+            first = bisect.bisect_left(self.dates,
+                                       applexml.getappletimestamp(start))
+        if end is not None:
+            last = bisect.bisect_left(self.dates,
+                                      applexml.getappletimestamp(end))
+        return self.images_by_date[first:last]
+
+    def get_min_rating(self, min_rating):
+        """Returns the images with at least the given rating."""
+        images = []
+        for rating, rated_images in self.images_by_rating.items():
+            if rating is not None and rating >= min_rating:
+                images.extend(rated_images)
+        return images
+
+    def query(self, keywords=None, faces=None, rolls=None, date_range=None,
+              min_rating=None):
+        """Returns the images that match all the given conditions, sorted by
+           date (images without a date first).
+
+        Args:
+          keywords: keyword names that the images must all have.
+          faces: face names that must all be in the images.
+          rolls: event (roll) ids; the images must be in one of them.
+          date_range: (start, end) tuple for get_date_range().
+          min_rating: lowest rating.
+        """
+        lists = []
+        for names, table, index in (
+            (keywords, self.tables.keywords, self.images_by_keyword),
+            (faces, self.tables.faces, self.images_by_face)):
+            for name in names or ():
+                lists.append(index.get(table.get_id(name), ()))
+        if rolls is not None:
+            roll_images = []
+            for roll in rolls:
+                roll_images.extend(self.images_by_roll.get(roll, ()))
+            lists.append(roll_images)
+        if date_range is not None:
+            lists.append(self.get_date_range(*date_range))
+        if min_rating is not None:
+            lists.append(self.get_min_rating(min_rating))
+        if not lists:
+            return self._sort(self.images)
+
+        # Start with the shortest list, and drop images that are not in the
+        # others.
+        lists.sort(key=len)
+        result = set(lists[0])
+        for images in lists[1:]:
+            if not result:
+                break
+            result.intersection_update(images)
+        return self._sort(result)
+
+    def _sort(self, images):
+        return sorted(images, key=lambda image: (image._date is not None,
+                                                 image._date))
+
+
+class ApertureMasters(object):
+    """Index of the master files in the Masters folder of an Aperture library.
+
+    Each Masters folder is scanned once, when the first image of the library
+    is looked up. The files are indexed by every prefix of their name that
+    ends before a ".", so that a master is found for the base name of its
+    preview image.
+    """
+
+    def __init__(self, threads=_MASTER_SCAN_THREADS):
+        """Creates an index.
+
+        Args:
+          threads: number of threads for scanning the top level folders of
+              the Masters folder.
+        """
+        self.threads = threads
+        # Masters folder path to (map from name prefix to file paths, set of
+        # folder paths).
+        self._roots = {}
+
+    def _get_root(self, master_path):
+        """Returns the Masters folder of a master folder path."""
+        index = master_path.find('/Masters/')
+        if index == -1:
+            return master_path
+        return master_path[:index + len('/Masters')]
+
+    def _scan(self, root):
+        """Scans a Masters folder, in parallel for its top level folders."""
+        try:
+            names = sorted(os.listdir(root))
+        except OSError:
+            names = []
+        folder_names = [name for name in names
+                        if os.path.isdir(os.path.join(root, name))]
+        folders = [os.path.join(root, name) for name in folder_names]
+        file_names = sorted(set(names) - set(folder_names))
+        walks = [[(root, folder_names, file_names)]]
+        if self.threads > 1 and len(folders) > 1:
+            pool = multiprocessing.pool.ThreadPool(
+                min(self.threads, len(folders)))
+            try:
+                walks.extend(pool.map(_walk_folder, folders))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            walks.extend([_walk_folder(folder) for folder in folders])
+        # Names are indexed in Normalization Form C, like the paths in the
+        # library data. HFS+ returns them in Form D.
+        files = {}
+        walked_folders = set()
+        for walk in walks:
+            for folder, _sub_folders, file_names in walk:
+                folder_key = _normalize_path(folder)
+                walked_folders.add(folder_key)
+                for file_name in file_names:
+                    key = _normalize_path(file_name)
+                    entry = (os.path.join(folder_key, key),
+                             os.path.join(folder, file_name))
+                    end = key.find('.')
+                    while end != -1:
+                        files.setdefault(key[:end], []).append(entry)
+                        end = key.find('.', end + 1)
+        return files, walked_folders
+
+    def find(self, preview_path):
+        """Returns the path of the master of a preview image, or None.
+           Prefers a .jpg master."""
+        master_path = _get_aperture_master_path(preview_path)
+        root = self._get_root(master_path)
+        scan = self._roots.get(root)
+        if scan is None:
+            scan = self._roots[root] = self._scan(root)
+        files, folders = scan
+        master_path = _normalize_path(master_path)
+        if master_path not in folders:
+            return None
+        basename = _normalize_path(sysutils.getfilebasename(preview_path))
+        file_name = os.path.join(master_path, basename + '.jpg')
+        prefix = master_path + '/'
+        candidates = [(key, path) for key, path in files.get(basename, ())
+                      if key.startswith(prefix)]
+        for key, path in candidates:
+            if key == file_name:
+                return path
+        if candidates:
+            return candidates[0][1]
+        print "No master for " + preview_path
+        return None
+
+
+def _normalize_path(path):
+    """Returns a path or name in Unicode Normalization Form C."""
+    return unicodedata.normalize("NFC", sysutils.unicode_string(path))
+
+
+def _walk_folder(folder):
+    """Returns the os.walk() entries of a folder, in sorted order."""
+    result = []
+    for entry in os.walk(folder):
+        entry[1].sort()
+        entry[2].sort()
+        result.append(entry)
+    return result
+
+
+def _join_path(folder, name):
+    if folder is None:
+        return None
+    return folder + name
+
+
+# Keys of the image dictionaries that IPhotoImage uses.
+IMAGE_KEYS = ("Caption", "Comment", "DateAsTimerInterval",
+              "ModDateAsTimerInterval", "ImagePath", "Rating", "latitude",
+              "longitude", "Keywords", "OriginalPath", "Roll", "MediaType",
+              "ThumbPath", "RotationIsOnlyEdit", "Faces")
+
 
 class IPhotoImage(object):
-    """Describes an image in the iPhoto database."""
+    """Describes an image in the iPhoto database.
+
+    Keeps only the values that are needed, in compact form: dates as Apple
+    time stamps (floats), keywords and faces as tuples of ids in the tables
+    of the library, and paths as a shared folder string and a file name.
+    Dates, GPS locations and faces are decoded when they are first used.
+    """
 
-    def __init__(self, data, keyword_map, face_map):
-        self.data = data
+    __slots__ = ('_caption', 'comment', '_date', '_date_time', '_mod_date',
+                 '_mod_date_time', '_image_folder', '_image_name', 'rating',
+                 '_gps', '_keywords', '_tables', '_original_folder',
+                 '_original_name', 'roll', '_is_movie', '_thumb_folder',
+                 '_thumb_name', 'rotation_is_only_edit', 'albums',
+                 '_face_data', '_faces', '_face_rectangles', 'event_name',
+                 'event_index', '_event_digits')
+
+    def __init__(self, data, tables):
+        """Creates an image from its dictionary in AlbumData.xml.
+
+        Args:
+          data: image dictionary.
+          tables: LibraryTables of the library.
+        """
+        self._tables = tables
         self._caption = sysutils.nn_string(data.get("Caption")).strip()
         self.comment = sysutils.nn_string(data.get("Comment")).strip()
         if data.has_key("DateAsTimerInterval"):
-            self.date = applexml.getappletime(data.get("DateAsTimerInterval"))
+            self._date = _get_apple_timestamp(data.get("DateAsTimerInterval"))
         else:
-            self.date = None
-        self.mod_date = applexml.getappletime(
+            self._date = None
+        self._date_time = None
+        self._mod_date = _get_apple_timestamp(
             data.get("ModDateAsTimerInterval"))
-        self.image_path = data.get("ImagePath")
+        self._mod_date_time = None
+        self._image_folder, self._image_name = tables.split_path(
+            data.get("ImagePath"))
         if data.has_key("Rating"):
             self.rating = int(data.get("Rating"))
         else:
             self.rating = None
         if data.get("longitude"):
-            latitude = float(data.get("latitude"))
-            longitude = float(data.get("longitude"))
-            self.gps = imageutils.GpsLocation(latitude, longitude)
+            # Replaced by a GpsLocation when first used.
+            self._gps = (float(data.get("latitude")),
+                         float(data.get("longitude")))
         else:
-            self.gps = None
+            self._gps = None
 
-        self.keywords = []
         keyword_list = data.get("Keywords")
-        if keyword_list is not None:
-            for i in keyword_list:
-                self.keywords.append(keyword_map.get(i))
+        if keyword_list:
+            keyword_ids = tables.keyword_ids
+            unknown = tables.unknown_keyword
+            self._keywords = tuple([keyword_ids.get(i, unknown)
+                                    for i in keyword_list])
+        else:
+            self._keywords = ()
 
-        self.originalpath = data.get("OriginalPath")
+        self._original_folder, self._original_name = tables.split_path(
+            data.get("OriginalPath"))
         self.roll = data.get("Roll")
+        self._is_movie = data.get("MediaType") == "Movie"
+        self._thumb_folder, self._thumb_name = tables.split_path(
+            data.get("ThumbPath"))
+        self.rotation_is_only_edit = data.get("RotationIsOnlyEdit")
 
-        self.albums = []  # list of albums that this image belongs to
-        self.faces = []
-        self.face_rectangles = []
+        self.albums = ()  # albums that this image belongs to
         self.event_name = '' # name of event (roll) that this image belongs to
         self.event_index = '' # index within event
-        self.event_index0 = '' # index with event, left padded with 0
+        self._event_digits = 0
 
+        # (face key, rectangle) pairs, decoded by _decode_faces().
         face_list = data.get("Faces")
         if face_list:
-            for face_entry in face_list:
-                face_key = face_entry.get("face key")
-                face_name = face_map.get(face_key)
-                if face_name:
-                    self.faces.append(face_name)
-                    # Rectangle is '{{x, y}, {width, height}}' as ratios,
-                    # referencing the lower left corner of the face rectangle.
-                    self.face_rectangles.append(parse_face_rectangle(
-                        face_entry.get("rectangle")))
-                # Other keys in face_entry: face index
+            # Other keys in face entries: face index
+            self._face_data = [(face_entry.get("face key"),
+                                face_entry.get("rectangle"))
+                               for face_entry in face_list]
+        else:
+            self._face_data = None
+        self._faces = ()
+        self._face_rectangles = ()
+
+    def _getimagepath(self):
+        return _join_path(self._image_folder, self._image_name)
+    def _setimagepath(self, path):
+        self._image_folder, self._image_name = self._tables.split_path(path)
+    image_path = property(_getimagepath, _setimagepath,
+                          doc="Path to the image file")
+
+    def _getoriginalpath(self):
+        if self._original_name is None and self._tables.masters:
+            self.find_aperture_original(self._tables.masters)
+        return _join_path(self._original_folder, self._original_name)
+    def _setoriginalpath(self, path):
+        self._original_folder, self._original_name = (
+            self._tables.split_path(path))
+    originalpath = property(_getoriginalpath, _setoriginalpath,
+                            doc="Path to the original image file, or None")
+
+    def _getthumbpath(self):
+        return _join_path(self._thumb_folder, self._thumb_name)
+    thumbpath = property(_getthumbpath, doc="Path to thumbnail image")
+
+    def _getdate(self):
+        if self._date_time is None and self._date is not None:
+            self._date_time = applexml.getappletime(self._date)
+        return self._date_time
+    date = property(_getdate, doc="Date and time the image was taken")
+
+    def _getmoddate(self):
+        if self._mod_date_time is None:
+            self._mod_date_time = applexml.getappletime(self._mod_date)
+        return self._mod_date_time
+    mod_date = property(_getmoddate, doc="Date and time of the last change")
+
+    def _getgps(self):
+        gps = self._gps
+        if gps.__class__ is tuple:
+            gps = self._gps = imageutils.GpsLocation(gps[0], gps[1])
+        return gps
+    gps = property(_getgps, doc="GpsLocation of the image, or None")
+
+    def getlatlong(self):
+        """Returns the GPS location as a (latitude, longitude) tuple, or
+           None."""
+        gps = self._gps
+        if gps is None or gps.__class__ is tuple:
+            return gps
+        return gps.latitude, gps.longitude
+
+    def _getkeywords(self):
+        strings = self._tables.keywords.strings
+        return tuple([strings[i] for i in self._keywords])
+    keywords = property(_getkeywords, doc="Keywords of the image (tuple)")
+
+    def haskeyword(self, keyword):
+        """Tests if the image has a keyword, without building the list of
+           keyword names."""
+        keyword_id = self._tables.keywords.get_id(keyword)
+        return keyword_id is not None and keyword_id in self._keywords
+
+    def _decode_faces(self):
+        faces = []
+        face_rectangles = []
+        face_ids = self._tables.face_ids
+        for face_key, rectangle in self._face_data:
+            face_id = face_ids.get(face_key)
+            if face_id is not None and self._tables.faces.strings[face_id]:
+                faces.append(face_id)
+                # Rectangle is '{{x, y}, {width, height}}' as ratios,
+                # referencing the lower left corner of the face rectangle.
+                face_rectangles.append(tuple(parse_face_rectangle(rectangle)))
+        self._faces = tuple(faces)
+        self._face_rectangles = tuple(face_rectangles)
+        self._face_data = None
+
+    def _getfaces(self):
+        if self._face_data is not None:
+            self._decode_faces()
+        strings = self._tables.faces.strings
+        return tuple([strings[i] for i in self._faces])
+    faces = property(_getfaces, doc="Names of the faces in the image (tuple)")
+
+    def _getfacerectangles(self):
+        if self._face_data is not None:
+            self._decode_faces()
+        return self._face_rectangles
+    face_rectangles = property(
+        _getfacerectangles,
+        doc="Rectangles (x, y, width, height) of the faces (tuple)")
+
+    def _geteventindex0(self):
+        if self.event_index == '':
+            return ''
+        return str(self.event_index).zfill(self._event_digits)
+    event_index0 = property(_geteventindex0,
+                            doc="Index within event, left padded with 0")
+
+    def set_event(self, name, index, index_digits):
+        """Records the event (roll) of this image, and its position in it."""
+        self.event_name = name
+        self.event_index = index
+        self._event_digits = index_digits
 
     def getimagepath(self):
         """Returns the full path to this image.."""
@@ -329,12 +1085,11 @@ class IPhotoImage(object):
 
     def getimagename(self):
         """Returns the file name of this image.."""
-        name = os.path.split(self.image_path)[1]
-        return name
+        return self._image_name
 
     def getbasename(self):
         """Returns the base name of the main image file."""
-        return sysutils.getfilebasename(self.image_path)
+        return sysutils.getfilebasename(self._image_name)
 
     def _getcaption(self):
         if not self._caption:
@@ -344,15 +1099,17 @@ class IPhotoImage(object):
 
     def ismovie(self):
         """Tests if this image is a movie."""
-        return self.data.get("MediaType") == "Movie"
+        return self._is_movie
 
     def addalbum(self, album):
         """Adds an album to the list of albums for this image."""
-        self.albums.append(album)
+        self.albums += (album,)
 
     def addface(self, name):
         """Adds a face (name) to the list of faces for this image."""
-        self.faces.append(name)
+        if self._face_data is not None:
+            self._decode_faces()
+        self._faces += (self._tables.faces.add(name),)
 
     def getfaces(self):
         """Gets the list of face tags for this image."""
@@ -360,53 +1117,26 @@ class IPhotoImage(object):
 
     def ishidden(self):
         """Tests if the image is hidden (using keyword "Hidden")"""
-        return "Hidden" in self.keywords
+        return self.haskeyword("Hidden")
 
-    def _getthumbpath(self):
-        return self.data.get("ThumbPath")
-    thumbpath = property(_getthumbpath, doc="Path to thumbnail image")
-
-    def _getrotationisonlyedit(self):
-        return self.data.get("RotationIsOnlyEdit")
-    rotation_is_only_edit = property(_getrotationisonlyedit,
-                                     doc="Rotation is only edit.")
-
-    def _search_for_file(self, folder_path, basename):
-        """Scans recursively through a folder tree and returns the path to the
-           first file it finds that starts with "basename".
-        """
-        for file_name in os.listdir(folder_path):
-            path = os.path.join(folder_path, file_name)
-            if os.path.isdir(path):
-                path = self._search_for_file(path, basename)
-                if path:
-                    return path
-            elif file_name.startswith(basename):
-                return path
-        return None
-        
-    def find_aperture_original(self):
-        """Attempts to locate the Aperture Master image. Works only for .jpg
-           masters that are stored in the Aperture library. Saves the result as
-           originalpath."""
-        master_path = _get_aperture_master_path(self.image_path)
-        if not os.path.exists(master_path):
-            return
-        basename = sysutils.getfilebasename(self.image_path)
-        file_name = os.path.join(master_path, basename + '.jpg')
-        if os.path.exists(file_name):
-            self.originalpath = file_name
-            return
-        path = self._search_for_file(master_path, basename + '.')
+    def find_aperture_original(self, masters):
+        """Attempts to locate the Aperture Master image in an ApertureMasters
+           index. Works only for masters that are stored in the Aperture
+           library. Saves the result as originalpath."""
+        path = masters.find(self.image_path)
         if path:
             self.originalpath = path
-            return
-        print "No master for " + self.image_path
+        else:
+            # Not found: no need to look again.
+            self._original_folder, self._original_name = None, ''
 
 
 class IPhotoContainer(object):
     """Base class for IPhotoAlbum and IPhotoRoll."""
 
+    __slots__ = ('name', 'date', 'albumtype', 'comment', 'albumid', 'images',
+                 'albums', 'master', 'keylist')
+
     def __init__(self, name, albumtype, data, images):
         self.name = name
         self.date = None
@@ -446,25 +1176,36 @@ class IPhotoContainer(object):
             else:
                 print 'Unknown album type %s for %s.' % (albumtype, name)
         self.albumtype = albumtype
-        self.data = data
+        self.comment = data.get("Comments") if data else None
 
         self.albumid = -1
         self.images = []
         self.albums = []
         self.master = False
 
+        self.keylist = ()
         if not self.isfolder() and data and data.has_key("KeyList"):
-            keylist = data.get("KeyList")
-            for key in keylist:
-                image = images.get(key)
-                if image:
-                    self.images.append(image)
-                else:
-                    print "%s: image with id %s does not exist." % (name, key)
-
-    def _getcomment(self):
-        return self.data.get("Comments")
-    comment = property(_getcomment, doc='comments (description)')
+            self.keylist = data.get("KeyList")
+        if images is not None:
+            self.resolve_images(images)
+
+    def resolve_images(self, images, skipped=None):
+        """Looks up the images of this container in a map from image id to
+           IPhotoImage.
+
+           Args:
+             images: map from image id to image.
+             skipped: optional function that tests if an image id is missing
+                 from the map on purpose.
+        """
+        for key in self.keylist:
+            image = images.get(key)
+            if image:
+                self.images.append(image)
+            elif not skipped or not skipped(key):
+                print "%s: image with id %s does not exist." % (self.name,
+                                                                key)
+        self.keylist = ()
 
     def _getsize(self):
         return len(self.images)
@@ -513,6 +1254,8 @@ class IPhotoContainer(object):
 class IPhotoRoll(IPhotoContainer):
     """Describes an iPhoto Roll or Event."""
 
+    __slots__ = ()
+
     def __init__(self, data, images):
         IPhotoContainer.__init__(self,
                                  data.get("RollName")
@@ -522,23 +1265,26 @@ class IPhotoRoll(IPhotoContainer):
         self.albumid = data.get("RollID")
         if not self.albumid:
             self.albumid = data.get("AlbumId")
-        self.date = applexml.getappletime(self.data.get(
+        self.date = applexml.getappletime(data.get(
             "RollDateAsTimerInterval"))
         if not self.date:
-            self.date = applexml.getappletime(self.data.get(
+            self.date = applexml.getappletime(data.get(
                 'ProjectEarliestDateAsTimerInterval'))
+
+    def resolve_images(self, images, skipped=None):
+        IPhotoContainer.resolve_images(self, images, skipped)
         i = 1
         index_digits = len(str(len(self.images)))
         for image in self.images:
-            image.event_name = self.name
-            image.event_index = i
-            image.event_index0 = str(i).zfill(index_digits)
+            image.set_event(self.name, i, index_digits)
             i += 1
 
 
 class IPhotoAlbum(IPhotoContainer):
     """Describes an iPhoto Album."""
 
+    __slots__ = ('parent',)
+
     def __init__(self, data, images, album_map, root_album):
         IPhotoContainer.__init__(self, data.get("AlbumName"),
                                  data.get("Album Type"),
@@ -557,15 +1303,19 @@ class IPhotoAlbum(IPhotoContainer):
                     self.name, parent_id)
         if self.parent:
             self.parent.addalbum(self)
+
+    def resolve_images(self, images, skipped=None):
+        IPhotoContainer.resolve_images(self, images, skipped)
         self.find_oldest_date()
 
 
-class IPhotoFace(object):
-    """An IPhotoContainer compatible class for a face."""
+class IPhotoVirtualAlbum(object):
+    """An IPhotoContainer compatible class for albums that are not in the
+       library, like faces and keywords."""
 
-    def __init__(self, face):
-        self.name = face
-        self.albumtype = "Face"
+    def __init__(self, name, albumtype):
+        self.name = name
+        self.albumtype = albumtype
         self.albumid = -1
         self.images = []
         self.albums = []
@@ -600,6 +1350,13 @@ class IPhotoFace(object):
         return "%s (%s)" % (self.name, self.albumtype)
 
 
+class IPhotoFace(IPhotoVirtualAlbum):
+    """An IPhotoContainer compatible class for a face."""
+
+    def __init__(self, face):
+        IPhotoVirtualAlbum.__init__(self, face, "Face")
+
+
 def get_album_xmlfile(library_dir):
     """Locates the iPhoto AlbumData.xml or Aperture ApertureData.xml file."""
     if os.path.exists(library_dir) and os.path.isdir(library_dir):
@@ -613,13 +1370,38 @@ def get_album_xmlfile(library_dir):
                        "library location.") % (library_dir)
 
 
-def get_iphoto_data(album_xml_file):
-    """reads the iPhoto database and converts it into an iPhotoData object."""
-    library_dir = os.path.dirname(album_xml_file)
-    print "Reading iPhoto database from " + library_dir + "..."
-    album_xml = applexml.read_applexml(album_xml_file)
+def get_iphoto_data(album_xml_file, cache=None, processes=1, selection=None):
+    """reads the iPhoto database and converts it into an iPhotoData object.
 
-    data = IPhotoData(album_xml, album_xml_file.endswith('ApertureData.xml'))
+       Args:
+         album_xml_file: path of AlbumData.xml or ApertureData.xml.
+         cache: optional librarycache.LibraryCache. If it has a current
+             snapshot of the file, the file is not parsed. Otherwise a new
+             snapshot is saved.
+         processes: number of processes for parsing the image list.
+         selection: optional ImageSelection. Images that are not selected are
+             skipped while parsing, unless a new snapshot is saved, or the
+             image list is parsed in several processes.
+    """
+    library_dir = os.path.dirname(album_xml_file)
+    entries = None
+    if cache:
+        entries = cache.load(album_xml_file)
+    if entries is None:
+        print "Reading iPhoto database from " + library_dir + "..."
+        # The snapshot needs all images.
+        entry_filter = None
+        if selection and not cache:
+            entry_filter = selection.wants
+        entries = applexml.iter_applexml_parallel(
+            album_xml_file, STREAMED_SECTIONS, _IMAGE_LIST, processes,
+            entry_filter)
+        if cache:
+            entries = cache.record(album_xml_file, entries)
+    else:
+        print "Reading iPhoto database snapshot for " + library_dir + "..."
+    data = IPhotoData(entries, album_xml_file.endswith('ApertureData.xml'),
+                      selection)
     if data.aperture:
         if not data.applicationVersion.startswith('3.'):
             raise ValueError, "Aperture version %s not supported" % (
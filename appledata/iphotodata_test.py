@@ -0,0 +1,463 @@
+"""This module tests iphotodata.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import appledata.applexml as applexml
+import appledata.iphotodata as iphotodata
+
+_IMAGE = """		<key>%(id)s</key>
+		<dict>
+			<key>MediaType</key>
+			<string>%(type)s</string>
+			<key>Caption</key>
+			<string>%(caption)s</string>
+			<key>Roll</key>
+			<integer>%(roll)s</integer>
+			<key>Rating</key>
+			<integer>%(rating)s</integer>
+			<key>ImagePath</key>
+			<string>/Users/me/Pictures/iPhoto Library/Masters/%(caption)s.JPG</string>
+			<key>ThumbPath</key>
+			<string>/Users/me/Pictures/iPhoto Library/Thumbnails/%(caption)s.jpg</string>
+			<key>DateAsTimerInterval</key>
+			<real>%(date)s</real>
+			<key>ModDateAsTimerInterval</key>
+			<real>%(date)s</real>
+			<key>latitude</key>
+			<real>%(latitude)s</real>
+			<key>longitude</key>
+			<real>%(longitude)s</real>
+			<key>Keywords</key>
+			<array>
+%(keywords)s			</array>
+			<key>Faces</key>
+			<array>
+%(faces)s			</array>
+		</dict>
+"""
+
+_KEYWORD = """				<string>%s</string>
+"""
+
+_FACE = """				<dict>
+					<key>face key</key>
+					<integer>%s</integer>
+					<key>rectangle</key>
+					<string>{{0.1, 0.2}, {0.3, 0.4}}</string>
+				</dict>
+"""
+
+# id, media type, caption, roll, rating, date, latitude, longitude,
+# keyword ids, face keys.
+_IMAGES = [
+    ('10', 'Image', 'Beach', '1', '5', '300000000', '37.5', '-122.25',
+     ['1'], ['7']),
+    ('11', 'Image', 'Dunes', '1', '3', '300086400', '37.625', '-122.375',
+     ['1', '2'], []),
+    ('12', 'Movie', 'Waves', '1', '0', '300172800', '0', '0', [], ['7', '8']),
+    ('20', 'Image', 'Snow', '2', '4', '320000000', '46.5', '7.75',
+     ['2', '3'], ['8']),
+    ('21', 'Image', 'Cabin', '2', '2', '320086400', '0', '0', ['3'], []),
+]
+
+_LIBRARY_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0">
+<dict>
+	<key>Application Version</key>
+	<string>8.1.2 (424)</string>
+	<key>List of Albums</key>
+	<array>
+		<dict>
+			<key>AlbumId</key>
+			<integer>2</integer>
+			<key>AlbumName</key>
+			<string>Photos</string>
+			<key>Master</key>
+			<true/>
+			<key>KeyList</key>
+			<array>
+				<string>10</string>
+				<string>11</string>
+				<string>12</string>
+				<string>20</string>
+				<string>21</string>
+			</array>
+		</dict>
+		<dict>
+			<key>AlbumId</key>
+			<integer>3</integer>
+			<key>AlbumName</key>
+			<string>Best of</string>
+			<key>Album Type</key>
+			<string>Regular</string>
+			<key>KeyList</key>
+			<array>
+				<string>10</string>
+				<string>20</string>
+			</array>
+		</dict>
+	</array>
+	<key>List of Faces</key>
+	<dict>
+		<key>7</key>
+		<dict>
+			<key>key</key>
+			<integer>7</integer>
+			<key>name</key>
+			<string>Alice</string>
+		</dict>
+		<key>8</key>
+		<dict>
+			<key>key</key>
+			<integer>8</integer>
+			<key>name</key>
+			<string>Bob</string>
+		</dict>
+	</dict>
+	<key>List of Keywords</key>
+	<dict>
+		<key>1</key>
+		<string>Beach</string>
+		<key>2</key>
+		<string>Hidden</string>
+		<key>3</key>
+		<string>Mountains</string>
+	</dict>
+	<key>List of Rolls</key>
+	<array>
+		<dict>
+			<key>RollID</key>
+			<integer>1</integer>
+			<key>RollName</key>
+			<string>Summer</string>
+			<key>RollDateAsTimerInterval</key>
+			<real>300000000</real>
+			<key>KeyList</key>
+			<array>
+				<string>10</string>
+				<string>11</string>
+				<string>12</string>
+			</array>
+		</dict>
+		<dict>
+			<key>RollID</key>
+			<integer>2</integer>
+			<key>RollName</key>
+			<string>Winter</string>
+			<key>RollDateAsTimerInterval</key>
+			<real>320000000</real>
+			<key>KeyList</key>
+			<array>
+				<string>20</string>
+				<string>21</string>
+			</array>
+		</dict>
+	</array>
+	<key>Master Image List</key>
+	<dict>
+"""
+
+_LIBRARY_FOOTER = """	</dict>
+</dict>
+</plist>
+"""
+
+
+def make_library():
+    """Returns the XML data of a small iPhoto library."""
+    images = []
+    for (image_id, media_type, caption, roll, rating, date, latitude,
+         longitude, keywords, faces) in _IMAGES:
+        images.append(_IMAGE % {
+            'id': image_id, 'type': media_type, 'caption': caption,
+            'roll': roll, 'rating': rating, 'date': date,
+            'latitude': latitude, 'longitude': longitude,
+            'keywords': ''.join([_KEYWORD % (k) for k in keywords]),
+            'faces': ''.join([_FACE % (f) for f in faces])})
+    return _LIBRARY_HEADER + ''.join(images) + _LIBRARY_FOOTER
+
+
+def describe(data):
+    """Returns the content of an IPhotoData in a form that can be compared."""
+    images = {}
+    for image_id, image in data.images_by_id.items():
+        images[image_id] = (
+            image.caption, image.date, image.mod_date, image.rating,
+            image.keywords, image.faces, image.face_rectangles,
+            image.ismovie(), image.thumbpath, image.roll,
+            image.event_name, image.event_index,
+            [album.name for album in image.albums],
+            image.gps and (image.gps.latitude, image.gps.longitude))
+    albums = {}
+    for album in data.albums.values() + data.rolls:
+        albums[album.albumid] = (album.name, album.albumtype,
+                                 [image.caption for image in album.images])
+    return images, albums
+
+
+class ApertureMastersTest(unittest.TestCase):
+    """Unit tests for the lookup of Aperture masters."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for path in ('Masters/2010/07/05/20100705-1/IMG_1.NEF',
+                     'Masters/2010/07/05/20100705-1/IMG_1.jpg',
+                     'Masters/2010/07/05/20100705-1/raw/IMG_2.CR2',
+                     'Masters/2010/07/05/20100705-1/IMG_20.CR2',
+                     'Masters/2011/01/01/20110101-1/IMG.3.tif'):
+            path = os.path.join(self.folder, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'wb').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _preview(self, folder, name):
+        return os.path.join(self.folder, 'Previews', folder, 'uuid', name)
+
+    def _master(self, folder, name):
+        return os.path.join(self.folder, 'Masters', folder, name)
+
+    def test_find(self):
+        """Tests the lookup of masters for previews."""
+        event = '2010/07/05/20100705-1'
+        masters = iphotodata.ApertureMasters(threads=2)
+        self.assertEquals(self._master(event, 'IMG_1.jpg'),
+                          masters.find(self._preview(event, 'IMG_1.jpg')))
+        self.assertEquals(self._master(event, 'raw/IMG_2.CR2'),
+                          masters.find(self._preview(event, 'IMG_2.jpg')))
+        self.assertEquals(
+            self._master('2011/01/01/20110101-1', 'IMG.3.tif'),
+            masters.find(self._preview('2011/01/01/20110101-1', 'IMG.3.jpg')))
+        self.assertEquals(None, masters.find(self._preview(event,
+                                                           'IMG_4.jpg')))
+        self.assertEquals(None, masters.find(
+            self._preview('2012/01/01/20120101-1', 'IMG_1.jpg')))
+
+    @unittest.skipIf(sys.getfilesystemencoding().lower() not in ('utf-8',
+                                                                 'utf8'),
+                     'File names are not UTF-8')
+    def test_find_decomposed(self):
+        """Tests a master in a folder with a decomposed (NFD) name, for a
+           preview path in composed form (as read from AlbumData.xml)."""
+        folder = os.path.join(unicode(self.folder), u'Masters',
+                              u'Cafe\u0301', u'20100705-1')
+        os.makedirs(folder)
+        open(os.path.join(folder, u'IMG_1.NEF'), 'wb').close()
+        masters = iphotodata.ApertureMasters(threads=1)
+        self.assertEquals(
+            os.path.join(folder, u'IMG_1.NEF'),
+            masters.find(self._preview(u'Caf\xe9/20100705-1', u'IMG_1.jpg')))
+
+    def test_originalpath(self):
+        """Tests that images look up their master when it is needed."""
+        event = '2010/07/05/20100705-1'
+        tables = iphotodata.LibraryTables()
+        image = iphotodata.IPhotoImage(
+            {'ImagePath': self._preview(event, 'IMG_2.jpg'),
+             'ModDateAsTimerInterval': '0'}, tables)
+        missing = iphotodata.IPhotoImage(
+            {'ImagePath': self._preview(event, 'IMG_5.jpg'),
+             'ModDateAsTimerInterval': '0'}, tables)
+        self.assertEquals(None, image.originalpath)
+        tables.masters = iphotodata.ApertureMasters()
+        self.assertEquals(self._master(event, 'raw/IMG_2.CR2'),
+                          image.originalpath)
+        self.assertEquals(None, missing.originalpath)
+        self.assertEquals(None, missing.originalpath)
+
+
+class _Album(object):
+    def __init__(self, name, albumtype, albums=()):
+        self.name = name
+        self.albumtype = albumtype
+        self.albums = list(albums)
+
+
+class FindAlbumsTest(unittest.TestCase):
+    """Unit tests for find_albums()."""
+
+    def setUp(self):
+        self.albums = [
+            _Album(u'Trips', u'Folder', [
+                _Album(u'Paris', u'Regular'),
+                _Album(u'Rome', u'Smart'),
+                _Album(u'2010', u'Folder', [_Album(u'Oslo', u'Regular')])]),
+            _Album(u'Paris old', u'Regular'),
+            _Album(None, u'Regular'),
+            _Album(u'Other', u'None')]
+
+    def _find(self, includes, excludes=None, album_types=(u'Regular',)):
+        return [(album.name, prefix) for album, prefix in
+                iphotodata.find_albums(self.albums, album_types, includes,
+                                       excludes)]
+
+    def test_find_albums(self):
+        """Tests the patterns, types and folder prefixes."""
+        self.assertEquals([(u'Paris', u'Trips/'), (u'Paris old', u'')],
+                          self._find(u'Paris'))
+        # Albums in a matching folder match too.
+        self.assertEquals([(u'Paris', u'Trips/'), (u'Oslo', u'Trips/2010/')],
+                          self._find(u'Trips'))
+        self.assertEquals([(u'Oslo', u'Trips/2010/')],
+                          self._find(u'Trips', u'Paris'))
+        self.assertEquals([(u'Rome', u'Trips/')],
+                          self._find(u'.', album_types=(u'Smart',)))
+        self.assertEquals([(None, u'')], self._find(u'xxx'))
+
+
+class IPhotoDataTest(unittest.TestCase):
+    """Unit tests for iphotodata.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'AlbumData.xml')
+        xml_file = open(self.path, 'wb')
+        xml_file.write(make_library())
+        xml_file.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_get_iphoto_data(self):
+        """Tests that the streamed data match the data from the tree."""
+        data = iphotodata.get_iphoto_data(self.path)
+        expected = iphotodata.IPhotoData(applexml.read_applexml(self.path),
+                                         False)
+        self.assertEquals(describe(expected), describe(data))
+        self.assertEquals(u'8.1.2 (424)', data.applicationVersion)
+        self.assertFalse('Master Image List' in data.data)
+
+        image = data.images_by_id['11']
+        self.assertEquals((u'Beach', u'Hidden'), image.keywords)
+        self.assertTrue(image.ishidden())
+        self.assertTrue(image.haskeyword(u'Beach'))
+        self.assertFalse(image.haskeyword(u'Snow'))
+        self.assertFalse(image.haskeyword(u'Unknown'))
+        self.assertEquals(u'Summer', image.event_name)
+        self.assertEquals((u'Alice', u'Bob'),
+                          data.images_by_id['12'].getfaces())
+        self.assertTrue(data.images_by_id['12'].ismovie())
+        self.assertEquals([u'Beach', u'Snow'],
+                          [i.caption for i in data.albums[u'3'].images])
+        self.assertEquals(((0.1, 0.2, 0.3, 0.4),),
+                          data.images_by_id['10'].face_rectangles)
+        self.assertEquals((37.5, -122.25),
+                          (data.images_by_id['10'].gps.latitude,
+                           data.images_by_id['10'].gps.longitude))
+        self.assertEquals('3', data.images_by_id['12'].event_index0)
+        self.assertFalse(hasattr(data.images_by_id['10'], '__dict__'))
+
+    def test_query(self):
+        """Tests the image indexes."""
+        data = iphotodata.get_iphoto_data(self.path)
+        def captions(images):
+            return [image.caption for image in images]
+        self.assertEquals([u'Beach', u'Dunes', u'Waves', u'Snow', u'Cabin'],
+                          captions(data.query()))
+        self.assertEquals([u'Dunes', u'Snow'],
+                          captions(data.query(keywords=[u'Hidden'])))
+        self.assertEquals([u'Dunes'], captions(
+            data.query(keywords=[u'Hidden', u'Beach'])))
+        self.assertEquals([], data.query(keywords=[u'Unknown']))
+        self.assertEquals([u'Waves', u'Snow'],
+                          captions(data.query(faces=[u'Bob'])))
+        self.assertEquals([u'Snow'], captions(
+            data.query(faces=[u'Bob'], rolls=[u'2'])))
+        self.assertEquals([u'Beach', u'Snow'],
+                          captions(data.query(min_rating=4)))
+        start = data.images_by_id['11'].date
+        end = data.images_by_id['21'].date
+        self.assertEquals([u'Dunes', u'Waves', u'Snow'],
+                          captions(data.query(date_range=(start, end))))
+        self.assertEquals([u'Cabin'],
+                          captions(data.query(date_range=(end, None))))
+
+        face_albums = dict([(album.name, sorted(captions(album.images)))
+                            for album in data.getfacealbums()])
+        self.assertEquals({u'Alice': [u'Beach', u'Waves'],
+                           u'Bob': [u'Snow', u'Waves']}, face_albums)
+        keyword_albums = dict([(album.name, album)
+                               for album in data.getkeywordalbums()])
+        self.assertEquals([u'Beach', u'Hidden', u'Mountains'],
+                          sorted(keyword_albums.keys()))
+        self.assertEquals('Keyword', keyword_albums[u'Mountains'].albumtype)
+        self.assertEquals(2, keyword_albums[u'Mountains'].size)
+        date_albums = data.getdatealbums('%Y')
+        self.assertEquals([u'2010', u'2011'],
+                          [album.name for album in date_albums])
+        self.assertEquals([u'Beach', u'Dunes', u'Waves'],
+                          captions(date_albums[0].images))
+
+    def test_location_albums(self):
+        """Tests the albums of images taken near each other."""
+        data = iphotodata.get_iphoto_data(self.path)
+        self.assertEquals(
+            [u'Beach', u'Dunes'],
+            [image.caption for image in data.geo_index.near(37.5, -122.3, 20)])
+        albums = data.getlocationalbums(25)
+        self.assertEquals([(u'Summer', [u'Beach', u'Dunes']),
+                           (u'Winter', [u'Snow'])],
+                          [(album.name, [i.caption for i in album.images])
+                           for album in albums])
+        self.assertEquals('Location', albums[0].albumtype)
+        self.assertEquals([u'Summer', u'Summer (2)', u'Winter'],
+                          [album.name for album in data.getlocationalbums(5)])
+
+    def test_tables(self):
+        """Tests the sharing of names and folders between images."""
+        tables = iphotodata.LibraryTables()
+        first = tables.split_path(u'/Library/Masters/a.jpg')
+        second = tables.split_path(u'/Library/Masters' + u'/b.jpg')
+        self.assertEquals((u'/Library/Masters/', u'a.jpg'), first)
+        self.assertTrue(first[0] is second[0])
+        self.assertEquals((u'', u'c.jpg'), tables.split_path(u'c.jpg'))
+        self.assertEquals((None, None), tables.split_path(None))
+        table = iphotodata.StringTable()
+        self.assertEquals(0, table.add(u'Beach'))
+        self.assertEquals(1, table.add(u'Snow'))
+        self.assertEquals(0, table.add(u'Beach'))
+        self.assertEquals(1, table.get_id(u'Snow'))
+        self.assertEquals(None, table.get_id(u'Hidden'))
+        self.assertEquals(2, len(table))
+
+    def test_selection(self):
+        """Tests that only the images of the selected albums are loaded."""
+        def album_filter(root_album):
+            return [album for album in root_album.albums
+                    if album.name == u'Winter']
+        for data in (iphotodata.get_iphoto_data(
+                         self.path, selection=iphotodata.ImageSelection(
+                             album_filter)),
+                     iphotodata.IPhotoData(
+                         applexml.read_applexml(self.path), False,
+                         iphotodata.ImageSelection(album_filter))):
+            self.assertEquals([u'20', u'21'], sorted(data.images_by_id))
+            self.assertEquals([u'Snow', u'Cabin'],
+                              [i.caption for i in data.getroll(u'2').images])
+            self.assertEquals([], data.getroll(u'1').images)
+            self.assertEquals([u'Snow'],
+                              [i.caption for i in data.albums[u'3'].images])
+            self.assertEquals(2, data.images_by_id[u'21'].event_index)
+
+if __name__ == '__main__':
+    unittest.main()
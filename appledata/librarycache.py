@@ -0,0 +1,142 @@
+"""Snapshot cache of parsed iPhoto libraries.
+
+Parsing AlbumData.xml is the slowest part of starting an export. The cache
+keeps the data that IPhotoData uses in a marshal file, and reuses it as long
+as AlbumData.xml has the same path, modification time and size, and the
+snapshot was written by the same version of the program.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import logging
+import marshal
+import os
+import tempfile
+
+import appledata.iphotodata as iphotodata
+
+DEFAULT_CACHE_FOLDER = '~/.cache/phoshare'
+
+# Changes whenever the layout of the snapshot changes.
+_FORMAT_VERSION = 1
+
+_IMAGE_LIST = 'Master Image List'
+
+_logger = logging.getLogger('google.librarycache')
+
+
+def _compact_entry(entry):
+    """Converts an entry of applexml.iter_applexml() into its snapshot form.
+       Images keep only the values listed in iphotodata.IMAGE_KEYS, as a tuple
+       in that order."""
+    section, key, value = entry
+    if section != _IMAGE_LIST:
+        return entry
+    get = value.get
+    return (section, key, tuple([get(k) for k in iphotodata.IMAGE_KEYS]))
+
+
+def _expand_entries(entries):
+    """Turns the snapshot form of the entries back into dictionaries."""
+    image_keys = iphotodata.IMAGE_KEYS
+    for section, key, value in entries:
+        if section == _IMAGE_LIST:
+            value = dict([(k, v) for (k, v) in zip(image_keys, value)
+                          if v is not None])
+        yield section, key, value
+
+
+class LibraryCache(object):
+    """Reads and writes snapshots of parsed libraries in a cache folder."""
+
+    def __init__(self, cache_folder, version):
+        """Creates a cache.
+
+        Args:
+          cache_folder: folder for the snapshot files. Created when the first
+              snapshot is saved.
+          version: version of the program. Snapshots from other versions are
+              ignored.
+        """
+        self.cache_folder = cache_folder
+        self.version = version
+
+    def get_snapshot_path(self, album_xml_file):
+        """Returns the path of the snapshot for a library file."""
+        xml_path = os.path.abspath(album_xml_file)
+        if isinstance(xml_path, unicode):
+            xml_path = xml_path.encode('utf-8')
+        name = hashlib.md5(xml_path).hexdigest()
+        return os.path.join(self.cache_folder, name + '.marshal')
+
+    def _get_key(self, album_xml_file):
+        xml_stat = os.stat(album_xml_file)
+        return (_FORMAT_VERSION, self.version,
+                os.path.abspath(album_xml_file), xml_stat.st_mtime,
+                xml_stat.st_size)
+
+    def load(self, album_xml_file):
+        """Returns the entries of the snapshot of a library file in the form
+           of applexml.iter_applexml(), or None if there is no valid snapshot.
+        """
+        path = self.get_snapshot_path(album_xml_file)
+        try:
+            snapshot_file = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                key = marshal.load(snapshot_file)
+                if key != self._get_key(album_xml_file):
+                    _logger.debug(u'Library snapshot %s is out of date.', path)
+                    return None
+                entries = marshal.load(snapshot_file)
+            except (EOFError, ValueError, TypeError), e:
+                _logger.info(u'Ignoring bad library snapshot %s: %s', path, e)
+                return None
+        finally:
+            snapshot_file.close()
+        return _expand_entries(entries)
+
+    def record(self, album_xml_file, entries):
+        """Passes through the entries of applexml.iter_applexml(), and saves a
+           snapshot of them after the last one."""
+        key = self._get_key(album_xml_file)
+        records = []
+        for entry in entries:
+            records.append(_compact_entry(entry))
+            yield entry
+        self._save(album_xml_file, key, records)
+
+    def _save(self, album_xml_file, key, records):
+        path = self.get_snapshot_path(album_xml_file)
+        try:
+            if not os.path.isdir(self.cache_folder):
+                os.makedirs(self.cache_folder)
+            tmpfd, tmp_path = tempfile.mkstemp(dir=self.cache_folder)
+            snapshot_file = os.fdopen(tmpfd, 'wb')
+            try:
+                try:
+                    marshal.dump(key, snapshot_file, 2)
+                    marshal.dump(records, snapshot_file, 2)
+                finally:
+                    snapshot_file.close()
+                os.rename(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError, ValueError), e:
+            _logger.info(u'Could not save library snapshot %s: %s', path, e)
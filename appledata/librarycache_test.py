@@ -0,0 +1,74 @@
+"""This module tests librarycache.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import appledata.iphotodata as iphotodata
+import appledata.iphotodata_test as iphotodata_test
+import appledata.librarycache as librarycache
+
+class LibraryCacheTest(unittest.TestCase):
+    """Unit tests for librarycache.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'AlbumData.xml')
+        self._write(iphotodata_test.make_library())
+        self.cache = librarycache.LibraryCache(
+            os.path.join(self.folder, 'cache'), 'Phoshare test')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, data):
+        xml_file = open(self.path, 'wb')
+        xml_file.write(data)
+        xml_file.close()
+
+    def test_snapshot(self):
+        """Tests that a snapshot is saved, reused, and invalidated."""
+        self.assertEquals(None, self.cache.load(self.path))
+        expected = iphotodata.get_iphoto_data(self.path, self.cache)
+        snapshot_path = self.cache.get_snapshot_path(self.path)
+        self.assertTrue(os.path.exists(snapshot_path))
+        self.assertEquals(iphotodata_test.describe(expected),
+                          iphotodata_test.describe(
+                              iphotodata.get_iphoto_data(self.path,
+                                                         self.cache)))
+
+        other_version = librarycache.LibraryCache(self.cache.cache_folder,
+                                                  'Phoshare 0.1')
+        self.assertEquals(None, other_version.load(self.path))
+
+        self._write(iphotodata_test.make_library().replace('Snow', 'Ice'))
+        self.assertEquals(None, self.cache.load(self.path))
+        data = iphotodata.get_iphoto_data(self.path, self.cache)
+        self.assertEquals(u'Ice', data.images_by_id['20'].caption)
+
+    def test_bad_snapshot(self):
+        """Tests that damaged snapshots are ignored."""
+        iphotodata.get_iphoto_data(self.path, self.cache)
+        snapshot_path = self.cache.get_snapshot_path(self.path)
+        snapshot_file = open(snapshot_path, 'r+b')
+        snapshot_file.truncate(os.path.getsize(snapshot_path) / 2)
+        snapshot_file.close()
+        self.assertEquals(None, self.cache.load(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+"""Finds images that are exported more than once with the same content, and
+groups of images that look alike."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+
+import tilutil.hashcache as hashcache
+import tilutil.phash as phash
+import tilutil.systemutils as su
+
+# Values of the --duplicates option.
+SKIP = 'skip'
+LINK = 'link'
+REPORT = 'report'
+MODES = (SKIP, LINK, REPORT)
+
+# Values of the --similar option.
+BEST = 'best'
+SIMILAR_MODES = (BEST, REPORT)
+
+
+def get_hash_cache(cache_folder, workers):
+    """Opens the hash cache in a cache folder."""
+    return hashcache.HashCache(os.path.join(cache_folder,
+                                            hashcache.HASH_CACHE_NAME),
+                               workers)
+
+
+def get_phash_cache(cache_folder):
+    """Opens the perceptual hash cache in a cache folder."""
+    return hashcache.HashCache(os.path.join(cache_folder,
+                                            hashcache.PHASH_CACHE_NAME),
+                               hash_files=phash.hash_files)
+
+
+def find_duplicates(named_folders, hash_cache):
+    """Finds the exported files whose image has the same content as the image
+       of an earlier file, going through the folders and files in sorted
+       order. An image that is in several folders is not a duplicate of
+       itself.
+
+    Args:
+      named_folders: map from folder name to an export folder, with a files
+          map from base name to an export file that has the image as photo.
+      hash_cache: hashcache.HashCache.
+    Returns:
+      List of (folder name, base name, first file) tuples, one for each
+      duplicate. first file is the export file of the first image with the
+      same content.
+    """
+    entries = []
+    paths = []
+    for folder_name in sorted(named_folders):
+        files = named_folders[folder_name].files
+        for base_name in sorted(files):
+            photo = files[base_name].photo
+            entries.append((folder_name, base_name, files[base_name]))
+            paths.append(photo.image_path)
+            if photo.originalpath:
+                paths.append(photo.originalpath)
+    hashes = hash_cache.get_hashes(paths)
+
+    first_files = {}  # content key -> first export file
+    first_images = {}  # content key -> first image
+    duplicates = []
+    for folder_name, base_name, export_file in entries:
+        photo = export_file.photo
+        digest = hashes.get(photo.image_path)
+        if digest is None:
+            continue
+        key = (digest, hashes.get(photo.originalpath))
+        first_image = first_images.setdefault(key, photo)
+        first_file = first_files.setdefault(key, export_file)
+        if first_image is not photo:
+            duplicates.append((folder_name, base_name, first_file))
+    return duplicates
+
+
+def handle_duplicates(named_folders, mode, hash_cache):
+    """Reports, skips or links the duplicates found by find_duplicates().
+
+    With SKIP, duplicates are removed from their folders. With LINK, the
+    link_to attribute of the export file of each duplicate is set to the
+    first file, and the export links the files. With REPORT, duplicates are
+    only listed.
+
+    Returns:
+      number of duplicates.
+    """
+    duplicates = find_duplicates(named_folders, hash_cache)
+    for folder_name, base_name, first_file in duplicates:
+        folder = named_folders[folder_name]
+        export_file = folder.files[base_name]
+        if mode == SKIP:
+            su.pout(u'Skipping duplicate %s/%s (same as %s).' % (
+                folder_name, base_name, first_file.photo.image_path))
+            del folder.files[base_name]
+        elif mode == LINK:
+            export_file.link_to = first_file
+        else:
+            su.pout(u'Duplicate: %s (%s) has the same content as %s (%s).' % (
+                export_file.photo.image_path, export_file.photo.caption,
+                first_file.photo.image_path, first_file.photo.caption))
+    return len(duplicates)
+
+
+def find_similar(named_folders, phash_cache, max_distance):
+    """Finds groups of exported images that look alike, by comparing the
+       perceptual hashes of their thumbnails. Movies are left out.
+
+    Each group is led by its best rated image (the first one if several have
+    the same rating), and has the other images within max_distance of it.
+
+    Args:
+      named_folders: map from folder name to an export folder, with a files
+          map from base name to an export file that has the image as photo.
+      phash_cache: hashcache.HashCache that computes perceptual hashes (see
+          get_phash_cache()).
+      max_distance: largest number of hash bits that differ between similar
+          images.
+    Returns:
+      List of groups, each a list of (image, locations) tuples, where
+      locations lists the (folder name, base name) tuples of the image. The
+      best image is first, followed by the others in the order of the
+      folders and files. Groups are in the order of their best images.
+    """
+    images = []
+    locations = {}  # id(image) -> [(folder name, base name)]
+    paths = {}  # id(image) -> path of the file to hash
+    for folder_name in sorted(named_folders):
+        files = named_folders[folder_name].files
+        for base_name in sorted(files):
+            photo = files[base_name].photo
+            if photo.ismovie():
+                continue
+            if id(photo) not in locations:
+                images.append(photo)
+                locations[id(photo)] = []
+                paths[id(photo)] = photo.thumbpath or photo.image_path
+            locations[id(photo)].append((folder_name, base_name))
+    hashes = phash_cache.get_hashes(paths.values())
+
+    hashed = []
+    for photo in images:
+        digest = hashes.get(paths[id(photo)])
+        if digest is not None:
+            hashed.append((photo, int(digest, 16)))
+    # Best rated images lead the groups. The sort is stable, so images with
+    # the same rating stay in file order.
+    hashed.sort(key=lambda entry: -(entry[0].rating or 0))
+    order = dict([(id(photo), i) for i, photo in enumerate(images)])
+    groups = []
+    for group in phash.group_similar(hashed, max_distance):
+        group[1:] = sorted(group[1:], key=lambda photo: order[id(photo)])
+        groups.append(group)
+    groups.sort(key=lambda group: order[id(group[0])])
+    return [[(photo, locations[id(photo)]) for photo in group]
+            for group in groups]
+
+
+def handle_similar(named_folders, mode, phash_cache, max_distance):
+    """Reports the groups found by find_similar(), or with BEST, keeps only
+       the best image of each group: the others are removed from the
+       folders that also have the best image.
+
+    Returns:
+      number of groups.
+    """
+    groups = find_similar(named_folders, phash_cache, max_distance)
+    for group in groups:
+        best, best_locations = group[0]
+        if mode == REPORT:
+            su.pout(u'Similar images:')
+            for photo, _locations in group:
+                su.pout(u'  %s (%s, rating %s)' % (
+                    photo.image_path, photo.caption, photo.rating))
+            continue
+        best_folders = set([folder_name
+                            for folder_name, _base_name in best_locations])
+        for _photo, photo_locations in group[1:]:
+            for folder_name, base_name in photo_locations:
+                if folder_name not in best_folders:
+                    continue
+                su.pout(u'Skipping %s/%s (similar to %s).' % (
+                    folder_name, base_name, best.image_path))
+                del named_folders[folder_name].files[base_name]
+    return len(groups)
@@ -0,0 +1,144 @@
+"""This module tests duplicates.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import phoshare.duplicates as duplicates
+import tilutil.hashcache as hashcache
+
+class _Photo(object):
+    def __init__(self, image_path, originalpath=None, rating=None,
+                 movie=False):
+        self.image_path = image_path
+        self.thumbpath = image_path
+        self.originalpath = originalpath
+        self.caption = os.path.basename(image_path)
+        self.rating = rating
+        self.movie = movie
+
+    def ismovie(self):
+        return self.movie
+
+
+def _read_hashes(paths):
+    """Uses the content of test files as their perceptual hash."""
+    return dict([(path, open(path).read()) for path in paths])
+
+
+class _File(object):
+    def __init__(self, photo):
+        self.photo = photo
+        self.link_to = None
+
+
+class _Folder(object):
+    def __init__(self, files):
+        self.files = files
+
+
+class DuplicatesTest(unittest.TestCase):
+    """Unit tests for duplicates.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = duplicates.get_hash_cache(
+            os.path.join(self.folder, 'cache'), 2)
+        beach = _Photo(self._write(u'beach.jpg', 'beach'))
+        self.files = {
+            'A': _Folder({'1': _File(beach),
+                          '2': _File(_Photo(self._write(u'dunes.jpg',
+                                                        'dunes')))}),
+            'B': _Folder({'1': _File(_Photo(self._write(u'beach2.jpg',
+                                                        'beach'))),
+                          # Same image in another album.
+                          '2': _File(beach),
+                          # Same image, different original.
+                          '3': _File(_Photo(
+                              self._write(u'beach3.jpg', 'beach'),
+                              self._write(u'original.jpg', 'original')))})}
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, data):
+        path = os.path.join(self.folder, name)
+        output = open(path, 'wb')
+        output.write(data)
+        output.close()
+        return path
+
+    def test_find_duplicates(self):
+        """Tests that only images with the same content are duplicates."""
+        self.assertEquals(
+            [('B', '1', self.files['A'].files['1'])],
+            duplicates.find_duplicates(self.files, self.cache))
+
+    def test_handle_duplicates(self):
+        """Tests the skip and link modes."""
+        first_file = self.files['A'].files['1']
+        duplicate = self.files['B'].files['1']
+        self.assertEquals(1, duplicates.handle_duplicates(
+            self.files, duplicates.LINK, self.cache))
+        self.assertTrue(duplicate.link_to is first_file)
+        self.assertEquals(1, duplicates.handle_duplicates(
+            self.files, duplicates.SKIP, self.cache))
+        self.assertEquals(['2', '3'], sorted(self.files['B'].files))
+
+    def test_handle_similar(self):
+        """Tests that images similar to the best rated image of a group are
+           removed from the folders that have the best image."""
+        cache = hashcache.HashCache(os.path.join(self.folder, 'phashes.db'),
+                                    hash_files=_read_hashes)
+        burst = _Photo(self._write(u'burst2.jpg', '00000000000000f0'), rating=4)
+        first = _Photo(self._write(u'burst1.jpg', '0000000000000000'),
+                       rating=2)
+        folders = {
+            'A': _Folder({'1': _File(first),
+                          '2': _File(burst),
+                          '3': _File(_Photo(
+                              self._write(u'other.jpg', 'ffffffff00000000'))),
+                          '4': _File(_Photo(
+                              self._write(u'movie.mov', '0000000000000000'),
+                              movie=True))}),
+            # burst3 is similar to burst1, but not to burst2.
+            'B': _Folder({'1': _File(_Photo(
+                              self._write(u'burst3.jpg', '0000000000000001'),
+                              rating=4)),
+                          '2': _File(burst)}),
+            'C': _Folder({'1': _File(first)})}
+        groups = duplicates.find_similar(folders, cache, 4)
+        self.assertEquals([[burst, first]],
+                          [[photo for photo, _locations in group]
+                           for group in groups])
+        self.assertEquals([[('A', '2'), ('B', '2')], [('A', '1'), ('C', '1')]],
+                          [locations for _photo, locations in groups[0]])
+        self.assertEquals(0, duplicates.handle_similar(folders,
+                                                       duplicates.BEST,
+                                                       cache, 0))
+        self.assertEquals(1, duplicates.handle_similar(folders,
+                                                       duplicates.BEST,
+                                                       cache, 4))
+        self.assertEquals(['2', '3', '4'], sorted(folders['A'].files))
+        self.assertEquals(['1', '2'], sorted(folders['B'].files))
+        self.assertEquals(['1'], sorted(folders['C'].files))
+        cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
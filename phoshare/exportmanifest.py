@@ -0,0 +1,154 @@
+"""Database of exported files, used to skip checks for unchanged files."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+# The manifest lives in the export folder. The name starts with a dot, so
+# imageutils.is_ignore() keeps the folder scan from deleting it.
+MANIFEST_NAME = '.phoshare.db'
+
+_SCHEMA_VERSION = 1
+
+_COLUMNS = ('export_path', 'source_path', 'source_mtime', 'source_size',
+            'source_inode', 'mod_date', 'fingerprint', 'export_mtime',
+            'export_size')
+
+_logger = logging.getLogger('google.exportmanifest')
+
+
+class ManifestEntry(object):
+    """What we know about an exported file from the last run."""
+
+    def __init__(self, row):
+        (self.export_path, self.source_path, self.source_mtime,
+         self.source_size, self.source_inode, self.mod_date, self.fingerprint,
+         self.export_mtime, self.export_size) = row
+
+    def matches_export(self, export_stat):
+        """Tests if the exported file is unchanged since it was recorded."""
+        return (export_stat.st_size == self.export_size and
+                export_stat.st_mtime == self.export_mtime)
+
+    def matches_source(self, source_stat):
+        """Tests if the source file is unchanged since it was recorded."""
+        return (source_stat.st_size == self.source_size and
+                source_stat.st_mtime == self.source_mtime and
+                source_stat.st_ino == self.source_inode)
+
+
+def get_fingerprint(*values):
+    """Returns a short digest of the repr() of a list of values."""
+    return hashlib.md5(repr(values)).hexdigest()
+
+
+def get_timestamp(date):
+    """Converts an optional datetime into a number we can store."""
+    if date is None:
+        return None
+    return time.mktime(date.timetuple()) + date.microsecond / 1000000.0
+
+
+class ExportManifest(object):
+    """Records the state of exported files in a SQLite database in the export
+       folder.
+
+    Entries are keyed by the path of the exported file. Updates are written
+    when commit() is called.
+    """
+
+    def __init__(self, export_folder):
+        self.path = os.path.join(export_folder, MANIFEST_NAME)
+        self._connection = sqlite3.connect(self.path)
+        self._connection.text_factory = unicode
+        self._seen = set()
+        self._create_tables()
+
+    def _create_tables(self):
+        """Creates the database tables, dropping data of other versions."""
+        cursor = self._connection.cursor()
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version != _SCHEMA_VERSION:
+            if version:
+                _logger.info(u'Discarding export manifest version %d.',
+                             version)
+            cursor.execute('DROP TABLE IF EXISTS files')
+            cursor.execute(
+                'CREATE TABLE files (export_path TEXT PRIMARY KEY, '
+                'source_path TEXT, source_mtime REAL, source_size INTEGER, '
+                'source_inode INTEGER, mod_date REAL, fingerprint TEXT, '
+                'export_mtime REAL, export_size INTEGER)')
+            cursor.execute('PRAGMA user_version = %d' % (_SCHEMA_VERSION))
+            self._connection.commit()
+
+    def lookup(self, export_path):
+        """Returns the ManifestEntry for an exported file, or None."""
+        self._seen.add(export_path)
+        row = self._connection.execute(
+            'SELECT %s FROM files WHERE export_path = ?' % (
+                ', '.join(_COLUMNS)), (export_path,)).fetchone()
+        if row is None:
+            return None
+        return ManifestEntry(row)
+
+    def update(self, export_path, source_path, mod_date, fingerprint):
+        """Records the current state of an exported file.
+
+        Args:
+          export_path: path of the exported file.
+          source_path: path of the file it was exported from.
+          mod_date: modification date of the image in the library, or None.
+          fingerprint: digest of the metadata written into the file, or None.
+        Raises:
+          OSError: if one of the files does not exist.
+        """
+        self._seen.add(export_path)
+        source_stat = os.stat(source_path)
+        export_stat = os.stat(export_path)
+        self._connection.execute(
+            'INSERT OR REPLACE INTO files (%s) VALUES (%s)' % (
+                ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))),
+            (export_path, source_path, source_stat.st_mtime,
+             source_stat.st_size, source_stat.st_ino,
+             get_timestamp(mod_date), fingerprint, export_stat.st_mtime,
+             export_stat.st_size))
+
+    def remove(self, export_path):
+        """Forgets an exported file."""
+        self._connection.execute('DELETE FROM files WHERE export_path = ?',
+                                 (export_path,))
+
+    def prune(self):
+        """Removes the entries for all files that were not looked up or updated
+           since the manifest was opened."""
+        stale = [(row[0],) for row in self._connection.execute(
+            'SELECT export_path FROM files') if row[0] not in self._seen]
+        if stale:
+            _logger.debug(u'Removing %d stale manifest entries.', len(stale))
+            self._connection.executemany(
+                'DELETE FROM files WHERE export_path = ?', stale)
+
+    def commit(self):
+        """Writes pending updates to the database."""
+        self._connection.commit()
+
+    def close(self):
+        """Commits pending updates and closes the database."""
+        self._connection.commit()
+        self._connection.close()
@@ -0,0 +1,81 @@
+"""This module tests exportmanifest.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import phoshare.exportmanifest as exportmanifest
+
+class ExportManifestTest(unittest.TestCase):
+    """Unit tests for exportmanifest.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = self._write(u'source.jpg', 'source')
+        self.export = self._write(u'export.jpg', 'export data')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, data):
+        path = os.path.join(self.folder, name)
+        output = open(path, 'wb')
+        output.write(data)
+        output.close()
+        return path
+
+    def test_update_lookup(self):
+        """Tests that entries survive reopening the manifest."""
+        mod_date = datetime.datetime(2010, 5, 6, 7, 8, 9, 500000)
+        manifest = exportmanifest.ExportManifest(self.folder)
+        self.assertEquals(None, manifest.lookup(self.export))
+        manifest.update(self.export, self.source, mod_date, 'abc')
+        manifest.close()
+
+        manifest = exportmanifest.ExportManifest(self.folder)
+        entry = manifest.lookup(self.export)
+        self.assertEquals(self.source, entry.source_path)
+        self.assertEquals(exportmanifest.get_timestamp(mod_date),
+                          entry.mod_date)
+        self.assertEquals('abc', entry.fingerprint)
+        self.assertTrue(entry.matches_export(os.stat(self.export)))
+        self.assertTrue(entry.matches_source(os.stat(self.source)))
+        self.assertFalse(entry.matches_export(os.stat(self.source)))
+        manifest.close()
+
+    def test_prune(self):
+        """Tests that entries not seen in a run are removed."""
+        other = self._write(u'other.jpg', 'other')
+        manifest = exportmanifest.ExportManifest(self.folder)
+        manifest.update(self.export, self.source, None, None)
+        manifest.update(other, self.source, None, None)
+        manifest.close()
+
+        manifest = exportmanifest.ExportManifest(self.folder)
+        manifest.lookup(self.export)
+        manifest.prune()
+        manifest.close()
+
+        manifest = exportmanifest.ExportManifest(self.folder)
+        self.assertNotEquals(None, manifest.lookup(self.export))
+        self.assertEquals(None, manifest.lookup(other))
+        manifest.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,11 +15,16 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import collections
+import functools
 import getpass
 import logging
+import multiprocessing.pool
 import os
 import re
+import sqlite3
 import sys
+import threading
 import time
 import unicodedata
 reload(sys)
@@ -29,10 +34,18 @@ from optparse import OptionParser
 from Carbon.File import FSResolveAliasFile
 import MacOS
 
+import appledata.imagetable as imagetable
 import appledata.iphotodata as iphotodata
+import appledata.librarycache as librarycache
 import tilutil.exiftool as exiftool
+import tilutil.jpegmetadata as jpegmetadata
+import tilutil.metadatastamp as metadatastamp
+import tilutil.phash as phash
+import tilutil.xmpsidecar as xmpsidecar
 import tilutil.systemutils as su
 import tilutil.imageutils as imageutils
+import phoshare.duplicates as duplicates
+import phoshare.exportmanifest as exportmanifest
 import phoshare.phoshare_version
 import phoshare.picasaweb as picasaweb
 
@@ -43,6 +56,9 @@ _MAX_FILE_DIFF = 35000
 # Fudge factor for file modification times
 _MTIME_FUDGE = 3
 
+# With --jobs, up to this many files per thread are queued at a time.
+_JOBS_QUEUE_FACTOR = 4
+
 _logger = logging.getLogger('google')
 _logger.setLevel(logging.DEBUG)
 
@@ -83,12 +99,23 @@ def delete_album_file(album_file, albumdirectory, msg, options):
             os.rmdir(album_file)
         else:
             os.remove(album_file)
+            metadatastamp.remove_sidecar(album_file)
         return True
     except OSError, ex:
         print >> sys.stderr, "Could not delete %s: %s" % (su.fsenc(album_file),
                                                           ex)
     return False
 
+def is_iptc_file(file_name):
+    """Tests if Phoshare checks the metadata of a file (name or full path)."""
+    return su.getfileextension(file_name) in ("jpg", "tif", "tiff", "png",
+                                              "nef", "cr2")
+
+def _stamp_file(file_name, fingerprint, success):
+    """Stores the metadata fingerprint of a file after a successful update."""
+    if success and fingerprint:
+        metadatastamp.write_stamp(file_name, fingerprint)
+
 def resolve_alias(path):
     """Resolves a path to point to the real file if it is a file system alias.
     """
@@ -121,6 +148,9 @@ class ExportFile(object):
                 su.getfileextension(photo.originalpath))
         else:
             self.original_export_file = None
+        # ExportFile of an image with the same content, that this file is
+        # linked to (see duplicates.handle_duplicates()).
+        self.link_to = None
 
     def get_photo(self):
         """Gets the associated iPhotoImage."""
@@ -166,14 +196,23 @@ class ExportFile(object):
         #    return True
         return False
 
-    def _generate_original(self, options):
-        """Exports the original file."""
-        do_original_export = False
+    def exports_original(self, options):
+        """Returns True if generate() exports the original file."""
+        return (options.originals and self.photo.originalpath and
+                not self.photo.rotation_is_only_edit)
+
+    def create_original_folder(self, options):
+        """Creates the folder of the original file if it does not exist."""
         export_dir = os.path.split(self.original_export_file)[0]
         if not os.path.exists(export_dir):
             su.pout("Creating folder " + export_dir)
             if not options.dryrun:
                 os.mkdir(export_dir)
+
+    def _generate_original(self, options, iptc_cache=None, write_batch=None):
+        """Exports the original file."""
+        do_original_export = False
+        self.create_original_folder(options)
         original_source_file = resolve_alias(self.photo.originalpath)
         if os.path.exists(self.original_export_file):
             if (os.path.getmtime(self.original_export_file) + _MTIME_FUDGE <
@@ -198,57 +237,233 @@ class ExportFile(object):
 
         do_iptc = (options.iptc == 1 and
                    do_original_export) or options.iptc == 2
-        if do_iptc and options.link:
+        if do_iptc and options.link and not options.sidecar:
             self.check_iptc_data(original_source_file, options,
-                                 is_original=True)
+                                 is_original=True, iptc_cache=iptc_cache,
+                                 write_batch=write_batch)
         exists = True  # True if the file exists or was updated.
         if do_original_export:
+            if iptc_cache and not options.link:
+                iptc_cache.pop(self.original_export_file, None)
+            writer = None
+            if do_iptc and not options.link and not options.sidecar:
+                writer = lambda source, target: self.copy_with_metadata(
+                    source, target, options, is_original=True)
             exists = imageutils.copy_or_link_file(original_source_file,
                                                   self.original_export_file,
                                                   options.dryrun,
                                                   options.link,
                                                   options.size,
-                                                  options.update)
+                                                  options.update,
+                                                  writer)
         else:
             _logger.debug(u'%s up to date.', self.original_export_file)
-        if exists and do_iptc and not options.link:
+        if exists and do_iptc and (options.sidecar or not options.link):
             self.check_iptc_data(self.original_export_file, options,
-                                 is_original=True)
+                                 is_original=True, iptc_cache=iptc_cache,
+                                 write_batch=write_batch)
+
+    def get_iptc_check_files(self, options, include_export=True):
+        """Returns the list of files that generate() will check the metadata of
+           with --iptcall, if they don't need to be exported first.
+
+        Args:
+          options: processing options.
+          include_export: False if the export file is known to be up to date.
+        """
+        check_files = []
+        if not include_export:
+            pass
+        elif options.link:
+            check_files.append(self.photo.image_path)
+        elif self._needs_metadata_check(self.export_file, options):
+            check_files.append(self.export_file)
+        if (options.originals and self.photo.originalpath and
+            not self.photo.rotation_is_only_edit):
+            if options.link:
+                check_files.append(self.photo.originalpath)
+            elif self._needs_metadata_check(self.original_export_file,
+                                            options, is_original=True):
+                check_files.append(self.original_export_file)
+        return [f for f in check_files if is_iptc_file(f)]
+
+    def _needs_metadata_check(self, export_file, options, is_original=False):
+        """Tests if an export file exists, and does not have a metadata stamp
+           that matches the current metadata."""
+        return (os.path.exists(export_file) and
+                metadatastamp.read_stamp(export_file) !=
+                self.get_metadata_fingerprint(options, is_original))
+
+    def get_metadata_fingerprint(self, options, is_original=False):
+        """Returns a digest of the metadata that check_iptc_data() maintains in
+           an export file."""
+        if options.aperture:
+            metadata = None
+        else:
+            gps = None
+            if options.gps and self.photo.gps:
+                gps = self.photo.gps.to_string()
+            metadata = (imageutils.get_photo_caption(self.photo,
+                                                     options.captiontemplate),
+                        self.get_export_keywords(options.face_keywords),
+                        self.photo.date, self.photo.rating, gps)
+        faces = None
+        if options.faces and not is_original:
+            faces = (self.get_photo_rectangles(), list(self.photo.faces))
+        return exportmanifest.get_fingerprint(metadata, faces)
+
+    def is_unchanged(self, options, manifest):
+        """Tests if the export file is up to date according to the export
+           manifest, so that generate() can skip the export and metadata
+           checks. Only stats the export file, and the source file if the
+           library modification date of the image changed.
+        """
+        source_file = self.photo.image_path
+        entry = manifest.lookup(self.export_file)
+        if entry is None or entry.source_path != source_file:
+            return False
+        try:
+            if not entry.matches_export(os.stat(self.export_file)):
+                return False
+            mod_date = exportmanifest.get_timestamp(self.photo.mod_date)
+            if ((mod_date is None or mod_date != entry.mod_date) and
+                not entry.matches_source(os.stat(source_file))):
+                return False
+        except OSError:
+            return False
+        if (options.iptc == 2 and
+            entry.fingerprint != self.get_metadata_fingerprint(options)):
+            return False
+        if (options.iptc == 2 and options.sidecar and
+            not os.path.exists(xmpsidecar.get_sidecar_path(self.export_file))):
+            return False
+        return True
 
-    def generate(self, options):
+    def generate(self, options, iptc_cache=None, manifest=None,
+                 unchanged=False, write_batch=None, path_locks=None):
         """makes sure all files exist in other album, and generates if
-           necessary."""
+           necessary.
+
+        Args:
+          options: processing options.
+          iptc_cache: optional map from file path to prefetched metadata (see
+              exiftool.get_iptc_data_batch()). Entries are consumed.
+          manifest: optional ExportManifest that records the export file.
+          unchanged: True if is_unchanged() found the export file to be up to
+              date.
+          write_batch: optional exiftool.WriteBatch for metadata updates.
+          path_locks: optional _PathLocks. The export holds the lock of the
+              image file, so that exports of the same image on other threads
+              wait for it.
+        """
+        if path_locks:
+            with path_locks.get(self.photo.image_path):
+                self._generate(options, iptc_cache, manifest, unchanged,
+                               write_batch)
+        else:
+            self._generate(options, iptc_cache, manifest, unchanged,
+                           write_batch)
+
+    def _generate(self, options, iptc_cache, manifest, unchanged,
+                  write_batch):
+        """Exports the file, see generate()."""
         source_file = self.photo.image_path
         try:
-            do_export = self._check_need_to_export(source_file, options)
-
-            # if we use links, we update the IPTC data in the original file
-            do_iptc = (options.iptc == 1 and do_export) or options.iptc == 2
-            if do_iptc and options.link:
-                if self.check_iptc_data(source_file, options):
-                    do_export = True
-
-            exists = True  # True if the file exists or was updated.
-            if do_export:
-                exists = imageutils.copy_or_link_file(source_file,
-                                                      self.export_file,
-                                                      options.dryrun,
-                                                      options.link,
-                                                      options.size,
-                                                      options.update)
+            if unchanged:
+                _logger.debug(u'%s up to date (manifest).', self.export_file)
             else:
-                _logger.debug(u'%s up to date.', self.export_file)
-
-            # if we copy, we update the IPTC data in the copied file
-            if exists and do_iptc and not options.link:
-                self.check_iptc_data(self.export_file, options)
+                self._generate_export(source_file, options, iptc_cache,
+                                      manifest, write_batch)
 
-            if (options.originals and self.photo.originalpath and
-                not self.photo.rotation_is_only_edit):
-                self._generate_original(options)
+            if self.exports_original(options):
+                self._generate_original(options, iptc_cache, write_batch)
         except (OSError, MacOS.Error) as ose:
             su.perr("Failed to export %s: %s" % (source_file, ose))
 
+    def generate_link(self, options):
+        """Exports the file as a hard link to the export file of link_to, which
+           must have been generated."""
+        self._link_file(self.link_to.export_file, self.export_file, options)
+        if (options.originals and self.original_export_file and
+            self.link_to.original_export_file and
+            not self.photo.rotation_is_only_edit):
+            self._link_file(self.link_to.original_export_file,
+                            self.original_export_file, options)
+
+    def _link_file(self, target, link, options):
+        try:
+            if os.path.exists(link) and os.path.samefile(target, link):
+                _logger.debug(u'%s up to date (duplicate).', link)
+                return
+            su.pout(u'Linking duplicate %s to %s.' % (link, target))
+            if options.dryrun:
+                return
+            export_dir = os.path.dirname(link)
+            if not os.path.exists(export_dir):
+                os.makedirs(export_dir)
+            if os.path.exists(link):
+                os.remove(link)
+            os.link(target, link)
+        except OSError, ose:
+            su.perr(u'Failed to link %s to %s: %s' % (link, target, ose))
+
+    def _generate_export(self, source_file, options, iptc_cache, manifest,
+                         write_batch):
+        """Exports the image file, and checks its metadata."""
+        do_export = self._check_need_to_export(source_file, options)
+
+        # if we use links, we update the IPTC data in the original file
+        do_iptc = (options.iptc == 1 and do_export) or options.iptc == 2
+        # Results of the metadata checks, see check_iptc_data().
+        checked = []
+        if do_iptc and options.link and not options.sidecar:
+            if self.check_iptc_data(source_file, options,
+                                    iptc_cache=iptc_cache,
+                                    write_batch=write_batch,
+                                    callback=checked.append):
+                do_export = True
+
+        exists = True  # True if the file exists or was updated.
+        if do_export:
+            if iptc_cache and not options.link:
+                iptc_cache.pop(self.export_file, None)
+            writer = None
+            if do_iptc and not options.link and not options.sidecar:
+                writer = lambda source, target: self.copy_with_metadata(
+                    source, target, options)
+            exists = imageutils.copy_or_link_file(source_file,
+                                                  self.export_file,
+                                                  options.dryrun,
+                                                  options.link,
+                                                  options.size,
+                                                  options.update,
+                                                  writer)
+        else:
+            _logger.debug(u'%s up to date.', self.export_file)
+
+        # if we copy, we update the IPTC data in the copied file. Sidecar files
+        # are always next to the export file.
+        if exists and do_iptc and (options.sidecar or not options.link):
+            self.check_iptc_data(self.export_file, options,
+                                 iptc_cache=iptc_cache,
+                                 write_batch=write_batch,
+                                 callback=checked.append)
+
+        if manifest and exists and not options.dryrun:
+            def record():
+                # Only claim the metadata is current if we checked it, and
+                # all updates succeeded, so that failed updates are retried.
+                fingerprint = None
+                if do_iptc and checked and all(checked):
+                    fingerprint = self.get_metadata_fingerprint(options)
+                manifest.update(self.export_file, source_file,
+                                self.photo.mod_date, fingerprint)
+            if write_batch:
+                # Record the file after its metadata has been written.
+                write_batch.call_after(record)
+            else:
+                record()
+
     def get_photo_rectangles(self):
         """Gets a list of photo rectangles for the faces in this image."""
         photo_rectangles = self.photo.face_rectangles
@@ -264,7 +479,7 @@ class ExportFile(object):
 
     def get_export_keywords(self, do_face_keywords):
         """Returns the list of keywords that should be in the exported image."""
-        new_keywords = self.photo.keywords[:]
+        new_keywords = list(self.photo.keywords)
         if do_face_keywords:
             for keyword in self.photo.getfaces():
                 if not keyword in new_keywords:
@@ -272,9 +487,10 @@ class ExportFile(object):
         return new_keywords
 
     def _check_person_iptc_data(self, export_file,
-                                region_rectangles, region_names, do_faces):
+                                region_rectangles, region_names, do_faces,
+                                messages):
         """Tests if the person names or regions in the export file need to be
-           updated.
+           updated. Reasons for updates are appended to messages.
 
         Returns: (new_rectangles, new_persons), or (None, None)
         """
@@ -287,39 +503,47 @@ class ExportFile(object):
         combined_region_names = ','.join(region_names)
         combined_photo_faces = ','.join(photo_faces)
         if combined_region_names != combined_photo_faces:
-            su.pout('Updating IPTC for %s because of persons (%s instead of %s)'
-                    % (export_file, combined_region_names,
-                       combined_photo_faces))
+            messages.append('Updating IPTC for %s because of persons (%s '
+                            'instead of %s)' % (export_file,
+                                                combined_region_names,
+                                                combined_photo_faces))
             return (photo_rectangles, photo_faces)
 
         if len(region_rectangles) != len(photo_rectangles):
-            su.pout('Updating IPTC for %s because of number of regions '
-                    '(%d vs %d)' %
-                    (export_file, len(region_rectangles),
-                     len(photo_rectangles)))
+            messages.append('Updating IPTC for %s because of number of '
+                            'regions (%d vs %d)' %
+                            (export_file, len(region_rectangles),
+                             len(photo_rectangles)))
             return (photo_rectangles, photo_faces)
 
         for p in xrange(len(region_rectangles)):
             if not region_matches(region_rectangles[p], photo_rectangles[p]):
-                su.pout('Updating IPTC for %s because of region for %s '
-                        '(%s vs %s)' %
-                        (export_file, region_names[p],
-                         ','.join(str(c) for c in region_rectangles[p]),
-                         ','.join(str(c) for c in photo_rectangles[p])))
+                messages.append(
+                    'Updating IPTC for %s because of region for %s (%s vs %s)' %
+                    (export_file, region_names[p],
+                     ','.join(str(c) for c in region_rectangles[p]),
+                     ','.join(str(c) for c in photo_rectangles[p])))
                 return (photo_rectangles, photo_faces)
 
         return (None, None)
     
-    def check_iptc_data(self, export_file, options, is_original=False):
-        """Tests if a file has the proper keywords and caption in the meta
-           data."""
-        if not su.getfileextension(export_file) in ("jpg", "tif", "tiff",
-                                                    "png", "nef", "cr2"):
-            return False
+    def get_metadata_updates(self, export_file, iptc_data, options,
+                             is_original, messages):
+        """Compares the metadata of a file with the iPhoto data.
 
+        Args:
+          export_file: path of the file, used in messages.
+          iptc_data: metadata tuple of the file, as returned by
+              exiftool.get_iptc_data().
+          options: processing options.
+          is_original: True if the file is an original image.
+          messages: list that collects the reasons for updates.
+        Returns:
+          Arguments for exiftool.update_iptcdata() after the file path, or None
+          if the file is up to date.
+        """
         (file_keywords, file_caption, date_time_original, rating, gps,
-         region_rectangles, region_names) = exiftool.get_iptc_data(
-            export_file)
+         region_rectangles, region_names) = iptc_data
         if options.aperture:
             # Aperture maintains all these metadata in the preview files, and
             # does not even save all the information into the .xml file. 
@@ -332,31 +556,34 @@ class ExportFile(object):
             new_caption = imageutils.get_photo_caption(self.photo,
                                                        options.captiontemplate)
             if not su.equalscontent(file_caption, new_caption):
-                su.pout('Updating IPTC for %s because it has Caption "%s" '
-                        'instead of "%s".' % (export_file, file_caption,
-                                              new_caption))
+                messages.append('Updating IPTC for %s because it has Caption '
+                                '"%s" instead of "%s".' % (
+                                    export_file, file_caption, new_caption))
             else:
                 new_caption = None
 
             new_keywords = self.get_export_keywords(options.face_keywords)
             if not imageutils.compare_keywords(new_keywords, file_keywords):
-                su.pout("Updating IPTC for %s because of keywords (%s instead "
-                        "of %s)" % (export_file, ",".join(file_keywords),
-                                 ",".join(new_keywords)))
+                messages.append("Updating IPTC for %s because of keywords (%s "
+                                "instead of %s)" % (
+                                    export_file, ",".join(file_keywords),
+                                    ",".join(new_keywords)))
             else:
                 new_keywords = None
 
             new_date = None
             if self.photo.date and date_time_original != self.photo.date:
-                su.pout("Updating IPTC for %s because of date (%s instead of "
-                        "%s)" %
-                        (export_file, date_time_original, self.photo.date))
+                messages.append("Updating IPTC for %s because of date (%s "
+                                "instead of %s)" % (
+                                    export_file, date_time_original,
+                                    self.photo.date))
                 new_date = self.photo.date
 
             new_rating = -1
             if self.photo.rating != None and rating != self.photo.rating:
-                su.pout("Updating IPTC for %s because of rating (%d instead of "
-                        "%d)" % (export_file, rating, self.photo.rating))
+                messages.append("Updating IPTC for %s because of rating (%d "
+                                "instead of %d)" % (export_file, rating,
+                                                    self.photo.rating))
                 new_rating = self.photo.rating
 
             new_gps = None
@@ -366,9 +593,10 @@ class ExportFile(object):
                         old_gps = gps
                     else:
                         old_gps = imageutils.GpsLocation()
-                    su.pout("Updating IPTC for %s because of GPS %s vs %s" %
-                            (export_file, old_gps.to_string(),
-                             self.photo.gps.to_string()))
+                    messages.append(
+                        "Updating IPTC for %s because of GPS %s vs %s" %
+                        (export_file, old_gps.to_string(),
+                         self.photo.gps.to_string()))
                     new_gps = self.photo.gps
 
         # Don't export the faces into the original file (could have been
@@ -379,16 +607,129 @@ class ExportFile(object):
 
         if (new_caption != None or new_keywords != None or new_date or
             new_gps or new_rating != -1 or new_rectangles or new_persons):
+            return (new_caption, new_keywords, new_date, new_rating, new_gps,
+                    new_rectangles, new_persons)
+        return None
+
+    def check_iptc_data(self, export_file, options, is_original=False,
+                        iptc_cache=None, write_batch=None, callback=None):
+        """Tests if a file has the proper keywords and caption in the meta
+           data. Updates are queued in write_batch if it is set.
+
+        Args:
+          callback: optional function that is called with True once the
+              metadata of the file is current, or with False if updating it
+              failed. Not called with --dryrun.
+        """
+        if not callback:
+            callback = lambda success: None
+        if not is_iptc_file(export_file):
             if not options.dryrun:
-                exiftool.update_iptcdata(export_file, new_caption, new_keywords,
-                                         new_date, new_rating, new_gps,
-                                         new_rectangles, new_persons)
-            return True
-        return False
+                callback(True)
+            return False
+        if options.sidecar:
+            return self._check_sidecar_data(export_file, options, is_original,
+                                            callback)
+
+        # Files in the export folder remember the metadata we last wrote, so
+        # that we don't have to read it again.
+        fingerprint = None
+        if not options.link:
+            fingerprint = self.get_metadata_fingerprint(options, is_original)
+            if metadatastamp.read_stamp(export_file) == fingerprint:
+                if iptc_cache:
+                    iptc_cache.pop(export_file, None)
+                if not options.dryrun:
+                    callback(True)
+                return False
+
+        iptc_data = None
+        if iptc_cache:
+            iptc_data = iptc_cache.pop(export_file, None)
+        if iptc_data is None:
+            iptc_data = exiftool.get_iptc_data(export_file)
+        messages = []
+        updates = self.get_metadata_updates(export_file, iptc_data, options,
+                                            is_original, messages)
+        for message in messages:
+            su.pout(message)
+        if options.dryrun:
+            return updates is not None
+
+        def updated(success):
+            _stamp_file(export_file, fingerprint, success)
+            callback(success)
+        if updates and write_batch:
+            write_batch.add(export_file, *updates, callback=updated)
+        elif updates:
+            updated(exiftool.update_iptcdata(export_file, *updates))
+        else:
+            updated(True)
+        return updates is not None
+
+    def _check_sidecar_data(self, export_file, options, is_original,
+                            callback):
+        """Tests if the XMP sidecar file of an export file has the proper
+           metadata, and updates it if necessary."""
+        iptc_data = xmpsidecar.read_sidecar(export_file)
+        if iptc_data is None:
+            su.pout(u'Replacing unreadable sidecar file %s.' % (
+                xmpsidecar.get_sidecar_path(export_file)))
+            iptc_data = ([], None, None, 0, None, [], [])
+        messages = []
+        updates = self.get_metadata_updates(export_file, iptc_data, options,
+                                            is_original, messages)
+        for message in messages:
+            su.pout(message)
+        if updates is None:
+            if not options.dryrun:
+                callback(True)
+            return False
+        if not options.dryrun:
+            try:
+                xmpsidecar.update_sidecar(export_file, iptc_data, *updates)
+            except EnvironmentError, ex:
+                su.perr(u'Failed to write sidecar file for %s: %s' % (
+                    export_file, ex))
+                callback(False)
+            else:
+                callback(True)
+        return True
+
+    def copy_with_metadata(self, source_file, target_file, options,
+                           is_original=False):
+        """Writes a JPEG copy of an image that has the proper metadata, reading
+           the source file only once.
+
+        Returns:
+          True if the copy was written, False if the file needs to be copied
+          and updated separately.
+        """
+        if not jpegmetadata.is_jpeg_file(source_file):
+            return False
+        iptc_data = jpegmetadata.read_iptc_data(source_file)
+        if iptc_data is None:
+            return False
+        messages = []
+        updates = self.get_metadata_updates(target_file, iptc_data, options,
+                                            is_original, messages)
+        if updates is None:
+            return False
+        try:
+            jpegmetadata.write_metadata(source_file, target_file, *updates)
+        except jpegmetadata.MalformedError, ex:
+            _logger.debug(u'Cannot copy %s with metadata: %s', source_file, ex)
+            return False
+        for message in messages:
+            su.pout(message)
+        metadatastamp.write_stamp(target_file, self.get_metadata_fingerprint(
+            options, is_original))
+        return True
 
     def is_part_of(self, file_name):
         """Checks if <file> is part of this image."""
-        return self.export_file == file_name
+        return (self.export_file == file_name or
+                xmpsidecar.is_sidecar_of(file_name, self.export_file))
 
 _YEAR_PATTERN_INDEX = re.compile(r'([0-9][0-9][0-9][0-9]) (.*)')
 
@@ -505,17 +846,105 @@ class ExportDirectory(object):
 
             # everything else must have a master, or will have to go
             if (not master_file or
-                originalfile != master_file.original_export_file or
+                (originalfile != master_file.original_export_file and
+                 not xmpsidecar.is_sidecar_of(
+                     originalfile, master_file.original_export_file)) or
                 master_file.photo.rotation_is_only_edit):
                 delete_album_file(originalfile, originalfile,
                                   "Obsolete Original", options)
 
-    def generate_files(self, options):
-        """Generates the files in the export location."""
+    def _prefetch_iptc_data(self, options, unchanged):
+        """Reads the metadata of all files in this folder that --iptcall will
+           check with a single exiftool call.
+
+        Args:
+            unchanged: set of the files that are known to be up to date.
+        Returns:
+            Map from file path to metadata, or None.
+        """
+        if options.iptc != 2 or options.sidecar:
+            return None
+        check_files = []
+        for f in sorted(self.files):
+            if self.files[f].link_to:
+                continue
+            check_files.extend(self.files[f].get_iptc_check_files(
+                options, not f in unchanged))
+        if len(check_files) < 2:
+            return None
+        return exiftool.get_iptc_data_batch(check_files)
+
+    def get_file_tasks(self, options, manifest=None, updates=None,
+                       path_locks=None):
+        """Prepares the export of the files in this folder: creates the
+        folders, and finds the files that are up to date.
+
+        Args:
+          options: processing options.
+          manifest: optional ExportManifest of the export folder.
+          updates: optional object that the tasks record manifest updates
+              in, instead of manifest.
+          path_locks: optional _PathLocks for tasks that run in parallel.
+        Returns:
+          (tasks, write_batch) tuple. tasks is a list of functions that each
+          generate one file, in file order. write_batch is the
+          exiftool.WriteBatch that must be flushed after all tasks ran, or
+          None.
+        """
         if not os.path.exists(self.albumdirectory) and not options.dryrun:
             os.makedirs(self.albumdirectory)
+        unchanged = set()
+        if manifest:
+            for f in self.files:
+                if (not self.files[f].link_to and
+                    self.files[f].is_unchanged(options, manifest)):
+                    unchanged.add(f)
+        iptc_cache = self._prefetch_iptc_data(options, unchanged)
+        write_batch = None
+        # With --link, the library file is updated before it is linked.
+        # exiftool replaces the file, so a deferred update would not reach a
+        # link that is made before the batch is flushed.
+        if options.iptc > 0 and not options.dryrun and not options.link:
+            write_batch = exiftool.WriteBatch()
+        if updates is None:
+            updates = manifest
+        tasks = []
+        for f in sorted(self.files):
+            export_file = self.files[f]
+            # Links to duplicates are made after all folders are done.
+            if export_file.link_to:
+                continue
+            if export_file.exports_original(options):
+                # Created here, so that parallel tasks (--jobs) don't race to
+                # create it. If this fails, generate() reports the error.
+                try:
+                    export_file.create_original_folder(options)
+                except OSError:
+                    pass
+            tasks.append(functools.partial(export_file.generate, options,
+                                           iptc_cache, updates,
+                                           f in unchanged, write_batch,
+                                           path_locks))
+        return tasks, write_batch
+
+    def generate_files(self, options, manifest=None):
+        """Generates the files in the export location.
+
+        Args:
+          options: processing options.
+          manifest: optional ExportManifest of the export folder.
+        """
+        tasks, write_batch = self.get_file_tasks(options, manifest)
+        for task in tasks:
+            task()
+        if write_batch:
+            write_batch.flush()
+
+    def generate_links(self, options):
+        """Links the files of duplicate images to their first export."""
         for f in sorted(self.files):
-            self.files[f].generate(options)
+            if self.files[f].link_to:
+                self.files[f].generate_link(options)
 
 
 class IPhotoFace(iphotodata.IPhotoContainer):
@@ -567,51 +996,20 @@ class ExportLibrary(object):
            (directories)."""
         entries = 0
 
-        include_pattern = re.compile(su.unicode_string(includes))
-        exclude_pattern = None
-        if excludes:
-            exclude_pattern = re.compile(su.unicode_string(excludes))
-
-        # first, do the sub-albums
-        for sub_album in albums:
+        for sub_album, album_prefix in iphotodata.find_albums(
+                albums, album_types, includes, excludes, folder_prefix,
+                matched):
             if self._check_abort():
-                return
-            sub_name = sub_album.name
-            if not sub_name:
+                return entries
+            if not sub_album.name:
                 print "Found an album with no name: " + sub_album.albumid
-                sub_name = "xxx"
-
-            # check the album type
-            if sub_album.albumtype == "Folder" or sub_album.albums:
-                sub_matched = matched
-                if include_pattern.match(sub_name):
-                    sub_matched = True
-                new_name = folder_prefix
-                if sub_album.albumtype == "Folder":
-                    new_name += imageutils.make_foldername(sub_name) + "/"
-                self.process_albums(sub_album.albums, album_types, new_name,
-                                    includes, excludes, options, sub_matched)
-                continue
-            elif (sub_album.albumtype == "None" or
-                  not sub_album.albumtype in album_types):
-                # print "Ignoring " + sub_album.name + " of type " + \
-                # sub_album.albumtype
-                continue
-
-            if not matched and not include_pattern.match(sub_name):
-                _logger.debug(u'Skipping "%s" because it does not match pattern.', sub_name)
-                continue
 
-            if exclude_pattern and exclude_pattern.match(sub_name):
-                _logger.debug(u'Skipping "%s" because it is excluded.', sub_name)
-                continue
-
-            _logger.debug(u'Loading "%s".', sub_name)
+            _logger.debug(u'Loading "%s".', sub_album.name)
 
             folder_hint = None
             if options.folderhints:
                 folder_hint = sub_album.getfolderhint()
-            prefix = folder_prefix
+            prefix = album_prefix
             if folder_hint is not None:
                 prefix = prefix + imageutils.make_foldername(folder_hint) + "/"
             formatted_name = imageutils.format_album_name(
@@ -619,12 +1017,6 @@ class ExportLibrary(object):
             sub_name = prefix + imageutils.make_foldername(formatted_name)
             sub_name = self._find_unused_folder(sub_name)
 
-            # first, do the sub-albums
-            if self.process_albums(sub_album.albums, album_types, folder_prefix,
-                                  includes, excludes, options, matched) > 0:
-                entries += 1
-
-            # now the album itself
             picture_directory = ExportDirectory(
                 sub_name, sub_album,
                 os.path.join(self.albumdirectory, sub_name))
@@ -684,14 +1076,198 @@ class ExportLibrary(object):
 
         return contains_albums
 
+    def check_duplicates(self, options, hash_cache):
+        """Skips, links or reports the images that have the same content as
+           an image that is exported before them (see --duplicates)."""
+        duplicates.handle_duplicates(self.named_folders, options.duplicates,
+                                     hash_cache)
+
+    def check_similar(self, options, phash_cache):
+        """Reports the images that look alike, or leaves out the images
+           that look like a better rated image (see --similar)."""
+        duplicates.handle_similar(self.named_folders, options.similar,
+                                  phash_cache, options.similar_distance)
+
+    def _open_manifest(self, options):
+        """Opens the export manifest if it is enabled, or returns None."""
+        if not options.manifest or options.dryrun:
+            return None
+        try:
+            return exportmanifest.ExportManifest(self.albumdirectory)
+        except sqlite3.Error, ex:
+            su.perr(u'Cannot open export manifest in %s: %s' % (
+                self.albumdirectory, ex))
+            return None
+
     def generate_files(self, options):
         """Walks through the export tree and sync the files."""
         if not os.path.exists(self.albumdirectory) and not options.dryrun:
             os.makedirs(self.albumdirectory)
-        for ndir in sorted(self.named_folders):
-            if self._check_abort():
-                break
-            self.named_folders[ndir].generate_files(options)
+        manifest = self._open_manifest(options)
+        try:
+            if options.jobs > 1:
+                completed = self._generate_files_parallel(options, manifest)
+            else:
+                completed = True
+                for ndir in sorted(self.named_folders):
+                    if self._check_abort():
+                        completed = False
+                        break
+                    self.named_folders[ndir].generate_files(options, manifest)
+                    if manifest:
+                        manifest.commit()
+            if completed:
+                for ndir in sorted(self.named_folders):
+                    self.named_folders[ndir].generate_links(options)
+            if manifest and completed:
+                manifest.prune()
+        finally:
+            if manifest:
+                manifest.close()
+
+    def _generate_files_parallel(self, options, manifest):
+        """Generates the files of all folders with options.jobs threads.
+
+        Folders are prepared in order on this thread, and their files are
+        queued for the threads as one list, so that threads that are done
+        with the files of one folder continue with the next folder. The
+        messages of each file are printed in file order, and folders are
+        finished (metadata updates flushed and manifest committed) in order.
+
+        Returns:
+          True if the export completed, False if it was aborted.
+        """
+        pool = multiprocessing.pool.ThreadPool(options.jobs)
+        pending = collections.deque()  # (folder state, result) in file order
+        folder_states = []  # [write_batch, updates, unfinished tasks]
+        max_pending = options.jobs * _JOBS_QUEUE_FACTOR
+        path_locks = None
+        if options.link and options.iptc > 0:
+            # The metadata is updated in the library files. An image in two
+            # albums must not be updated (and linked) by two threads at once.
+            path_locks = _PathLocks()
+
+        def run_task(task):
+            if self._abort:
+                return []
+            su.start_capture()
+            try:
+                task()
+            finally:
+                messages = su.end_capture()
+            return messages
+
+        def finish_folders():
+            """Finishes the folders at the front whose files are all done."""
+            while folder_states and folder_states[0][2] == 0:
+                write_batch, updates, _ = folder_states.pop(0)
+                if write_batch:
+                    write_batch.flush()
+                if manifest:
+                    updates.apply(manifest)
+                    manifest.commit()
+
+        def finish_next():
+            """Waits for the oldest queued file, and prints its messages."""
+            state, result = pending.popleft()
+            su.write_captured(result.get())
+            state[2] -= 1
+            finish_folders()
+
+        completed = True
+        try:
+            for ndir in sorted(self.named_folders):
+                if self._check_abort():
+                    completed = False
+                    break
+                updates = None
+                if manifest:
+                    updates = _ManifestUpdates()
+                tasks, write_batch = self.named_folders[ndir].get_file_tasks(
+                    options, manifest, updates, path_locks)
+                state = [write_batch, updates, len(tasks)]
+                folder_states.append(state)
+                finish_folders()
+                for task in tasks:
+                    pending.append((state, pool.apply_async(run_task,
+                                                            (task,))))
+                    while len(pending) > max_pending:
+                        finish_next()
+            while pending:
+                finish_next()
+            if completed and self._check_abort():
+                completed = False
+        finally:
+            pool.close()
+            pool.join()
+        return completed
+
+
+class _PathLocks(object):
+    """A lock for each file path, for threads that write to the same files."""
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Returns the lock of a path."""
+        with self._lock:
+            lock = self._locks.get(path)
+            if lock is None:
+                lock = self._locks[path] = threading.Lock()
+            return lock
+
+
+class _ManifestUpdates(object):
+    """Collects the manifest updates of export threads, so that they can be
+    applied by the thread that owns the manifest database."""
+
+    def __init__(self):
+        self._updates = []
+        self._lock = threading.Lock()
+
+    def update(self, *args):
+        """Records a call to ExportManifest.update()."""
+        with self._lock:
+            self._updates.append(args)
+
+    def apply(self, manifest):
+        """Makes the recorded updates in manifest."""
+        with self._lock:
+            updates, self._updates = self._updates, []
+        for args in updates:
+            try:
+                manifest.update(*args)
+            except OSError, ose:
+                su.perr(u'Failed to record %s in the export manifest: %s' % (
+                    args[0], ose))
+
+
+def get_image_selection(options):
+    """Returns an ImageSelection for the albums that export_iphoto() will
+       process, or None if all images are needed."""
+    if (options.facealbums or options.locationalbums or
+        options.checkalbumsize or options.monthreport):
+        return None
+    def album_filter(root_album):
+        """Returns the albums and events selected by the options."""
+        found = []
+        if options.events:
+            found.extend(iphotodata.find_albums(root_album.albums, ["Event"],
+                                                options.events,
+                                                options.exclude))
+        if options.albums:
+            found.extend(iphotodata.find_albums(root_album.albums,
+                                                ["Regular", "Published"],
+                                                options.albums,
+                                                options.exclude))
+        if options.smarts:
+            found.extend(iphotodata.find_albums(root_album.albums, ["Smart"],
+                                                options.smarts,
+                                                options.exclude))
+        return [album for album, _prefix in found]
+    return iphotodata.ImageSelection(album_filter)
 
 
 def export_iphoto(library, data, excludes, options):
@@ -717,11 +1293,41 @@ def export_iphoto(library, data, excludes, options):
                                unicode(options.facealbum_prefix),
                                ".", excludes, options)
 
+    if options.locationalbums:
+        library.process_albums(
+            data.getlocationalbums(options.locationalbum_radius),
+            ["Location"], unicode(options.locationalbum_prefix), ".",
+            excludes, options)
+
+    if options.duplicates:
+        print "Checking for duplicate images..."
+        hash_cache = duplicates.get_hash_cache(
+            su.expand_home_folder(librarycache.DEFAULT_CACHE_FOLDER),
+            options.hash_workers)
+        try:
+            library.check_duplicates(options, hash_cache)
+        finally:
+            hash_cache.close()
+
+    if options.similar:
+        print "Checking for similar images..."
+        phash_cache = duplicates.get_phash_cache(
+            su.expand_home_folder(librarycache.DEFAULT_CACHE_FOLDER))
+        try:
+            library.check_similar(options, phash_cache)
+        finally:
+            phash_cache.close()
+
     print "Scanning existing files in export folder..."
     library.load_album(options)
 
     print "Exporting photos from iPhoto to export folder..."
-    library.generate_files(options)
+    if options.iptc > 0:
+        exiftool.start_pool(options.exiftool_workers)
+    try:
+        library.generate_files(options)
+    finally:
+        exiftool.stop_pool()
 
 USAGE = """usage: %prog [options]
 Exports images and movies from an iPhoto library into a folder.
@@ -750,6 +1356,13 @@ def get_option_parser():
         "--dryrun", action="store_true",
         help="""Show what would have been done, but don't change or copy any
              files.""")
+    p.add_option("--duplicates", type="choice", choices=duplicates.MODES,
+                 help="""Find images with the same content as an image that
+                 is exported before them, by comparing content hashes
+                 (cached in %s). "skip" leaves them out, "link" exports them
+                 as hard links to the first copy (like "skip" with
+                 --picasaweb), and "report" lists them.""" % (
+                     librarycache.DEFAULT_CACHE_FOLDER))
     p.add_option("-e", "--events",
                  help="""Export matching events. The argument is
                  a regular expression. Use -e . to export all events.""")
@@ -759,6 +1372,10 @@ def get_option_parser():
                       export set will be deleted, and files that match will be
                       overwritten if the iPhoto version of the file is
                       different. d""")
+    p.add_option("--exiftool_workers", type='int', default=1,
+                 help="""Number of persistent exiftool processes to use for
+                 reading and updating metadata. Use 0 to launch a new exiftool
+                 process for every file. Default: 1.""")
     p.add_option("--facealbums", action='store_true',
                  help="Create albums (folders) for faces")
     p.add_option("--facealbum_prefix", default="",
@@ -777,6 +1394,9 @@ def get_option_parser():
                  help="""Pattern for folders to ignore in the export folder (use
                       with --delete if you have extra folders folders that you 
                       don't want iphoto_export to delete.""")
+    p.add_option("--hash_workers", type='int', default=2,
+                 help="""Number of threads for computing content hashes
+                 (use with --duplicates). Default: 2.""")
     p.add_option("--iphoto",
                  help="""Path to iPhoto library, e.g.
                  "%s/Pictures/iPhoto Library".""",
@@ -791,16 +1411,44 @@ def get_option_parser():
         help="""Check the IPTC data of all files. Checks for
         keywords and descriptions. Requires the program "exiftool" (see
         http://www.sno.phy.queensu.ca/~phil/exiftool/).""")
+    p.add_option("--jobs", type='int', default=1,
+                 help="""Number of threads that export files at the same time.
+                 Messages are still printed in file order. Default: 1.""")
     p.add_option(
       "-l", "--link", action="store_true",
       help="""Use links instead of copying files. Use with care, as changes made
       to the exported files might affect the image that is stored in the iPhoto
       library.""")
+    p.add_option("--locationalbums", action='store_true',
+                 help="""Create albums (folders) for places, with the images
+                 taken near each other.""")
+    p.add_option("--locationalbum_prefix", default="",
+                 help='Prefix for place folders (use with --locationalbums)')
+    p.add_option("--locationalbum_radius", type='float', default=5.0,
+                 help="""Distance in km from the first image of a place
+                 folder to the other images in it (use with
+                 --locationalbums). Default: 5.""")
+    p.add_option("--manifest", action="store_true",
+                 help="""Keep a database of the exported files in the export
+                 folder, and skip the checks for files that have not changed
+                 since the last export.""")
+    p.add_option("--monthreport", action="store_true",
+                 help="""List the number of images and their total size for
+                 each month. Use --pictures to leave out movies. Requires
+                 NumPy.""")
+    p.add_option("--no-library-cache", action="store_false",
+                 dest="library_cache", default=True,
+                 help="""Always parse the iPhoto library, instead of reusing a
+                 snapshot from an earlier run (kept in %s).""" % (
+                     librarycache.DEFAULT_CACHE_FOLDER))
     p.add_option(
       "-n", "--nametemplate", default="{title}",
       help="""Template for naming image files. Default: "{title}".""")
     p.add_option("-o", "--originals", action="store_true",
                       help="Export original files into Originals.")
+    p.add_option("--parse_workers", type='int', default=1,
+                 help="""Number of processes to use for reading the image list
+                 of the iPhoto library. Default: 1.""")
     p.add_option("--picasa", action="store_true",
                       help="Store originals in .picasaoriginals")
     p.add_option('--picasapassword',  
@@ -810,9 +1458,25 @@ def get_option_parser():
     p.add_option("--pictures", action="store_false", dest="movies",
                  default=True,
                  help="Export pictures only (no movies).")
+    p.add_option("--sidecar", action="store_true",
+                 help="""Write metadata into XMP sidecar files (.xmp) next to
+                 the exported images, instead of updating the images. Use with
+                 -k or -K.""")
     p.add_option(
       "--size", type='int', help="""Resize images so that neither width or
       height exceeds this size. Converts all images to jpeg.""")
+    p.add_option("--similar", type="choice",
+                 choices=duplicates.SIMILAR_MODES,
+                 help="""Find groups of images that look alike (for example
+                 edited copies or bursts), by comparing perceptual hashes of
+                 the thumbnails (cached in %s). Each group has the best
+                 rated image, and the images within --similar_distance of it.
+                 "best" leaves the other images out of the folders that have
+                 the best image, "report" lists the groups. Requires
+                 NumPy.""" % (librarycache.DEFAULT_CACHE_FOLDER))
+    p.add_option("--similar_distance", type='int', default=6,
+                 help="""Number of the 64 hash bits that may differ between
+                 similar images (use with --similar). Default: 6.""")
     p.add_option(
         "-s", "--smarts",
         help="""Export matching smart albums. The argument
@@ -868,13 +1532,19 @@ def main():
         parser.error("Need to specify the iPhoto library with the --iphoto "
                      "option.")
 
+    if options.monthreport and not imagetable.numpy:
+        parser.error("--monthreport requires NumPy.")
+
+    if options.similar and not phash.numpy:
+        parser.error("--similar requires NumPy.")
+
     if options.export or options.picasaweb or options.checkalbumsize:
         if not (options.albums or options.events or options.smarts or
-                options.facealbums):
+                options.facealbums or options.locationalbums):
             parser.error("Need to specify at least one event, album, or smart "
                          "album for exporting, using the -e, -a, or -s "
                          "options.")
-    else:
+    elif not options.monthreport:
         parser.error("No action specified. Use --export to export from your "
                      "iPhoto library.")
 
@@ -885,13 +1555,20 @@ def main():
             google_password = getpass.getpass('Google password for %s: ' %
                                               options.picasaweb)
 
-    logging_handler = logging.StreamHandler()
+    logging_handler = su.CapturingStreamHandler()
     logging_handler.setLevel(logging.DEBUG if options.verbose else logging.INFO)
     _logger.addHandler(logging_handler)
 
     album_xml_file = iphotodata.get_album_xmlfile(
         su.expand_home_folder(options.iphoto))
-    data = iphotodata.get_iphoto_data(album_xml_file)
+    cache = None
+    if options.library_cache:
+        cache = librarycache.LibraryCache(
+            su.expand_home_folder(librarycache.DEFAULT_CACHE_FOLDER),
+            phoshare.phoshare_version.PHOSHARE_VERSION)
+    data = iphotodata.get_iphoto_data(album_xml_file, cache,
+                                      options.parse_workers,
+                                      get_image_selection(options))
     if data.aperture:
         if options.originals:
             data.load_aperture_originals()
@@ -905,6 +1582,9 @@ def main():
     if options.checkalbumsize:
         data.checkalbumsizes(int(options.checkalbumsize))
 
+    if options.monthreport:
+        data.reportbymonth(options.movies)
+
     if options.export:
         album = ExportLibrary(su.expand_home_folder(options.export))
         export_iphoto(album, data, options.exclude, options)
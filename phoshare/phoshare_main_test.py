@@ -14,9 +14,33 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import logging
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
 import unittest
 
 import phoshare.phoshare_main as pm
+import tilutil.systemutils as su
+
+class _Photo(object):
+    """Stands in for an IPhotoImage. Reading image_path takes delay
+       seconds, to make a file take longer to export than the next files."""
+
+    def __init__(self, image_path, delay=0):
+        self._image_path = image_path
+        self.delay = delay
+        self.originalpath = None
+        self.rotation_is_only_edit = False
+        self.mod_date = None
+
+    @property
+    def image_path(self):
+        time.sleep(self.delay)
+        return self._image_path
 
 class PhoshareMainTest(unittest.TestCase):
     """Unit tests for phoshare_main.py code."""
@@ -44,5 +68,59 @@ class PhoshareMainTest(unittest.TestCase):
         self.assertEquals("/usr", pm.resolve_alias("/usr"))
         self.assertEquals("/private/tmp", pm.resolve_alias("/tmp"))
 
+    def test_generate_files_jobs(self):
+        """Tests that the messages of --jobs exports are printed in file
+           order, with the log records of each file."""
+        tmp_dir = tempfile.mkdtemp()
+        saved_stdout = sys.stdout
+        output = StringIO.StringIO()
+        handler = su.CapturingStreamHandler(output)
+        handler.setLevel(logging.INFO)
+        pm._logger.addHandler(handler)
+        try:
+            options, _ = pm.get_option_parser().parse_args(
+                ['--jobs', '2', '--update'])
+            options.aperture = False
+            export_dir = os.path.join(tmp_dir, 'export')
+            library = pm.ExportLibrary(export_dir)
+            expected = []
+            for name in ('A', 'B'):
+                folder = pm.ExportDirectory(name, None,
+                                            os.path.join(export_dir, name))
+                for i in range(2):
+                    source = os.path.join(tmp_dir, '%s%d.jpg' % (name, i))
+                    data = open(source, 'wb')
+                    data.write('x' * 40000)
+                    data.close()
+                    # The first file is slow, and needs an update.
+                    photo = _Photo(source, name == 'A' and i == 0 and 0.2)
+                    export_file = pm.ExportFile(photo, folder.albumdirectory,
+                                                str(i), options)
+                    folder.files[str(i)] = export_file
+                    target = export_file.export_file
+                    if photo.delay:
+                        os.makedirs(folder.albumdirectory)
+                        open(target, 'wb').write('x')
+                        expected.append('Changed:  %s: file size: 1 vs. '
+                                        '40000' % (target))
+                        expected.append('Updating: %s (copy)' % (target))
+                    else:
+                        expected.append('New file: %s (copy)' % (target))
+                library.named_folders[name] = folder
+            sys.stdout = output
+            library.generate_files(options)
+        finally:
+            sys.stdout = saved_stdout
+            pm._logger.removeHandler(handler)
+            shutil.rmtree(tmp_dir)
+        self.assertEquals(expected, output.getvalue().splitlines())
+
+    def test_path_locks(self):
+        """Tests that exports of the same image file share a lock."""
+        path_locks = pm._PathLocks()
+        lock = path_locks.get(u'/a.jpg')
+        self.assertTrue(lock is path_locks.get(u'/a.jpg'))
+        self.assertFalse(lock is path_locks.get(u'/b.jpg'))
+
 if __name__ == '__main__':
     unittest.main()
@@ -28,6 +28,7 @@ from Tkinter import *  #IGNORE:W0401
 from ttk import *
 
 import appledata.iphotodata as iphotodata
+import appledata.librarycache as librarycache
 import phoshare.phoshare_main as phoshare_main
 import phoshare.phoshare_version as phoshare_version
 import tilutil.exiftool as exiftool
@@ -136,7 +137,7 @@ class ExportApp(Frame):
         self.create_widgets()
 
         # Set up logging so it gets redirected to the text area in the app.
-        self.logging_handler = logging.StreamHandler(self)
+        self.logging_handler = su.CapturingStreamHandler(self)
         self.logging_handler.setLevel(logging.WARN)
         _logger.addHandler(self.logging_handler)
 
@@ -672,11 +673,22 @@ Metadata options will be disabled if exiftool is not available.""")
             self.movies = True  # TODO
             self.originals = False
             self.iptc = 0
+            self.exiftool_workers = 1
             self.gps = False
             self.faces = False
             self.facealbums = False
             self.facealbum_prefix = ''
+            self.locationalbums = False
+            self.locationalbum_prefix = ''
+            self.locationalbum_radius = 5.0
             self.face_keywords = False
+            self.manifest = False
+            self.duplicates = None
+            self.hash_workers = 2
+            self.similar = None
+            self.similar_distance = 6
+            self.jobs = 1
+            self.sidecar = False
             self.verbose = False
 
         def load(self):
@@ -813,7 +825,10 @@ Metadata options will be disabled if exiftool is not available.""")
             # First, load the iPhoto library.
             library_path = su.expand_home_folder(self.iphoto_library.get())
             album_xml_file = iphotodata.get_album_xmlfile(library_path)
-            data = iphotodata.get_iphoto_data(album_xml_file)
+            data = iphotodata.get_iphoto_data(
+                album_xml_file, librarycache.LibraryCache(
+                    su.expand_home_folder(librarycache.DEFAULT_CACHE_FOLDER),
+                    phoshare_version.PHOSHARE_VERSION))
             msg = "Version %s library with %d images" % (
                 data.applicationVersion, len(data.images))
             self.write(msg + '\n')
@@ -25,6 +25,8 @@ import gdata.photos.service
 import gdata.media
 import gdata.geo
 
+import appledata.iphotodata as iphotodata
+import phoshare.duplicates as duplicates
 import tilutil.confirmmanager as confirmmanager
 import tilutil.systemutils as su
 import tilutil.imageutils as imageutils
@@ -229,7 +231,7 @@ class PicasaFile(object):
 
     def get_export_keywords(self, options):
         """Get the list of keywords for the uploaded file."""
-        new_keywords = self.photo.keywords[:]
+        new_keywords = list(self.photo.keywords)
         if options.face_keywords:
             for keyword in self.photo.getfaces():
                 if not keyword in new_keywords:
@@ -405,7 +407,7 @@ class PicasaAlbum(object):
             for image in images:
                 if image.ismovie() and not options.movies:
                     continue
-                if _NOUPLOAD_KEYWORD in image.keywords:
+                if image.haskeyword(_NOUPLOAD_KEYWORD):
                     continue
                 entries += 1
                 image_basename = self.make_album_basename(
@@ -589,51 +591,19 @@ class PicasaAlbums(object):
            (directories)."""
         entries = 0
 
-        include_pattern = re.compile(su.fsdec(includes))
-        exclude_pattern = None
-        if excludes:
-            exclude_pattern = re.compile(su.fsdec(excludes))
-
-        # first, do the sub-albums
-        for sub_album in albums:
+        for sub_album, album_prefix in iphotodata.find_albums(
+                albums, album_types, includes, excludes, folder_prefix,
+                matched):
             if self._check_abort():
-                return
+                return entries
             sub_name = sub_album.name
             if not sub_name:
                 print "Found an album with no name: " + sub_album.albumid
                 sub_name = "xxx"
 
-            # check the album type
-            if sub_album.albumtype == "Folder":
-                sub_matched = matched
-                if include_pattern.match(sub_name):
-                    sub_matched = True
-                self.process_albums(
-                    sub_album.albums, album_types,
-                    folder_prefix + imageutils.make_foldername(sub_name) + "/",
-                    includes, excludes, options, sub_matched)
-                continue
-            elif (sub_album.albumtype == "None" or
-                  not sub_album.albumtype in album_types):
-                # print "Ignoring " + sub_album.name + " of type " + \
-                # sub_album.albumtype
-                continue
-
-            if not matched and not include_pattern.match(sub_name):
-                continue
-
-            if exclude_pattern and exclude_pattern.match(sub_name):
-                continue
-
-            sub_name = folder_prefix + imageutils.make_foldername(sub_name)
+            sub_name = album_prefix + imageutils.make_foldername(sub_name)
             sub_name = self._find_unused_folder(sub_name)
 
-            # first, do the sub-albums
-            if self.process_albums(sub_album.albums, album_types, folder_prefix,
-                                  includes, excludes, options, matched) > 0:
-                entries += 1
-
-            # now the album itself
             picture_directory = PicasaAlbum(sub_name, sub_album)
             if picture_directory.add_iphoto_images(sub_album.images,
                                                    options) > 0:
@@ -642,6 +612,21 @@ class PicasaAlbums(object):
 
         return entries
 
+    def check_duplicates(self, options, hash_cache):
+        """Skips or reports the images that have the same content as an image
+           that is uploaded before them (see --duplicates). Online albums
+           cannot share photos, so "link" skips them too."""
+        mode = options.duplicates
+        if mode == duplicates.LINK:
+            mode = duplicates.SKIP
+        duplicates.handle_duplicates(self.named_folders, mode, hash_cache)
+
+    def check_similar(self, options, phash_cache):
+        """Reports the images that look alike, or uploads only the best rated
+           image of each group (see --similar)."""
+        duplicates.handle_similar(self.named_folders, options.similar,
+                                  phash_cache, options.similar_distance)
+
     def load_album(self, options):
         """Loads an existing album (export folder)."""
         online_albums = {}
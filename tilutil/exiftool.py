@@ -19,19 +19,57 @@ Created on May 29, 2009
 #   limitations under the License.
 
 import datetime
+import logging
 import os
+import Queue
+import subprocess
 import sys
-import tempfile
+import threading
 import time
+import unicodedata
 
-from xml.dom import minidom
-from xml import parsers
+from xml.parsers import expat
 
 import tilutil.systemutils as su
 import tilutil.imageutils as imageutils
+import tilutil.jpegmetadata as jpegmetadata
 
 EXIFTOOL = "exiftool"
 
+# First exiftool version that supports the -stay_open option.
+_STAY_OPEN_VERSION = 8.42
+
+# Longer argument lists are passed to exiftool as an argument file.
+_MAX_COMMAND_LINE_ARGS = 100
+
+# Maximum number of updates in a WriteBatch before it is flushed.
+_MAX_BATCH_SIZE = 500
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+_logger = logging.getLogger("google.exiftool")
+_logger.addHandler(_NullHandler())
+
+def get_exif_tool_version():
+    """Returns the version of the installed exiftool as a float, or None if
+       exiftool cannot be executed."""
+    try:
+        return float(su.execandcombine((EXIFTOOL, "-ver")))
+    except (StandardError, OSError):
+        return None
+
+_exif_tool_version = []
+
+def _supports_stay_open():
+    """Tests if the installed exiftool supports -stay_open. Only checks the
+       version once."""
+    if not _exif_tool_version:
+        _exif_tool_version.append(get_exif_tool_version())
+    version = _exif_tool_version[0]
+    return version is not None and version >= _STAY_OPEN_VERSION
+
 def check_exif_tool(msgstream=sys.stderr):
     """Tests if a compatible version of exiftool is available."""
     try:
@@ -53,127 +91,443 @@ copy from http://www.sno.phy.queensu.ca/~phil/exiftool/.
 """ % (EXIFTOOL)
     return False
 
-def _get_xml_nodevalues(xml_data, tag, data):
-    """Extracts one or more node values from an XML element, and appends
-       it to the data array. Node values can be directly below the element,
-       or a list in <rdf:Bag><rfd:li>...</rfd:li>...</rdf:Bag> format.
+
+class ExiftoolSession(object):
+    """A long running exiftool process (exiftool -stay_open True -@ -) that
+    reads its arguments from stdin, and executes a command every time it sees
+    an -execute argument. Not thread safe - use an ExiftoolPool to share
+    sessions between threads.
     """
-    for xml_element in xml_data.getElementsByTagName(tag):
-        if (xml_element.firstChild.nodeValue and
-            xml_element.firstChild.nodeValue != "\n"):
-            data.append(xml_element.firstChild.nodeValue)
-        for xml_bag in xml_element.getElementsByTagName("rdf:Bag"):
-            for xml_li in xml_bag.getElementsByTagName("rdf:li"):
-                data.append(xml_li.firstChild.nodeValue)
 
-def get_iptc_data(image_file):
-    """get caption, keywords, datetime, rating, and GPS info all in one 
-       operation."""
-    output = su.execandcombine(
-        (EXIFTOOL, "-X", "-m", "-q", "-q", '-c', '%.6f', "-Keywords", 
-         "-Caption-Abstract", "-DateTimeOriginal", "-Rating", "-GPSLatitude",
-         "-Subject", "-GPSLongitude", "-RegionRectangle",
-         "-RegionPersonDisplayName", image_file))
-  
-    keywords = []
+    def __init__(self):
+        self._process = None
+        self._sequence = 0
+
+    def _start(self):
+        """Launches the exiftool process."""
+        _logger.debug(u'Starting %s -stay_open True -@ -', EXIFTOOL)
+        self._process = subprocess.Popen(
+            [EXIFTOOL, '-stay_open', 'True', '-@', '-'], shell=False,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+
+    def execute(self, args):
+        """Executes one exiftool command.
+
+        Args:
+            args: list of exiftool arguments (without the exiftool command
+                itself). Arguments must not contain line breaks.
+        Returns:
+            The combined output of the command, in the same format as
+            systemutils.execandcombine() returns it.
+        Raises:
+            IOError: if the exiftool process terminated unexpectedly.
+        """
+        if not self._process or self._process.poll() is not None:
+            self._start()
+        self._sequence += 1
+        lines = [_encode_arg(arg) for arg in args]
+        lines.append('-execute%d' % (self._sequence))
+        try:
+            self._process.stdin.write('\n'.join(lines) + '\n')
+            self._process.stdin.flush()
+        except IOError:
+            self.kill()
+            raise
+        ready = '{ready%d}' % (self._sequence)
+        data = []
+        while True:
+            line = self._process.stdout.readline()
+            if not line:
+                self.kill()
+                raise IOError('exiftool terminated unexpectedly')
+            line = line.strip()
+            if line == ready:
+                break
+            data.append(line.replace("\r", "\n"))
+        return "\n".join(data)
+
+    def kill(self):
+        """Terminates the exiftool process without waiting for it."""
+        if self._process:
+            try:
+                self._process.kill()
+                self._process.wait()
+            except OSError:
+                pass
+            self._process = None
+
+    def close(self):
+        """Asks the exiftool process to exit, and waits for it."""
+        if not self._process:
+            return
+        try:
+            self._process.stdin.write('-stay_open\nFalse\n')
+            self._process.stdin.close()
+            self._process.wait()
+        except (IOError, OSError):
+            self.kill()
+        self._process = None
+
+
+class ExiftoolPool(object):
+    """A fixed size pool of ExiftoolSession objects that can be used from
+    several threads at once."""
+
+    def __init__(self, size):
+        self._sessions = [ExiftoolSession() for _ in xrange(max(1, size))]
+        self._idle = Queue.Queue()
+        for session in self._sessions:
+            self._idle.put(session)
+
+    def _getsize(self):
+        return len(self._sessions)
+    size = property(_getsize, doc="Number of exiftool processes.")
+
+    def execute(self, args):
+        """Executes an exiftool command in the next idle session. Blocks until
+           a session becomes available."""
+        session = self._idle.get()
+        try:
+            return session.execute(args)
+        finally:
+            self._idle.put(session)
+
+    def close(self):
+        """Shuts down all exiftool processes."""
+        for session in self._sessions:
+            session.close()
+
+
+_pool = None
+_stats_lock = threading.Lock()
+_call_count = 0
+_call_seconds = 0.0
+
+def _encode_arg(arg):
+    """Encodes an exiftool argument for an argument file."""
+    if isinstance(arg, unicode):
+        return arg.encode("utf-8")
+    return arg
+
+def start_pool(size, msgstream=sys.stderr):
+    """Starts a pool of size persistent exiftool processes that will be used by
+       get_iptc_data() and update_iptcdata() until stop_pool() is called.
+
+    Returns:
+        True if the pool is active, False if the installed exiftool does not
+        support -stay_open (each call will then fork a new exiftool).
+    """
+    global _pool
+    if _pool:
+        return True
+    if size <= 0:
+        return False
+    version = get_exif_tool_version()
+    if version is None or version < _STAY_OPEN_VERSION:
+        print >> msgstream, ("exiftool %s does not support -stay_open - "
+                             "upgrade to %.2f or newer for faster metadata "
+                             "processing." % (version, _STAY_OPEN_VERSION))
+        return False
+    _pool = ExiftoolPool(size)
+    return True
+
+def stop_pool():
+    """Shuts down the exiftool processes started by start_pool()."""
+    global _pool
+    if _pool:
+        _pool.close()
+        _pool = None
+    count, seconds = get_call_stats()
+    if count:
+        _logger.debug(u'exiftool: %d calls, %.1f ms per call.', count,
+                      seconds * 1000.0 / count)
+
+def get_call_stats():
+    """Returns a tuple with the number of exiftool calls made so far, and the
+       total number of seconds spent in them."""
+    with _stats_lock:
+        return (_call_count, _call_seconds)
+
+def _execute(args):
+    """Runs exiftool with the given arguments, and returns the combined
+       output. Uses the persistent exiftool processes if start_pool() has been
+       called, otherwise forks a new exiftool process. Long argument lists
+       are passed through stdin.
+    """
+    global _call_count, _call_seconds
+    start_time = time.time()
+    output = None
+    pool = _pool
+    if pool and not [arg for arg in args if '\n' in arg]:
+        try:
+            output = pool.execute(args)
+        except (IOError, OSError), ex:
+            su.perr('exiftool session failed (%s), retrying without it.' % (
+                ex))
+    if output is None:
+        if len(args) > _MAX_COMMAND_LINE_ARGS:
+            output = su.execandcombine(
+                [EXIFTOOL, '-@', '-'],
+                input_data="\n".join([_encode_arg(arg) for arg in args]))
+        else:
+            output = su.execandcombine([EXIFTOOL] + list(args))
+    elapsed = time.time() - start_time
+    with _stats_lock:
+        _call_count += 1
+        _call_seconds += elapsed
+    _logger.debug(u'exiftool: %.1f ms for %s', elapsed * 1000.0, args[-1])
+    return output
+
+# Arguments for reading the metadata that Phoshare checks, in XML format.
+_IPTC_READ_ARGS = ("-X", "-m", "-q", "-q", '-c', '%.6f', "-Keywords",
+                   "-Caption-Abstract", "-DateTimeOriginal", "-Rating",
+                   "-GPSLatitude", "-Subject", "-GPSLongitude",
+                   "-RegionRectangle", "-RegionPersonDisplayName")
+
+# Elements in the exiftool -X output that we extract.
+_TAG_KEYWORDS = 'IPTC:Keywords'
+# Keywords can also be stored as Subject in the XMP directory
+_TAG_SUBJECT = 'XMP:Subject'
+_TAG_CAPTION = 'IPTC:Caption-Abstract'
+_TAG_DATE = 'ExifIFD:DateTimeOriginal'
+_TAG_RATING = 'XMP-xmp:Rating'
+_TAG_LATITUDE = 'Composite:GPSLatitude'
+_TAG_LONGITUDE = 'Composite:GPSLongitude'
+_TAG_RECTANGLE = 'XMP-MP:RegionRectangle'
+_TAG_PERSON = 'XMP-MP:RegionPersonDisplayName'
+_IPTC_TAGS = frozenset((_TAG_KEYWORDS, _TAG_SUBJECT, _TAG_CAPTION, _TAG_DATE,
+                        _TAG_RATING, _TAG_LATITUDE, _TAG_LONGITUDE,
+                        _TAG_RECTANGLE, _TAG_PERSON))
+
+class _IptcXmlParser(object):
+    """Extracts the tags in _IPTC_TAGS from exiftool -X output in a single
+    pass, without building a DOM tree.
+
+    Tag values can be directly below the tag element, or a list in
+    <rdf:Bag><rdf:li>...</rdf:li>...</rdf:Bag> format. The result is a list of
+    (file name, values) tuples, one per <rdf:Description> element, where
+    values maps a tag name to the list of its values.
+    """
+
+    def __init__(self):
+        self.descriptions = []
+        self._values = None  # tag values of the current rdf:Description
+        self._depth = 0  # element depth below the current rdf:Description
+        self._tag = None  # current tag element, if it is one we extract
+        self._tag_start = 0  # index of the first value of the current tag
+        self._text = []
+        self._li_text = None
+
+    def parse(self, output):
+        """Parses exiftool output.
+
+        Raises:
+            xml.parsers.expat.ExpatError: if the output is not valid XML.
+        """
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._character_data
+        parser.Parse(output, True)
+        return self.descriptions
+
+    def _start_element(self, name, attributes):
+        if self._values is None:
+            if name == 'rdf:Description':
+                self._values = {}
+                self._depth = 0
+                self.descriptions.append((attributes.get('rdf:about', u''),
+                                          self._values))
+            return
+        self._depth += 1
+        if self._depth == 1:
+            if name in _IPTC_TAGS:
+                self._tag = name
+                self._text = []
+                self._tag_start = len(self._values.setdefault(name, []))
+        elif self._depth == 3 and self._tag and name == 'rdf:li':
+            self._li_text = []
+
+    def _end_element(self, name):
+        if self._values is None:
+            return
+        if self._depth == 0:
+            self._values = None
+            return
+        if self._depth == 1:
+            if self._tag:
+                text = u''.join(self._text)
+                if text.strip():
+                    # Direct values come before any list values.
+                    self._values[self._tag].insert(self._tag_start, text)
+                self._tag = None
+        elif self._depth == 3 and self._li_text is not None:
+            self._values[self._tag].append(u''.join(self._li_text))
+            self._li_text = None
+        self._depth -= 1
+
+    def _character_data(self, data):
+        if self._li_text is not None:
+            self._li_text.append(data)
+        elif self._tag and self._depth == 1:
+            self._text.append(data)
+
+
+def _get_iptc_tuple(values, image_file):
+    """Converts extracted tag values of one image into a metadata tuple.
+
+    Args:
+        values: map from tag name to list of values, from _IptcXmlParser.
+        image_file: name of the file for error messages.
+    Returns:
+        (keywords, caption, date_time_original, rating, gps,
+        region_rectangles, region_names) tuple.
+    """
+    keywords = values.get(_TAG_KEYWORDS, []) + values.get(_TAG_SUBJECT, [])
     caption = None
+    for value in values.get(_TAG_CAPTION, ()):
+        caption = value
     date_time_original = None
+    for value in values.get(_TAG_DATE, ()):
+        try:
+            date_time_original = time.strptime(value, '%Y:%m:%d %H:%M:%S')
+            date_time_original = datetime.datetime(
+                date_time_original.tm_year,
+                date_time_original.tm_mon,
+                date_time_original.tm_mday,
+                date_time_original.tm_hour,
+                date_time_original.tm_min,
+                date_time_original.tm_sec)
+        except ValueError, _ve:
+            date_time_original = None
+            su.perr('Exiftool returned an invalid '
+                    'date %s for %s - ignoring.' % (value, image_file))
     rating = 0
+    for value in values.get(_TAG_RATING, ()):
+        rating = int(value)
     gps = None
-    region_names = []
+    gps_latitude = values.get(_TAG_LATITUDE)
+    gps_longitude = values.get(_TAG_LONGITUDE)
+    if gps_latitude and gps_longitude:
+        gps = imageutils.GpsLocation().from_composite(gps_latitude[-1],
+                                                      gps_longitude[-1])
     region_rectangles = []
+    for string_rectangle in values.get(_TAG_RECTANGLE, ()):
+        region_rectangles.append(
+            [float(c) for c in string_rectangle.split(',')])
+    region_names = values.get(_TAG_PERSON, [])
+    return (keywords, caption, date_time_original, rating, gps,
+            region_rectangles, region_names)
+
+def _get_empty_iptc_data():
+    """Returns the metadata tuple for an image without any metadata."""
+    return ([], None, None, 0, None, [], [])
+
+def _parse_iptc_output(output, image_file):
+    """Parses exiftool -X output for one or more files.
+
+    Args:
+        output: exiftool output.
+        image_file: name of the file for error messages, if exiftool does not
+            report it.
+    Returns:
+        List of (file name, metadata tuple) in the order exiftool reported
+        them.
+    Raises:
+        xml.parsers.expat.ExpatError: if the output is not valid XML.
+    """
+    result = []
+    for about, values in _IptcXmlParser().parse(output):
+        result.append((about, _get_iptc_tuple(values, about or image_file)))
+    return result
+
+def get_iptc_data(image_file):
+    """get caption, keywords, datetime, rating, and GPS info all in one 
+       operation."""
+    # JPEG files can be read directly, without launching exiftool.
+    iptc_data = jpegmetadata.read_iptc_data(image_file)
+    if iptc_data is not None:
+        return iptc_data
+    output = _execute(_IPTC_READ_ARGS + (image_file,))
     if output:
         try:
-            gps_latitude = None
-            gps_longitude = None
-
-            xml_data = minidom.parseString(output)
-
-            for xml_desc in xml_data.getElementsByTagName('rdf:Description'):
-                _get_xml_nodevalues(xml_desc, 'IPTC:Keywords', keywords)
-                # Keywords can also be stored as Subject in the XMP directory
-                _get_xml_nodevalues(xml_desc, 'XMP:Subject', keywords)
-                for xml_caption in xml_data.getElementsByTagName(
-                    'IPTC:Caption-Abstract'):
-                    caption = xml_caption.firstChild.nodeValue
-                for xml_element in xml_data.getElementsByTagName(
-                    'ExifIFD:DateTimeOriginal'):
-                    if not xml_element.firstChild:
-                        continue
-                    try:
-                        date_time_original = time.strptime(
-                            xml_element.firstChild.nodeValue,
-                            '%Y:%m:%d %H:%M:%S')
-                        date_time_original = datetime.datetime(
-                            date_time_original.tm_year,
-                            date_time_original.tm_mon,
-                            date_time_original.tm_mday,
-                            date_time_original.tm_hour,
-                            date_time_original.tm_min,
-                            date_time_original.tm_sec)
-                    except ValueError, _ve:
-                        su.perr('Exiftool returned an invalid '
-                                'date %s for %s - ignoring.' % (
-                            xml_element.firstChild.nodeValue,
-                            image_file))
-                for xml_element in xml_data.getElementsByTagName(
-                    'XMP-xmp:Rating'):
-                    rating = int(xml_element.firstChild.nodeValue)
-                for xml_element in xml_data.getElementsByTagName(
-                    'Composite:GPSLatitude'):
-                    gps_latitude = xml_element.firstChild.nodeValue
-                for xml_element in xml_data.getElementsByTagName(
-                    'Composite:GPSLongitude'):
-                    gps_longitude = xml_element.firstChild.nodeValue
-                string_rectangles = []
-                _get_xml_nodevalues(xml_desc, 'XMP-MP:RegionRectangle', 
-                                    string_rectangles)
-                for string_rectangle in string_rectangles:
-                    rectangle = []
-                    for c in string_rectangle.split(','):
-                        rectangle.append(float(c))
-                    region_rectangles.append(rectangle)
-                _get_xml_nodevalues(xml_desc, 'XMP-MP:RegionPersonDisplayName', 
-                                    region_names)
-
-            xml_data.unlink()
-            if gps_latitude and gps_longitude:
-                gps = imageutils.GpsLocation().from_composite(gps_latitude, 
-                                                              gps_longitude)
-        except parsers.expat.ExpatError, ex:
+            descriptions = _parse_iptc_output(output, image_file)
+            if descriptions:
+                return descriptions[-1][1]
+        except expat.ExpatError, ex:
             su.perr('Could not parse exiftool output %s: %s' % (
                 output, ex))
+    return _get_empty_iptc_data()
 
-    return (keywords, caption, date_time_original, rating, gps,
-            region_rectangles, region_names)
+def get_iptc_data_batch(image_files):
+    """Reads the metadata of several files with a single exiftool command.
+       JPEG files are read directly.
 
+    Args:
+        image_files: list of paths to image files.
+    Returns:
+        Map from path (as passed in image_files) to the same metadata tuple
+        that get_iptc_data() returns. Files that exiftool could not read are
+        missing from the map.
+    """
+    result = {}
+    paths = {}
+    for image_file in image_files:
+        iptc_data = jpegmetadata.read_iptc_data(image_file)
+        if iptc_data is not None:
+            result[image_file] = iptc_data
+        else:
+            paths[unicodedata.normalize(
+                "NFC", su.unicode_string(image_file))] = image_file
+    if not paths:
+        return result
+    exiftool_files = [f for f in image_files if f not in result]
+    output = _execute(_IPTC_READ_ARGS + tuple(exiftool_files))
+    # exiftool reports errors (e.g. missing files) in between the XML.
+    output = "\n".join([line for line in output.split("\n")
+                        if not line.startswith("Error: ") and
+                        not line.startswith("Warning: ")])
+    if not output:
+        return result
+    try:
+        descriptions = _parse_iptc_output(output, exiftool_files[0])
+    except expat.ExpatError, ex:
+        su.perr('Could not parse exiftool output for %d files: %s' % (
+            len(exiftool_files), ex))
+        return result
+    for about, iptc_data in descriptions:
+        image_file = paths.get(unicodedata.normalize("NFC", about))
+        if image_file is not None:
+            result[image_file] = iptc_data
+    return result
 
-def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
-                    new_rating, new_gps, new_rectangles, new_persons):
-    """Updates the caption and keywords of an image file."""
+
+def _escape_value(value):
+    """Escapes a tag value for exiftool -E, so that it fits on one line of an
+       argument file."""
+    return value.replace('&', '&amp;').replace('\n', '&#x0a;').replace(
+        '\r', '&#x0d;')
+
+def _get_update_args(filepath, new_caption, new_keywords, new_datetime,
+                     new_rating, new_gps, new_rectangles, new_persons):
+    """Returns the exiftool arguments for update_iptcdata(). Tag values are
+       HTML escaped (-E), so no argument contains a line break."""
     # Some cameras write into ImageDescription, so we wipe it out to not cause
     # conflicts with Caption-Abstract. We also wipe out the XMP Subject and
     # Description tags (we use Keywords and Caption-Abstract).
-    command = [EXIFTOOL, '-F', '-m', '-P', '-ImageDescription=', '-Subject=',
+    command = ['-F', '-m', '-P', '-E', '-ImageDescription=', '-Subject=',
                '-Description=']
-    tmp = None
     if not new_caption is None:
-        if not new_caption:
-            command.append('-Caption-Abstract=')
-        else:
-            tmpfd, tmp = tempfile.mkstemp(dir="/var/tmp")
-            os.close(tmpfd)
-            file1 = open(tmp, "w")
-            print >> file1, new_caption.encode("utf-8")
-            file1.close()
-            command.append('-Caption-Abstract<=%s' % (tmp))
-    
+        command.append(u'-Caption-Abstract=%s' % (_escape_value(new_caption)))
+
     if new_datetime:
         command.append('-DateTimeOriginal="%s"' % (
             new_datetime.strftime("%Y:%m:%d %H:%M:%S")))
     if new_keywords:
         for keyword in new_keywords:
-            command.append(u'-keywords=%s' % (keyword))
+            command.append(u'-keywords=%s' % (_escape_value(keyword)))
     elif new_keywords != None:
         command.append('-keywords=')
     if new_rating >= 0:
@@ -187,7 +541,8 @@ def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
         command.append('-GPSLongitudeRef=' + new_gps.longitude_ref())
     if new_persons:
         for person in new_persons:
-            command.append(u'-RegionPersonDisplayName=%s' % (person))
+            command.append(u'-RegionPersonDisplayName=%s' % (
+                _escape_value(person)))
     elif new_persons != None:
         command.append('-RegionPersonDisplayName=')
     if new_rectangles:
@@ -198,9 +553,14 @@ def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
         command.append('-RegionRectangle=')
     command.append("-iptc:CodedCharacterSet=ESC % G")
     command.append(filepath)
-    result = su.fsdec(su.execandcombine(command))
-    if tmp:
-        os.remove(tmp)
+    return command
+
+def _check_update_result(filepath, result):
+    """Reports the exiftool output of an update of filepath.
+
+    Returns:
+        True if the file was updated.
+    """
     if result.find("1 image files updated") != -1:
         if result != "1 image files updated":
             su.pout(result)
@@ -214,4 +574,140 @@ def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
         su.perr("Failed to update IPTC data in image %s: %s" % (
             filepath, result))
         return False
-    
+
+def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
+                    new_rating, new_gps, new_rectangles, new_persons):
+    """Updates the caption and keywords of an image file."""
+    result = jpegmetadata.update_metadata(
+        filepath, new_caption, new_keywords, new_datetime, new_rating, new_gps,
+        new_rectangles, new_persons)
+    if result is not None:
+        return result
+    command = _get_update_args(filepath, new_caption, new_keywords,
+                               new_datetime, new_rating, new_gps,
+                               new_rectangles, new_persons)
+    return _check_update_result(filepath, su.fsdec(_execute(command)))
+
+def _split_execute_output(output):
+    """Splits the output of exiftool -stay_open with numbered -execute
+       arguments.
+
+    Returns:
+        Map from -execute number to the output of that command. Output after
+        the last {ready} line is mapped to None.
+    """
+    results = {}
+    lines = []
+    for line in output.split('\n'):
+        if line.startswith('{ready') and line.endswith('}'):
+            try:
+                results[int(line[6:-1])] = '\n'.join(lines)
+            except ValueError:
+                pass
+            lines = []
+        else:
+            lines.append(line)
+    results[None] = '\n'.join(lines)
+    return results
+
+class WriteBatch(object):
+    """Collects metadata updates, and runs all updates that need exiftool in
+    a single exiftool process when flush() is called. Can be used from
+    several threads at once.
+
+    The updates are written as one UTF-8 argument file with an -execute
+    section per image, and passed to exiftool -stay_open through stdin. Tag
+    values are HTML escaped, so no temporary files are needed for multi-line
+    captions.
+    """
+
+    def __init__(self, max_size=_MAX_BATCH_SIZE):
+        self._max_size = max_size
+        self._pending = []  # list of (filepath, args, callback)
+        self._after = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, filepath, new_caption, new_keywords, new_datetime,
+            new_rating, new_gps, new_rectangles, new_persons, callback=None):
+        """Adds an update. Takes the same arguments as update_iptcdata().
+
+        Updates that don't need exiftool are done right away. Otherwise the
+        update happens when the batch is flushed, which happens automatically
+        once the batch is full.
+
+        Args:
+            callback: optional function that is called with True if the file
+                was updated, or False if the update failed.
+        """
+        result = jpegmetadata.update_metadata(
+            filepath, new_caption, new_keywords, new_datetime, new_rating,
+            new_gps, new_rectangles, new_persons)
+        if result is not None:
+            if callback:
+                callback(result)
+            return
+        args = _get_update_args(filepath, new_caption, new_keywords,
+                                new_datetime, new_rating, new_gps,
+                                new_rectangles, new_persons)
+        with self._lock:
+            self._pending.append((filepath, args, callback))
+            if len(self._pending) >= self._max_size:
+                self.flush()
+
+    def call_after(self, callback):
+        """Calls callback() after the pending updates have been written."""
+        with self._lock:
+            if self._pending:
+                self._after.append(callback)
+                return
+        callback()
+
+    def flush(self):
+        """Writes all pending updates."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        after, self._after = self._after, []
+        if pending:
+            if _supports_stay_open():
+                results = self._execute_batch(pending)
+            else:
+                results = [su.fsdec(_execute(args))
+                           for _, args, _ in pending]
+            for (filepath, _, callback), result in zip(pending, results):
+                success = _check_update_result(filepath, result)
+                if callback:
+                    callback(success)
+        for callback in after:
+            callback()
+
+    def _execute_batch(self, pending):
+        """Runs exiftool once for a list of updates.
+
+        Returns:
+            List with the output for each update.
+        """
+        global _call_count, _call_seconds
+        start_time = time.time()
+        lines = []
+        for index, (_, args, _) in enumerate(pending):
+            lines.extend([_encode_arg(arg) for arg in args])
+            lines.append('-execute%d' % (index + 1))
+        lines.extend(['-stay_open', 'False'])
+        output = su.execandcombine(
+            [EXIFTOOL, '-stay_open', 'True', '-@', '-'],
+            input_data='\n'.join(lines) + '\n')
+        results = _split_execute_output(output)
+        elapsed = time.time() - start_time
+        with _stats_lock:
+            _call_count += 1
+            _call_seconds += elapsed
+        _logger.debug(u'exiftool: %.1f ms for %d updates', elapsed * 1000.0,
+                      len(pending))
+        return [su.fsdec(results.get(index + 1, results[None]))
+                for index in xrange(len(pending))]
@@ -0,0 +1,139 @@
+"""This module tests exiftool.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import unittest
+
+import tilutil.exiftool as exiftool
+import tilutil.systemutils as su
+
+_OUTPUT = """<?xml version='1.0' encoding='UTF-8'?>
+<rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>
+
+<rdf:Description rdf:about='/tmp/a &amp; b.jpg'
+  xmlns:et='http://ns.exiftool.ca/1.0/' et:toolkit='Image::ExifTool 8.50'
+  xmlns:ExifIFD='http://ns.exiftool.ca/EXIF/ExifIFD/1.0/'
+  xmlns:IPTC='http://ns.exiftool.ca/IPTC/IPTC/1.0/'
+  xmlns:XMP-xmp='http://ns.exiftool.ca/XMP/XMP-xmp/1.0/'
+  xmlns:XMP-MP='http://ns.exiftool.ca/XMP/XMP-MP/1.0/'
+  xmlns:Composite='http://ns.exiftool.ca/Composite/1.0/'>
+ <IPTC:Keywords>
+  <rdf:Bag>
+   <rdf:li>one</rdf:li>
+   <rdf:li>tw&amp;o</rdf:li>
+  </rdf:Bag>
+ </IPTC:Keywords>
+ <IPTC:Caption-Abstract>Hello &lt;world&gt;</IPTC:Caption-Abstract>
+ <ExifIFD:DateTimeOriginal>2010:05:06 07:08:09</ExifIFD:DateTimeOriginal>
+ <XMP-xmp:Rating>3</XMP-xmp:Rating>
+ <Composite:GPSLatitude>37.123456 N</Composite:GPSLatitude>
+ <Composite:GPSLongitude>122.500000 W</Composite:GPSLongitude>
+ <XMP-MP:RegionRectangle>
+  <rdf:Bag>
+   <rdf:li>0.1, 0.2, 0.3, 0.4</rdf:li>
+   <rdf:li>0.5, 0.6, 0.1, 0.1</rdf:li>
+  </rdf:Bag>
+ </XMP-MP:RegionRectangle>
+ <XMP-MP:RegionPersonDisplayName>
+  <rdf:Bag>
+   <rdf:li>Jane</rdf:li>
+   <rdf:li>John</rdf:li>
+  </rdf:Bag>
+ </XMP-MP:RegionPersonDisplayName>
+</rdf:Description>
+
+<rdf:Description rdf:about='/tmp/c.jpg'
+  xmlns:et='http://ns.exiftool.ca/1.0/' et:toolkit='Image::ExifTool 8.50'
+  xmlns:IPTC='http://ns.exiftool.ca/IPTC/IPTC/1.0/'>
+ <IPTC:Keywords>single</IPTC:Keywords>
+</rdf:Description>
+</rdf:RDF>
+"""
+
+class ExiftoolTest(unittest.TestCase):
+    """Unit tests for exiftool.py code."""
+
+    def test_parse_iptc_output(self):
+        """Tests exiftool._parse_iptc_output."""
+        result = exiftool._parse_iptc_output(_OUTPUT, 'unknown')
+        self.assertEquals(2, len(result))
+
+        about, (keywords, caption, date, rating, gps, rectangles,
+                names) = result[0]
+        self.assertEquals(u'/tmp/a & b.jpg', about)
+        self.assertEquals([u'one', u'tw&o'], keywords)
+        self.assertEquals(u'Hello <world>', caption)
+        self.assertEquals(datetime.datetime(2010, 5, 6, 7, 8, 9), date)
+        self.assertEquals(3, rating)
+        self.assertEquals('(37.123456, -122.500000)', gps.to_string())
+        self.assertEquals([[0.1, 0.2, 0.3, 0.4], [0.5, 0.6, 0.1, 0.1]],
+                          rectangles)
+        self.assertEquals([u'Jane', u'John'], names)
+
+        about, iptc_data = result[1]
+        self.assertEquals(u'/tmp/c.jpg', about)
+        self.assertEquals(([u'single'], None, None, 0, None, [], []),
+                          iptc_data)
+
+    def test_get_iptc_data_batch(self):
+        """Tests exiftool.get_iptc_data_batch."""
+        saved_execute = exiftool._execute
+        try:
+            exiftool._execute = lambda args: (
+                'Error: File not found - /tmp/x.jpg\n' + _OUTPUT)
+            result = exiftool.get_iptc_data_batch(
+                [u'/tmp/a & b.jpg', '/tmp/c.jpg', '/tmp/x.jpg'])
+        finally:
+            exiftool._execute = saved_execute
+        self.assertEquals(['/tmp/a & b.jpg', '/tmp/c.jpg'], sorted(result))
+        self.assertEquals([u'single'], result['/tmp/c.jpg'][0])
+
+    def test_write_batch(self):
+        """Tests that exiftool.WriteBatch runs all updates at once."""
+        calls = []
+        def execandcombine(command, input_data=None):
+            calls.append((command, input_data))
+            return ('1 image files updated\n{ready1}\n'
+                    'Error: File not found - /tmp/b.tif\n'
+                    '0 image files updated\n{ready2}')
+        saved = (su.execandcombine, exiftool._supports_stay_open)
+        results = []
+        try:
+            su.execandcombine = execandcombine
+            exiftool._supports_stay_open = lambda: True
+            batch = exiftool.WriteBatch()
+            batch.add('/tmp/a.tif', u'Line 1\nLine 2 & more', None, None, -1,
+                      None, None, None, callback=results.append)
+            batch.add('/tmp/b.tif', None, [u'caf\xe9'], None, -1, None, None,
+                      None, callback=results.append)
+            batch.call_after(lambda: results.append('done'))
+            self.assertEquals(2, len(batch))
+            self.assertEquals([], calls)
+            batch.flush()
+        finally:
+            su.execandcombine, exiftool._supports_stay_open = saved
+        self.assertEquals(1, len(calls))
+        lines = calls[0][1].split('\n')
+        self.assertTrue('-Caption-Abstract=Line 1&#x0a;Line 2 &amp; more'
+                        in lines)
+        self.assertTrue('-keywords=caf\xc3\xa9' in lines)
+        self.assertEquals(['-execute2', '-stay_open', 'False', ''],
+                          lines[-4:])
+        self.assertEquals([True, False, 'done'], results)
+        self.assertEquals(0, len(batch))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""Grid index over GPS locations.
+
+The index files items by latitude and longitude in cells of a fixed number
+of degrees, so that bounding box and radius queries only look at the items
+in the cells that overlap the query, and clustering only compares nearby
+items.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import math
+
+EARTH_RADIUS_KM = 6371.0
+
+# Length of a degree of latitude.
+_KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180.0
+
+
+def distance_km(latitude1, longitude1, latitude2, longitude2):
+    """Returns the great circle distance between two locations, in km."""
+    lat1 = math.radians(latitude1)
+    lat2 = math.radians(latitude2)
+    dlat = lat2 - lat1
+    dlon = math.radians(longitude2 - longitude1)
+    a = (math.sin(dlat / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GeoIndex(object):
+    """Grid index of items with a latitude and longitude."""
+
+    def __init__(self, points, cell_degrees=0.1):
+        """Builds the index.
+
+        Args:
+          points: list of (latitude, longitude, item) tuples.
+          cell_degrees: size of the grid cells in degrees. Queries are
+              fastest when the cells are about the size of the queries.
+        """
+        self.cell_degrees = cell_degrees
+        self._columns = int(math.ceil(360.0 / cell_degrees))
+        self.points = list(points)
+        self._cells = {}
+        for point in self.points:
+            self._cells.setdefault(self._get_cell(point[0], point[1]),
+                                   []).append(point)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _get_row(self, latitude):
+        return int(math.floor(latitude / self.cell_degrees))
+
+    def _get_column(self, longitude):
+        if longitude == 180.0:
+            # The east edge of the last column, not the west edge of the
+            # first one.
+            return self._columns - 1
+        return (int(math.floor((longitude + 180.0) / self.cell_degrees)) %
+                self._columns)
+
+    def _get_cell(self, latitude, longitude):
+        return self._get_row(latitude), self._get_column(longitude)
+
+    def _iter_candidates(self, south, west, north, east):
+        """Yields the points in the cells that overlap a box. west > east
+           means that the box crosses the 180th meridian."""
+        first_column = self._get_column(west)
+        last_column = self._get_column(east)
+        if west > east:
+            columns = (range(first_column, self._columns) +
+                       range(0, last_column + 1))
+        elif east - west >= 360.0:
+            columns = range(self._columns)
+        else:
+            columns = range(first_column, last_column + 1)
+        for row in xrange(self._get_row(south), self._get_row(north) + 1):
+            for column in columns:
+                for point in self._cells.get((row, column), ()):
+                    yield point
+
+    def in_box(self, south, west, north, east):
+        """Returns the items inside a box. The box may cross the 180th
+           meridian (west > east)."""
+        result = []
+        for latitude, longitude, item in self._iter_candidates(
+                south, west, north, east):
+            if not south <= latitude <= north:
+                continue
+            if west <= east:
+                if not west <= longitude <= east:
+                    continue
+            elif not (longitude >= west or longitude <= east):
+                continue
+            result.append(item)
+        return result
+
+    def _iter_near(self, latitude, longitude, radius_km):
+        """Yields (distance, point) for the points within a radius."""
+        lat_degrees = radius_km / _KM_PER_DEGREE
+        south = max(-90.0, latitude - lat_degrees)
+        north = min(90.0, latitude + lat_degrees)
+        # Longitude degrees get shorter towards the poles, so the box is
+        # as wide as it needs to be at the latitude closest to a pole.
+        cos_lat = math.cos(math.radians(max(abs(south), abs(north))))
+        if cos_lat * 180.0 * _KM_PER_DEGREE <= radius_km:
+            west, east = -180.0, 180.0
+        else:
+            lon_degrees = lat_degrees / cos_lat
+            west = longitude - lon_degrees
+            east = longitude + lon_degrees
+            if west < -180.0:
+                west += 360.0
+            if east > 180.0:
+                east -= 360.0
+        for point in self._iter_candidates(south, west, north, east):
+            distance = distance_km(latitude, longitude, point[0], point[1])
+            if distance <= radius_km:
+                yield distance, point
+
+    def near(self, latitude, longitude, radius_km):
+        """Returns the items within radius_km of a location, closest first."""
+        found = list(self._iter_near(latitude, longitude, radius_km))
+        found.sort(key=lambda entry: entry[0])
+        return [point[2] for _distance, point in found]
+
+    def clusters(self, radius_km):
+        """Groups the items into clusters of nearby items.
+
+        Takes the points in the order they were given. Each point that is
+        not in a cluster yet starts a new cluster, which gets all the other
+        free points within radius_km of it.
+
+        Returns:
+          list of item lists, in the order of the first item of each cluster.
+          The items of a cluster keep their order too.
+        """
+        positions = dict([(id(point), i)
+                          for i, point in enumerate(self.points)])
+        clustered = set()
+        result = []
+        for point in self.points:
+            if id(point) in clustered:
+                continue
+            cluster = []
+            for _distance, other in self._iter_near(point[0], point[1],
+                                                    radius_km):
+                if id(other) not in clustered:
+                    clustered.add(id(other))
+                    cluster.append(positions[id(other)])
+            cluster.sort()
+            result.append([self.points[i][2] for i in cluster])
+        return result
@@ -0,0 +1,106 @@
+"""This module tests geoindex.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import random
+import unittest
+
+import tilutil.geoindex as geoindex
+
+_POINTS = [
+    (37.7749, -122.4194, 'San Francisco'),
+    (37.8044, -122.2712, 'Oakland'),
+    (37.3382, -121.8863, 'San Jose'),
+    (48.8566, 2.3522, 'Paris'),
+    (48.8049, 2.1204, 'Versailles'),
+    (-17.7134, 178.0650, 'Fiji'),
+    (-17.5, -179.95, 'Date line'),
+    (89.99, 45.0, 'North Pole'),
+    (89.99, -135.0, 'Other side of the pole'),
+]
+
+
+class GeoIndexTest(unittest.TestCase):
+    """Unit tests for geoindex.py code."""
+
+    def setUp(self):
+        self.index = geoindex.GeoIndex(_POINTS)
+
+    def test_distance(self):
+        """Tests the great circle distance."""
+        self.assertAlmostEquals(
+            1105, geoindex.distance_km(48.8566, 2.3522, 41.9028, 12.4964), 0)
+        self.assertEquals(0, geoindex.distance_km(10, 20, 10, 20))
+        self.assertAlmostEquals(
+            22.2, geoindex.distance_km(0, 179.9, 0, -179.9), 1)
+
+    def test_near(self):
+        """Tests the radius queries."""
+        self.assertEquals(['San Francisco', 'Oakland'],
+                          self.index.near(37.7749, -122.4194, 20))
+        self.assertEquals(['San Francisco', 'Oakland', 'San Jose'],
+                          self.index.near(37.7749, -122.4194, 70))
+        self.assertEquals(['Fiji', 'Date line'],
+                          self.index.near(-17.7, 178.1, 250))
+        self.assertEquals(['North Pole', 'Other side of the pole'],
+                          self.index.near(89.99, 45.0, 5))
+        self.assertEquals([], self.index.near(0, 0, 1000))
+
+    def test_in_box(self):
+        """Tests the bounding box queries."""
+        self.assertEquals(['San Francisco', 'Oakland'],
+                          self.index.in_box(37.5, -123, 38, -122))
+        self.assertEquals(['Date line', 'Fiji'],
+                          sorted(self.index.in_box(-20, 170, -10, -170)))
+        self.assertEquals(len(_POINTS),
+                          len(self.index.in_box(-90, -180, 90, 180)))
+
+    def test_in_box_date_line(self):
+        """Tests boxes that end or start exactly at the 180th meridian."""
+        index = geoindex.GeoIndex([(0, 175, 'a'), (0, 180, 'b'),
+                                   (0, -175, 'c')])
+        self.assertEquals(['a', 'b'], sorted(index.in_box(-10, 170, 10, 180)))
+        self.assertEquals(['b', 'c'],
+                          sorted(index.in_box(-10, 180, 10, -170)))
+        self.assertEquals(['a', 'b', 'c'],
+                          sorted(index.in_box(-10, 170, 10, -170)))
+        self.assertEquals(['b', 'a', 'c'], index.near(0, 179.9, 600))
+
+    def test_clusters(self):
+        """Tests the clustering of nearby points."""
+        self.assertEquals([['San Francisco', 'Oakland'], ['San Jose'],
+                           ['Paris', 'Versailles'], ['Fiji'], ['Date line'],
+                           ['North Pole', 'Other side of the pole']],
+                          self.index.clusters(25))
+
+    def test_brute_force(self):
+        """Compares the queries with a scan of all points."""
+        generator = random.Random(42)
+        points = [(generator.uniform(-90, 90), generator.uniform(-180, 180), i)
+                  for i in range(500)]
+        index = geoindex.GeoIndex(points, cell_degrees=5.0)
+        for _ in range(20):
+            latitude = generator.uniform(-90, 90)
+            longitude = generator.uniform(-180, 180)
+            radius = generator.uniform(10, 2000)
+            expected = sorted([item for lat, lon, item in points
+                               if geoindex.distance_km(latitude, longitude,
+                                                       lat, lon) <= radius])
+            self.assertEquals(expected,
+                              sorted(index.near(latitude, longitude, radius)))
+
+
+if __name__ == '__main__':
+    unittest.main()
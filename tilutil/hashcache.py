@@ -0,0 +1,169 @@
+"""Content hashes of files, cached in a SQLite database.
+
+A hash is computed once for each file, and reused as long as the size,
+modification time and inode of the file are unchanged. New hashes are
+computed by a pool of threads that read the files in chunks, or by a
+function that hashes a list of files at once (see tilutil/phash.py).
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import logging
+import multiprocessing.pool
+import os
+import sqlite3
+
+HASH_CACHE_NAME = 'hashes.db'
+PHASH_CACHE_NAME = 'phashes.db'
+
+_SCHEMA_VERSION = 1
+
+# Files are read in chunks of this size. hashlib releases the interpreter
+# lock for large updates, so several threads can hash at the same time.
+_CHUNK_SIZE = 1024 * 1024
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+_logger = logging.getLogger('google.hashcache')
+_logger.addHandler(_NullHandler())
+
+
+def hash_file(path):
+    """Returns the SHA-1 hex digest of the content of a file."""
+    digest = hashlib.sha1()
+    input_file = open(path, 'rb')
+    try:
+        while True:
+            chunk = input_file.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        input_file.close()
+    return digest.hexdigest()
+
+
+def _hash_entry(entry):
+    """Hashes the file of a (path, stat) entry for the thread pool. Returns
+       (path, stat, digest), with digest None if the file cannot be read."""
+    path, stat = entry
+    try:
+        return path, stat, hash_file(path)
+    except IOError, e:
+        _logger.info(u'Cannot hash %s: %s', path, e)
+        return path, stat, None
+
+
+class HashCache(object):
+    """Computes and remembers the content hashes of files.
+
+    Entries are keyed by the path of the file, and are valid while the size,
+    modification time and inode of the file match.
+    """
+
+    def __init__(self, path, workers=2, hash_files=None):
+        """Opens or creates a cache.
+
+        Args:
+          path: path of the SQLite database.
+          workers: number of threads that hash files.
+          hash_files: function that takes a list of paths, and returns a map
+              from path to hash for the files it could hash. If None, files
+              are hashed with hash_file().
+        """
+        self.path = path
+        self.workers = workers
+        self._hash_files = hash_files
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._connection = sqlite3.connect(path)
+        self._connection.text_factory = unicode
+        self._create_tables()
+
+    def _create_tables(self):
+        """Creates the database tables, dropping data of other versions."""
+        cursor = self._connection.cursor()
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version != _SCHEMA_VERSION:
+            cursor.execute('DROP TABLE IF EXISTS hashes')
+            cursor.execute(
+                'CREATE TABLE hashes (path TEXT PRIMARY KEY, size INTEGER, '
+                'mtime REAL, inode INTEGER, digest TEXT)')
+            cursor.execute('PRAGMA user_version = %d' % (_SCHEMA_VERSION))
+            self._connection.commit()
+
+    def _lookup(self, path, stat):
+        row = self._connection.execute(
+            'SELECT size, mtime, inode, digest FROM hashes WHERE path = ?',
+            (path,)).fetchone()
+        if (row and row[0] == stat.st_size and row[1] == stat.st_mtime and
+            row[2] == stat.st_ino):
+            return row[3]
+        return None
+
+    def get_hashes(self, paths):
+        """Returns a map from path to content hash for a list of files. Files
+           that do not exist or cannot be read are left out."""
+        result = {}
+        pending = []
+        for path in sorted(set(paths)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            digest = self._lookup(path, stat)
+            if digest:
+                result[path] = digest
+            else:
+                pending.append((path, stat))
+        if not pending:
+            return result
+
+        _logger.debug(u'Hashing %d files.', len(pending))
+        if self._hash_files:
+            hashes = self._hash_files([path for path, _stat in pending])
+            self._store([(path, stat, hashes.get(path))
+                         for path, stat in pending], result)
+        elif self.workers > 1 and len(pending) > 1:
+            pool = multiprocessing.pool.ThreadPool(self.workers)
+            try:
+                hashed = pool.imap_unordered(_hash_entry, pending)
+                self._store(hashed, result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self._store([_hash_entry(entry) for entry in pending], result)
+        return result
+
+    def _store(self, hashed, result):
+        """Records new hashes in the database and in result."""
+        for path, stat, digest in hashed:
+            if digest is None:
+                continue
+            result[path] = digest
+            self._connection.execute(
+                'INSERT OR REPLACE INTO hashes (path, size, mtime, inode, '
+                'digest) VALUES (?, ?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime, stat.st_ino, digest))
+        self._connection.commit()
+
+    def close(self):
+        """Closes the database."""
+        self._connection.close()
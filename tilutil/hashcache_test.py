@@ -0,0 +1,89 @@
+"""This module tests hashcache.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import tilutil.hashcache as hashcache
+
+class HashCacheTest(unittest.TestCase):
+    """Unit tests for hashcache.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.folder, 'cache', 'hashes.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, data):
+        path = os.path.join(self.folder, name)
+        output = open(path, 'wb')
+        output.write(data)
+        output.close()
+        return path
+
+    def test_hash_file(self):
+        """Tests hashing a file that is larger than a chunk."""
+        data = 'x' * (3 * 1024 * 1024 + 5)
+        self.assertEquals(hashlib.sha1(data).hexdigest(),
+                          hashcache.hash_file(self._write(u'big.jpg', data)))
+
+    def test_get_hashes(self):
+        """Tests that hashes are cached, and computed again for changed
+           files."""
+        paths = [self._write(u'%d.jpg' % (i), 'data %d' % (i % 3))
+                 for i in range(6)]
+        missing = os.path.join(self.folder, u'missing.jpg')
+        cache = hashcache.HashCache(self.cache_path, workers=3)
+        hashes = cache.get_hashes(paths + [missing])
+        self.assertEquals(sorted(paths), sorted(hashes.keys()))
+        self.assertEquals(hashes[paths[0]], hashes[paths[3]])
+        self.assertNotEquals(hashes[paths[0]], hashes[paths[1]])
+        cache.close()
+
+        # Same content, but a different size: the hash must not be reused.
+        self._write(u'0.jpg', 'other data')
+        cache = hashcache.HashCache(self.cache_path, workers=1)
+        hashes2 = cache.get_hashes(paths)
+        self.assertEquals(hashlib.sha1('other data').hexdigest(),
+                          hashes2[paths[0]])
+        self.assertEquals(hashes[paths[1]], hashes2[paths[1]])
+        cache.close()
+
+    def test_hash_files(self):
+        """Tests a cache with a function that hashes a list of files."""
+        paths = [self._write(u'%d.jpg' % (i), 'data %d' % (i))
+                 for i in range(3)]
+        calls = []
+        def hash_files(pending):
+            calls.append(sorted(pending))
+            return dict([(path, 'hash of ' + os.path.basename(path))
+                         for path in pending if not path.endswith('2.jpg')])
+        cache = hashcache.HashCache(self.cache_path, hash_files=hash_files)
+        hashes = cache.get_hashes(paths)
+        self.assertEquals({paths[0]: 'hash of 0.jpg',
+                           paths[1]: 'hash of 1.jpg'}, hashes)
+        self.assertEquals(hashes, cache.get_hashes(paths))
+        # Files that could not be hashed are tried again.
+        self.assertEquals([sorted(paths), [paths[2]]], calls)
+        cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -409,20 +409,25 @@ def format_photo_name(photo, album_name, index, padded_index,
     return make_image_filename(formatted_name)
 
 def copy_or_link_file(source, target, dryrun=False, link=False, size=None,
-                      update=True):
-    """copies, links, or converts an image file."""
+                      update=True, writer=None):
+    """copies, links, or converts an image file.
+
+    Args:
+        writer: optional function(source, target) used instead of
+            shutil.copy2() for copies. It returns False if it did not write
+            the file, in which case the file is copied normally.
+    """
     try:
         if size:
             mode = " (convert)"
         elif link:
             mode = " (link)"
-            print source # TODO
         else:
             mode = " (copy)"
         if os.path.exists(target):
             if not update:
                 _logger.info("Needs update: %s." % target)
-                print "Use the -u option to update this file."
+                su.pout("Use the -u option to update this file.")
                 return True
             _logger.info("Updating: " + target + mode)
             if not dryrun:
@@ -439,6 +444,8 @@ def copy_or_link_file(source, target, dryrun=False, link=False, size=None,
             if result:
                 _logger.error(u'%s: %s' % (source, result))
                 return False
+        elif writer and writer(source, target):
+            _logger.debug(u'Copied %s to %s with metadata', source, target)
         else:
             _logger.debug(u'shutil.copy2(%s, %s)', source, target)
             shutil.copy2(source, target)
@@ -0,0 +1,1017 @@
+'''Reads image metadata directly from JPEG files, without launching exiftool.
+
+Only the marker segments in front of the image data are examined: APP1 (EXIF
+and XMP) and APP13 (Photoshop image resources with IPTC data). The results
+match what exiftool.get_iptc_data() reports. Anything unexpected (other file
+formats, malformed files, metadata stored in ways we don't parse) is reported
+as None, so that callers can fall back to exiftool.
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+from xml.dom import minidom
+from xml.parsers import expat
+from xml.sax import saxutils
+
+import tilutil.systemutils as su
+import tilutil.imageutils as imageutils
+
+# JPEG markers.
+_SOI = 0xd8
+_EOI = 0xd9
+_SOS = 0xda
+_TEM = 0x01
+_RST0 = 0xd0
+_RST7 = 0xd7
+APP1 = 0xe1
+APP13 = 0xed
+
+# Segment signatures.
+EXIF_SIGNATURE = 'Exif\x00\x00'
+XMP_SIGNATURE = 'http://ns.adobe.com/xap/1.0/\x00'
+_XMP_EXTENSION_SIGNATURE = 'http://ns.adobe.com/xmp/extension/\x00'
+PHOTOSHOP_SIGNATURE = 'Photoshop 3.0\x00'
+
+# Segment kinds, see _get_segment_kind().
+_EXIF = 'exif'
+_XMP = 'xmp'
+_XMP_EXTENSION = 'xmp-extension'
+_PHOTOSHOP = 'photoshop'
+
+# Photoshop image resource that holds IPTC data.
+IPTC_RESOURCE_ID = 0x0404
+# Photoshop image resource with the MD5 digest of the IPTC data.
+IPTC_DIGEST_RESOURCE_ID = 0x0425
+
+# IPTC datasets (record, dataset).
+IPTC_CODED_CHARACTER_SET = (1, 90)
+IPTC_RECORD_VERSION = (2, 0)
+IPTC_KEYWORDS = (2, 25)
+IPTC_CAPTION = (2, 120)
+# CodedCharacterSet value for UTF-8.
+IPTC_UTF8 = '\x1b%G'
+
+# TIFF tags.
+TAG_IMAGE_DESCRIPTION = 0x010e
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_DATE_TIME_ORIGINAL = 0x9003
+TAG_GPS_LATITUDE_REF = 1
+TAG_GPS_LATITUDE = 2
+TAG_GPS_LONGITUDE_REF = 3
+TAG_GPS_LONGITUDE = 4
+
+# Size in bytes of the TIFF field types.
+_TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4,
+                    10: 8, 11: 4, 12: 8}
+TIFF_ASCII = 2
+TIFF_RATIONAL = 5
+
+# XMP namespaces.
+NS_RDF = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+NS_DC = 'http://purl.org/dc/elements/1.1/'
+NS_XMP = 'http://ns.adobe.com/xap/1.0/'
+NS_EXIF = 'http://ns.adobe.com/exif/1.0/'
+NS_MP = 'http://ns.microsoft.com/photo/1.2/'
+NS_MP_REGION_INFO = 'http://ns.microsoft.com/photo/1.2/t/RegionInfo#'
+NS_MP_REGION = 'http://ns.microsoft.com/photo/1.2/t/Region#'
+_NS_XMLNS = 'http://www.w3.org/2000/xmlns/'
+
+_XMP_PACKET_HEADER = (
+    "<?xpacket begin='\xef\xbb\xbf' id='W5M0MpCehiHzreSzNTczkc9d'?>\n"
+    "<x:xmpmeta xmlns:x='adobe:ns:meta/'>\n"
+    "<rdf:RDF xmlns:rdf='%s'>\n" % (NS_RDF))
+_XMP_PACKET_TRAILER = "\n</rdf:RDF>\n</x:xmpmeta>\n<?xpacket end='w'?>"
+
+# Maximum size of the data in a marker segment.
+_MAX_SEGMENT_DATA = 0xffff - 2
+
+# Buffer size for copying the image data.
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class MalformedError(Exception):
+    """Raised when metadata cannot be parsed."""
+
+
+def is_jpeg_file(file_name):
+    """Tests if the file (name or full path) is a JPEG file."""
+    return su.getfileextension(file_name) in ("jpg", "jpeg")
+
+
+def read_segments(data):
+    """Walks the marker segments of a JPEG image.
+
+    Args:
+        data: string or mmap with the contents of a JPEG file.
+    Returns:
+        (segments, image_start) tuple. segments is a list of (marker, start,
+        end) for every segment in front of the image data, where data[start:end]
+        is the complete segment including the marker. image_start is the
+        offset of the Start Of Scan marker.
+    Raises:
+        MalformedError: if data is not a well-formed JPEG file.
+    """
+    size = len(data)
+    if size < 4 or data[0:2] != '\xff\xd8':
+        raise MalformedError('not a JPEG file')
+    segments = []
+    pos = 2
+    while pos + 4 <= size:
+        if data[pos] != '\xff':
+            raise MalformedError('missing marker at offset %d' % (pos))
+        marker = ord(data[pos + 1])
+        if marker == 0xff:
+            # Fill byte.
+            pos += 1
+            continue
+        if marker == _SOS:
+            return (segments, pos)
+        if marker == _EOI:
+            break
+        if marker in (_SOI, _TEM) or _RST0 <= marker <= _RST7:
+            raise MalformedError('unexpected marker %02x' % (marker))
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if length < 2 or pos + 2 + length > size:
+            raise MalformedError('bad segment length at offset %d' % (pos))
+        segments.append((marker, pos, pos + 2 + length))
+        pos += 2 + length
+    raise MalformedError('no image data')
+
+
+def _get_segment_kind(data, marker, start):
+    """Identifies the metadata segment that starts at data[start].
+
+    Returns:
+        One of _EXIF, _XMP, _XMP_EXTENSION, _PHOTOSHOP, or None for other
+        segments.
+    """
+    payload = start + 4
+    if marker == APP1:
+        for signature, kind in ((EXIF_SIGNATURE, _EXIF),
+                                (XMP_SIGNATURE, _XMP),
+                                (_XMP_EXTENSION_SIGNATURE, _XMP_EXTENSION)):
+            if data[payload:payload + len(signature)] == signature:
+                return kind
+    elif marker == APP13:
+        if data[payload:payload + len(PHOTOSHOP_SIGNATURE)] == (
+            PHOTOSHOP_SIGNATURE):
+            return _PHOTOSHOP
+    return None
+
+
+class TiffData(object):
+    """Minimal reader for the TIFF structure inside an EXIF segment."""
+
+    def __init__(self, tiff):
+        """Parses the TIFF header.
+
+        Args:
+            tiff: EXIF segment data following the "Exif\\0\\0" signature.
+        """
+        self.tiff = tiff
+        byte_order = tiff[0:2]
+        if byte_order == 'II':
+            self.endian = '<'
+        elif byte_order == 'MM':
+            self.endian = '>'
+        else:
+            raise MalformedError('bad TIFF byte order')
+        if self._unpack('H', 2) != 42:
+            raise MalformedError('bad TIFF header')
+        self.ifd0_offset = self._unpack('L', 4)
+
+    def _unpack(self, fmt, offset):
+        size = struct.calcsize(self.endian + fmt)
+        if offset < 0 or offset + size > len(self.tiff):
+            raise MalformedError('TIFF offset out of range')
+        return struct.unpack(self.endian + fmt,
+                             self.tiff[offset:offset + size])[0]
+
+    def read_ifd(self, offset):
+        """Reads an image file directory.
+
+        Returns:
+            Map from tag to (type, count, value_offset), where value_offset is
+            the position of the value data in the TIFF data.
+        """
+        entries = {}
+        count = self._unpack('H', offset)
+        for i in xrange(count):
+            entry = offset + 2 + 12 * i
+            tag = self._unpack('H', entry)
+            field_type = self._unpack('H', entry + 2)
+            field_count = self._unpack('L', entry + 4)
+            field_size = _TIFF_TYPE_SIZES.get(field_type, 1) * field_count
+            if field_size > 4:
+                value_offset = self._unpack('L', entry + 8)
+            else:
+                value_offset = entry + 8
+            if value_offset + field_size > len(self.tiff):
+                raise MalformedError('TIFF value out of range')
+            entries[tag] = (field_type, field_count, value_offset)
+        return entries
+
+    def get_sub_ifd(self, entries, tag):
+        """Reads the sub directory that entry tag points to, or returns None
+           if there is no such entry."""
+        entry = entries.get(tag)
+        if not entry:
+            return None
+        return self.read_ifd(self._unpack('L', entry[2]))
+
+    def get_ascii(self, entries, tag):
+        """Returns the value of an ASCII entry as a string, or None."""
+        entry = entries.get(tag)
+        if not entry or entry[0] != TIFF_ASCII:
+            return None
+        value = self.tiff[entry[2]:entry[2] + entry[1]]
+        return value.split('\x00', 1)[0]
+
+    def get_rationals(self, entries, tag):
+        """Returns the value of a RATIONAL entry as a list of floats, or None.
+        """
+        entry = entries.get(tag)
+        if not entry or entry[0] != TIFF_RATIONAL:
+            return None
+        result = []
+        for i in xrange(entry[1]):
+            numerator = self._unpack('L', entry[2] + 8 * i)
+            denominator = self._unpack('L', entry[2] + 8 * i + 4)
+            if not denominator:
+                raise MalformedError('undefined rational')
+            result.append(float(numerator) / denominator)
+        return result
+
+
+def _get_gps_coordinate(tiff, gps_ifd, tag, ref_tag):
+    """Returns a GPS coordinate as exiftool -c %.6f formats it ("37.5 N"), or
+       None if it is not set."""
+    ref = tiff.get_ascii(gps_ifd, ref_tag)
+    value = tiff.get_rationals(gps_ifd, tag)
+    if not ref or not value:
+        return None
+    degrees = value[0]
+    if len(value) > 1:
+        degrees += value[1] / 60.0
+    if len(value) > 2:
+        degrees += value[2] / 3600.0
+    return '%.6f %s' % (degrees, ref.strip())
+
+
+def parse_exif(segment_data):
+    """Extracts the date and location from an EXIF segment.
+
+    Args:
+        segment_data: APP1 segment data, starting with the EXIF signature.
+    Returns:
+        (date_time_original, gps_latitude, gps_longitude) as strings in
+        exiftool format, or None for missing values.
+    """
+    tiff = TiffData(segment_data[len(EXIF_SIGNATURE):])
+    ifd0 = tiff.read_ifd(tiff.ifd0_offset)
+    date_time_original = None
+    exif_ifd = tiff.get_sub_ifd(ifd0, TAG_EXIF_IFD)
+    if exif_ifd:
+        date_time_original = tiff.get_ascii(exif_ifd, TAG_DATE_TIME_ORIGINAL)
+    latitude = None
+    longitude = None
+    gps_ifd = tiff.get_sub_ifd(ifd0, TAG_GPS_IFD)
+    if gps_ifd:
+        latitude = _get_gps_coordinate(tiff, gps_ifd, TAG_GPS_LATITUDE,
+                                       TAG_GPS_LATITUDE_REF)
+        longitude = _get_gps_coordinate(tiff, gps_ifd, TAG_GPS_LONGITUDE,
+                                        TAG_GPS_LONGITUDE_REF)
+    return (date_time_original, latitude, longitude)
+
+
+def read_photoshop_resources(data):
+    """Splits Photoshop image resources into a list of (id, name, data)."""
+    resources = []
+    pos = 0
+    size = len(data)
+    while pos + 12 <= size:
+        if data[pos:pos + 4] != '8BIM':
+            raise MalformedError('bad image resource signature')
+        resource_id = struct.unpack('>H', data[pos + 4:pos + 6])[0]
+        name_length = ord(data[pos + 6])
+        # The name is a Pascal string, padded to an even length.
+        name_size = name_length + 1
+        name_size += name_size % 2
+        name = data[pos + 7:pos + 7 + name_length]
+        pos += 6 + name_size
+        if pos + 4 > size:
+            raise MalformedError('truncated image resource')
+        resource_size = struct.unpack('>L', data[pos:pos + 4])[0]
+        pos += 4
+        if pos + resource_size > size:
+            raise MalformedError('truncated image resource')
+        resources.append((resource_id, name, data[pos:pos + resource_size]))
+        pos += resource_size + resource_size % 2
+    return resources
+
+
+def read_iptc_datasets(data):
+    """Splits IPTC-IIM data into a list of ((record, dataset), value)."""
+    datasets = []
+    pos = 0
+    size = len(data)
+    while pos + 5 <= size:
+        if data[pos] != '\x1c':
+            # Padding at the end of the block.
+            if data[pos:].strip('\x00'):
+                raise MalformedError('bad IPTC tag marker')
+            break
+        record = ord(data[pos + 1])
+        dataset = ord(data[pos + 2])
+        length = struct.unpack('>H', data[pos + 3:pos + 5])[0]
+        if length & 0x8000:
+            raise MalformedError('extended IPTC datasets not supported')
+        pos += 5
+        if pos + length > size:
+            raise MalformedError('truncated IPTC dataset')
+        datasets.append(((record, dataset), data[pos:pos + length]))
+        pos += length
+    return datasets
+
+
+def decode_iptc_datasets(datasets):
+    """Extracts keywords and caption from IPTC datasets.
+
+    Returns:
+        (keywords, caption) tuple, with caption None if not set.
+    """
+    encoding = 'latin-1'
+    for tag, value in datasets:
+        if tag == IPTC_CODED_CHARACTER_SET and value == IPTC_UTF8:
+            encoding = 'utf-8'
+    keywords = []
+    caption = None
+    for tag, value in datasets:
+        if tag == IPTC_KEYWORDS:
+            keywords.append(value.decode(encoding, 'replace'))
+        elif tag == IPTC_CAPTION:
+            caption = value.decode(encoding, 'replace')
+    return (keywords, caption)
+
+
+class XmpReader(object):
+    """Extracts the XMP properties Phoshare compares from an XMP packet:
+       xmp:Rating, and the person names and rectangles of Microsoft Photo
+       regions. Properties can be stored as attributes or as elements."""
+
+    def __init__(self):
+        self.rating = None
+        self.region_rectangles = []
+        self.region_names = []
+        self.has_gps = False
+        self._text = None
+
+    def parse(self, packet):
+        """Parses an XMP packet.
+
+        Raises:
+            MalformedError: if the packet is not well-formed XML.
+        """
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._character_data
+        try:
+            parser.Parse(packet, True)
+        except (expat.ExpatError, ValueError), ex:
+            # Invalid UTF-8 in names raises UnicodeDecodeError.
+            raise MalformedError(str(ex))
+        return self
+
+    def _set_property(self, name, value):
+        if name == NS_XMP + ' Rating':
+            self.rating = value
+        elif name == NS_MP_REGION + ' Rectangle':
+            self.region_rectangles.append(value)
+        elif name == NS_MP_REGION + ' PersonDisplayName':
+            self.region_names.append(value)
+        elif name in (NS_EXIF + ' GPSLatitude', NS_EXIF + ' GPSLongitude'):
+            self.has_gps = True
+
+    def _start_element(self, name, attributes):
+        for attribute, value in attributes.items():
+            self._set_property(attribute, value)
+        self._text = []
+
+    def _end_element(self, name):
+        if self._text is not None:
+            self._set_property(name, u''.join(self._text))
+        self._text = None
+
+    def _character_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+
+def _parse_date(value, image_file):
+    """Converts an EXIF date string into a datetime, or returns None."""
+    if not value or not value.strip():
+        return None
+    try:
+        date_time = time.strptime(value, '%Y:%m:%d %H:%M:%S')
+        return datetime.datetime(date_time.tm_year, date_time.tm_mon,
+                                 date_time.tm_mday, date_time.tm_hour,
+                                 date_time.tm_min, date_time.tm_sec)
+    except ValueError:
+        su.perr('Invalid date %s in %s - ignoring.' % (value, image_file))
+        return None
+
+
+def parse_metadata(data, image_file):
+    """Extracts metadata from the contents of a JPEG file.
+
+    Args:
+        data: string or mmap with the contents of the JPEG file.
+        image_file: name of the file for error messages.
+    Returns:
+        (keywords, caption, date_time_original, rating, gps,
+        region_rectangles, region_names) tuple, like
+        exiftool.get_iptc_data().
+    Raises:
+        MalformedError: if the metadata cannot be parsed, or uses features that
+            we don't support.
+    """
+    segments = read_segments(data)[0]
+    exif = None
+    xmp = None
+    photoshop = []
+    for marker, start, end in segments:
+        kind = _get_segment_kind(data, marker, start)
+        if kind == _EXIF:
+            if exif is None:
+                exif = parse_exif(data[start + 4:end])
+        elif kind == _XMP:
+            if xmp is not None:
+                raise MalformedError('more than one XMP segment')
+            xmp = XmpReader().parse(data[start + 4 + len(XMP_SIGNATURE):end])
+        elif kind == _XMP_EXTENSION:
+            raise MalformedError('extended XMP not supported')
+        elif kind == _PHOTOSHOP:
+            photoshop.append(data[start + 4 + len(PHOTOSHOP_SIGNATURE):end])
+
+    keywords = []
+    caption = None
+    if photoshop:
+        datasets = []
+        for resource_id, _name, resource_data in read_photoshop_resources(
+            ''.join(photoshop)):
+            if resource_id == IPTC_RESOURCE_ID:
+                datasets.extend(read_iptc_datasets(resource_data))
+        keywords, caption = decode_iptc_datasets(datasets)
+
+    date_time_original = None
+    gps = None
+    if exif:
+        date_time_original = _parse_date(exif[0], image_file)
+        if exif[1] and exif[2]:
+            gps = imageutils.GpsLocation().from_composite(exif[1], exif[2])
+
+    rating = 0
+    region_rectangles = []
+    region_names = []
+    if xmp:
+        if xmp.has_gps and not gps:
+            # exiftool would derive the location from the XMP data.
+            raise MalformedError('XMP GPS data not supported')
+        if xmp.rating is not None:
+            try:
+                rating = int(xmp.rating)
+            except ValueError:
+                raise MalformedError('bad rating %s' % (xmp.rating))
+        try:
+            for string_rectangle in xmp.region_rectangles:
+                region_rectangles.append(
+                    [float(c) for c in string_rectangle.split(',')])
+        except ValueError:
+            raise MalformedError('bad region rectangle')
+        region_names = xmp.region_names
+
+    return (keywords, caption, date_time_original, rating, gps,
+            region_rectangles, region_names)
+
+
+def read_iptc_data(image_file):
+    """Reads caption, keywords, date, rating, GPS and face regions from a JPEG
+       file.
+
+    Returns:
+        The same tuple as exiftool.get_iptc_data(), or None if the file is not
+        a JPEG file that we can parse (use exiftool instead).
+    """
+    if not is_jpeg_file(image_file):
+        return None
+    try:
+        image = open(image_file, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            data = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return None
+        try:
+            return parse_metadata(data, image_file)
+        except (MalformedError, struct.error):
+            return None
+        finally:
+            data.close()
+    finally:
+        image.close()
+
+
+def encode_iptc_datasets(datasets):
+    """Joins a list of ((record, dataset), value) into IPTC-IIM data."""
+    data = []
+    for (record, dataset), value in datasets:
+        if len(value) > 0x7fff:
+            raise MalformedError('IPTC value too long')
+        data.append(struct.pack('>BBBH', 0x1c, record, dataset, len(value)))
+        data.append(value)
+    return ''.join(data)
+
+
+def write_photoshop_resources(resources):
+    """Joins a list of (id, name, data) into Photoshop image resources."""
+    data = []
+    for resource_id, name, value in resources:
+        name_data = chr(len(name)) + name
+        if len(name_data) % 2:
+            name_data += '\x00'
+        data.append('8BIM' + struct.pack('>H', resource_id) + name_data +
+                    struct.pack('>L', len(value)) + value)
+        if len(value) % 2:
+            data.append('\x00')
+    return ''.join(data)
+
+
+def update_iptc_datasets(datasets, new_caption, new_keywords):
+    """Applies caption and keyword changes to a list of IPTC datasets. The
+       result is always encoded in UTF-8.
+
+    Args:
+        datasets: list of ((record, dataset), value).
+        new_caption: new caption, '' to delete it, or None to keep it.
+        new_keywords: new list of keywords, or None to keep them.
+    Returns:
+        New list of datasets, sorted by record and dataset number.
+    """
+    is_utf8 = (IPTC_CODED_CHARACTER_SET, IPTC_UTF8) in datasets
+    result = []
+    for tag, value in datasets:
+        if tag == IPTC_CODED_CHARACTER_SET:
+            continue
+        if tag == IPTC_CAPTION and new_caption is not None:
+            continue
+        if tag == IPTC_KEYWORDS and new_keywords is not None:
+            continue
+        if not is_utf8 and tag[0] == 2 and tag != IPTC_RECORD_VERSION:
+            value = value.decode('latin-1').encode('utf-8')
+        result.append((tag, value))
+    result.append((IPTC_CODED_CHARACTER_SET, IPTC_UTF8))
+    if new_caption:
+        result.append((IPTC_CAPTION,
+                       su.unicode_string(new_caption).encode('utf-8')))
+    for keyword in new_keywords or ():
+        result.append((IPTC_KEYWORDS,
+                       su.unicode_string(keyword).encode('utf-8')))
+    records = [tag for tag, _ in result if tag[0] == 2]
+    if records and IPTC_RECORD_VERSION not in records:
+        result.append((IPTC_RECORD_VERSION, struct.pack('>H', 4)))
+    result.sort(key=lambda dataset: dataset[0])
+    return result
+
+
+def _update_photoshop(photoshop, new_caption, new_keywords):
+    """Applies caption and keyword changes to Photoshop image resources.
+
+    Args:
+        photoshop: Photoshop resource data, or '' if there is none.
+    Returns:
+        New Photoshop resource data.
+    """
+    resources = read_photoshop_resources(photoshop)
+    datasets = []
+    for resource_id, _name, value in resources:
+        if resource_id == IPTC_RESOURCE_ID:
+            datasets.extend(read_iptc_datasets(value))
+    iptc = encode_iptc_datasets(update_iptc_datasets(datasets, new_caption,
+                                                     new_keywords))
+    result = []
+    for resource_id, name, value in resources:
+        if resource_id == IPTC_RESOURCE_ID:
+            if iptc is None:
+                continue
+            value = iptc
+            iptc = None
+        elif resource_id == IPTC_DIGEST_RESOURCE_ID:
+            # Keep the digest valid, so that other applications don't think
+            # the IPTC data was changed behind their back.
+            value = None
+        result.append((resource_id, name, value))
+    if iptc is not None:
+        result.append((IPTC_RESOURCE_ID, '', iptc))
+    iptc = [value for resource_id, _, value in result
+            if resource_id == IPTC_RESOURCE_ID][0]
+    result = [(resource_id, name,
+               hashlib.md5(iptc).digest() if value is None else value)
+              for resource_id, name, value in result]
+    return write_photoshop_resources(result)
+
+
+def _encode_rationals(tiff, value):
+    """Encodes a coordinate in degrees as three TIFF rationals (degrees,
+       minutes, seconds)."""
+    degrees = int(value)
+    minutes = (value - degrees) * 60.0
+    seconds = (minutes - int(minutes)) * 60.0
+    return struct.pack(tiff.endian + '6L', degrees, 1, int(minutes), 1,
+                       int(round(seconds * 10000)), 10000)
+
+
+def _update_exif(segment_data, new_datetime, new_gps):
+    """Applies date and GPS changes to an EXIF segment, and clears the image
+       description. Values are updated in place, so the segment size does not
+       change.
+
+    Args:
+        segment_data: APP1 segment data, starting with the EXIF signature.
+    Returns:
+        New segment data.
+    Raises:
+        MalformedError: if the tags that need to be updated don't exist yet.
+    """
+    header = len(EXIF_SIGNATURE)
+    tiff = TiffData(segment_data[header:])
+    data = bytearray(segment_data)
+
+    def put(offset, value):
+        data[header + offset:header + offset + len(value)] = value
+
+    ifd0 = tiff.read_ifd(tiff.ifd0_offset)
+    entry = ifd0.get(TAG_IMAGE_DESCRIPTION)
+    if entry and entry[0] == TIFF_ASCII:
+        put(entry[2], '\x00' * entry[1])
+    if new_datetime:
+        exif_ifd = tiff.get_sub_ifd(ifd0, TAG_EXIF_IFD)
+        entry = exif_ifd and exif_ifd.get(TAG_DATE_TIME_ORIGINAL)
+        if not entry or entry[0] != TIFF_ASCII or entry[1] != 20:
+            raise MalformedError('no DateTimeOriginal tag')
+        put(entry[2], new_datetime.strftime('%Y:%m:%d %H:%M:%S') + '\x00')
+    if new_gps:
+        gps_ifd = tiff.get_sub_ifd(ifd0, TAG_GPS_IFD)
+        if not gps_ifd:
+            raise MalformedError('no GPS tags')
+        for tag, ref_tag, value, ref in (
+            (TAG_GPS_LATITUDE, TAG_GPS_LATITUDE_REF,
+             abs(new_gps.latitude), new_gps.latitude_ref()),
+            (TAG_GPS_LONGITUDE, TAG_GPS_LONGITUDE_REF,
+             abs(new_gps.longitude), new_gps.longitude_ref())):
+            entry = gps_ifd.get(tag)
+            ref_entry = gps_ifd.get(ref_tag)
+            if (not entry or entry[0] != TIFF_RATIONAL or entry[1] != 3 or
+                not ref_entry or ref_entry[0] != TIFF_ASCII or
+                ref_entry[1] != 2):
+                raise MalformedError('no GPS tags')
+            put(entry[2], _encode_rationals(tiff, value))
+            put(ref_entry[2], ref + '\x00')
+    return str(data)
+
+
+def _encode_xmp_coordinate(value, positive_ref, negative_ref):
+    """Formats a coordinate in degrees as an XMP GPS coordinate
+       ("DDD,MM.mmmmmmmmK")."""
+    ref = positive_ref if value >= 0.0 else negative_ref
+    value = abs(value)
+    degrees = int(value)
+    return '%d,%.8f%s' % (degrees, (value - degrees) * 60.0, ref)
+
+
+def get_xmp_description(rating=None, rectangles=None, persons=None,
+                        caption=None, keywords=None, date=None, gps=None):
+    """Builds an rdf:Description element with Phoshare's XMP properties.
+
+    Args:
+        rating: xmp:Rating value, or None.
+        rectangles: list of face rectangles (x, y, width, height).
+        persons: list of face names, in the same order as rectangles.
+        caption: dc:description value, or None.
+        keywords: list of dc:subject values.
+        date: exif:DateTimeOriginal value (datetime), or None.
+        gps: imageutils.GpsLocation for exif:GPSLatitude/GPSLongitude, or
+            None.
+    Returns:
+        The element as a UTF-8 string, or None if there are no properties.
+    """
+    attributes = [" xmlns:rdf='%s'" % (NS_RDF)]
+    elements = []
+    if caption or keywords:
+        attributes.append(" xmlns:dc='%s'" % (NS_DC))
+    if caption:
+        elements.append(
+            " <dc:description>\n"
+            "  <rdf:Alt>\n"
+            "   <rdf:li xml:lang='x-default'>%s</rdf:li>\n"
+            "  </rdf:Alt>\n"
+            " </dc:description>\n" % (
+                saxutils.escape(su.unicode_string(caption).encode('utf-8'))))
+    if keywords:
+        elements.append(" <dc:subject>\n"
+                        "  <rdf:Bag>\n")
+        for keyword in keywords:
+            elements.append("   <rdf:li>%s</rdf:li>\n" % (saxutils.escape(
+                su.unicode_string(keyword).encode('utf-8'))))
+        elements.append("  </rdf:Bag>\n"
+                        " </dc:subject>\n")
+    if date or gps:
+        attributes.append(" xmlns:exif='%s'" % (NS_EXIF))
+    if date:
+        attributes.append(" exif:DateTimeOriginal='%s'" % (
+            date.strftime('%Y-%m-%dT%H:%M:%S')))
+    if gps:
+        attributes.append(" exif:GPSLatitude='%s' exif:GPSLongitude='%s'" % (
+            _encode_xmp_coordinate(gps.latitude, 'N', 'S'),
+            _encode_xmp_coordinate(gps.longitude, 'E', 'W')))
+    if rating is not None:
+        attributes.append(" xmlns:xmp='%s' xmp:Rating='%d'" % (NS_XMP,
+                                                                rating))
+    rectangles = rectangles or []
+    persons = persons or []
+    if rectangles or persons:
+        attributes.append(" xmlns:MP='%s' xmlns:MPRI='%s' xmlns:MPReg='%s'" % (
+            NS_MP, NS_MP_REGION_INFO, NS_MP_REGION))
+        elements.append(" <MP:RegionInfo rdf:parseType='Resource'>\n"
+                        "  <MPRI:Regions>\n"
+                        "   <rdf:Bag>\n")
+        for i in xrange(max(len(rectangles), len(persons))):
+            elements.append("    <rdf:li rdf:parseType='Resource'>\n")
+            if i < len(rectangles):
+                elements.append(
+                    "     <MPReg:Rectangle>%s</MPReg:Rectangle>\n" % (
+                        ','.join(str(c) for c in rectangles[i])))
+            if i < len(persons):
+                elements.append(
+                    "     <MPReg:PersonDisplayName>%s"
+                    "</MPReg:PersonDisplayName>\n" % (saxutils.escape(
+                        su.unicode_string(persons[i]).encode('utf-8'))))
+            elements.append("    </rdf:li>\n")
+        elements.append("   </rdf:Bag>\n"
+                        "  </MPRI:Regions>\n"
+                        " </MP:RegionInfo>\n")
+    if len(attributes) == 1:
+        return None
+    return "<rdf:Description rdf:about=''%s>\n%s</rdf:Description>" % (
+        ''.join(attributes), ''.join(elements))
+
+
+def make_xmp_packet(descriptions):
+    """Wraps a list of rdf:Description elements into an XMP packet."""
+    return _XMP_PACKET_HEADER + '\n'.join(descriptions) + _XMP_PACKET_TRAILER
+
+
+def _is_empty_description(description):
+    """Tests if an rdf:Description element has no properties."""
+    for attribute in description.attributes.values():
+        if (attribute.namespaceURI != _NS_XMLNS and
+            (attribute.namespaceURI, attribute.localName) != (NS_RDF,
+                                                              'about')):
+            return False
+    for child in description.childNodes:
+        if child.nodeType == child.ELEMENT_NODE:
+            return False
+    return True
+
+
+def update_xmp_packet(packet, new_rating, new_rectangles, new_persons):
+    """Applies rating and face region changes to an XMP packet, and removes
+       dc:subject and dc:description (we use the IPTC keywords and caption).
+
+    Args:
+        packet: existing XMP packet, or None.
+        new_rating: new rating, or -1 to keep it.
+        new_rectangles: new face rectangles, or None to keep them.
+        new_persons: new face names, or None to keep them.
+    Returns:
+        The new packet (packet itself if nothing changed), or None if there
+        is no XMP data.
+    """
+    remove = set([(NS_DC, 'subject'), (NS_DC, 'description')])
+    if new_rating >= 0:
+        remove.add((NS_XMP, 'Rating'))
+    else:
+        new_rating = None
+    if new_rectangles is not None or new_persons is not None:
+        remove.add((NS_MP, 'RegionInfo'))
+    new_description = get_xmp_description(new_rating, new_rectangles,
+                                          new_persons)
+    if packet is None:
+        if new_description is None:
+            return None
+        return make_xmp_packet([new_description])
+
+    try:
+        document = minidom.parseString(packet)
+    except expat.ExpatError, ex:
+        raise MalformedError(str(ex))
+    rdf_elements = document.getElementsByTagNameNS(NS_RDF, 'RDF')
+    if len(rdf_elements) != 1:
+        raise MalformedError('expected one rdf:RDF element')
+    rdf = rdf_elements[0]
+    changed = False
+    for description in rdf.getElementsByTagNameNS(NS_RDF, 'Description'):
+        if description.parentNode is not rdf:
+            continue
+        removed = False
+        for attribute in description.attributes.values():
+            if (attribute.namespaceURI, attribute.localName) in remove:
+                description.removeAttributeNode(attribute)
+                removed = True
+        for child in description.childNodes[:]:
+            if (child.nodeType == child.ELEMENT_NODE and
+                (child.namespaceURI, child.localName) in remove):
+                description.removeChild(child).unlink()
+                removed = True
+        if removed:
+            changed = True
+            if _is_empty_description(description):
+                rdf.removeChild(description).unlink()
+    if new_description:
+        new_element = minidom.parseString(new_description).documentElement
+        rdf.appendChild(document.importNode(new_element, True))
+        changed = True
+    if not changed:
+        return packet
+    result = '\n'.join([node.toxml('utf-8') for node in document.childNodes])
+    document.unlink()
+    return result
+
+
+def _make_segment(marker, data):
+    """Builds a marker segment."""
+    if len(data) > _MAX_SEGMENT_DATA:
+        raise MalformedError('segment too large')
+    return struct.pack('>BBH', 0xff, marker, len(data) + 2) + data
+
+
+def write_metadata(source, target, new_caption, new_keywords, new_datetime,
+                   new_rating, new_gps, new_rectangles, new_persons):
+    """Writes a copy of a JPEG file with updated metadata. Only the APP1 and
+       APP13 segments are regenerated, the image data is copied unchanged.
+       Makes the same changes as exiftool.update_iptcdata().
+
+    Args:
+        source: path to the JPEG file to read.
+        target: path of the file to write; can be the same as source. The file
+            is replaced atomically, and gets the permissions and modification
+            time of the source file.
+        new_caption, new_keywords, new_datetime, new_rating, new_gps,
+        new_rectangles, new_persons: changes, see exiftool.update_iptcdata().
+    Raises:
+        MalformedError: if the file cannot be updated without exiftool.
+        EnvironmentError: if reading or writing failed.
+    """
+    image = open(source, 'rb')
+    try:
+        try:
+            data = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError, ex:
+            raise MalformedError(str(ex))
+        try:
+            _write_metadata(data, source, target, new_caption, new_keywords,
+                            new_datetime, new_rating, new_gps, new_rectangles,
+                            new_persons)
+        finally:
+            data.close()
+    finally:
+        image.close()
+
+
+def _write_metadata(data, source, target, new_caption, new_keywords,
+                    new_datetime, new_rating, new_gps, new_rectangles,
+                    new_persons):
+    """Implements write_metadata() for the mapped source file data."""
+    segments, image_start = read_segments(data)
+    new_segments = []
+    # New segments go after the leading APPn segments.
+    insert_index = None
+    exif_done = False
+    xmp_index = None
+    xmp_packet = None
+    photoshop_index = None
+    photoshop = []
+    for marker, start, end in segments:
+        if insert_index is None and not 0xe0 <= marker <= 0xef:
+            insert_index = len(new_segments)
+        kind = _get_segment_kind(data, marker, start)
+        if kind == _EXIF and not exif_done:
+            new_segments.append(_make_segment(
+                APP1, _update_exif(data[start + 4:end], new_datetime,
+                                   new_gps)))
+            exif_done = True
+        elif kind == _XMP:
+            if xmp_index is not None:
+                raise MalformedError('more than one XMP segment')
+            xmp_index = len(new_segments)
+            xmp_packet = data[start + 4 + len(XMP_SIGNATURE):end]
+            new_segments.append('')
+        elif kind == _XMP_EXTENSION:
+            raise MalformedError('extended XMP not supported')
+        elif kind == _PHOTOSHOP:
+            if photoshop_index is None:
+                photoshop_index = len(new_segments)
+                new_segments.append('')
+            photoshop.append(data[start + 4 + len(PHOTOSHOP_SIGNATURE):end])
+        else:
+            new_segments.append(data[start:end])
+    if insert_index is None:
+        insert_index = len(new_segments)
+    if (new_datetime or new_gps) and not exif_done:
+        raise MalformedError('no EXIF data')
+
+    photoshop_segment = _make_segment(
+        APP13, PHOTOSHOP_SIGNATURE + _update_photoshop(
+            ''.join(photoshop), new_caption, new_keywords))
+    if photoshop_index is None:
+        new_segments.insert(insert_index, photoshop_segment)
+    else:
+        new_segments[photoshop_index] = photoshop_segment
+    new_packet = update_xmp_packet(xmp_packet, new_rating, new_rectangles,
+                                   new_persons)
+    if new_packet is not None:
+        xmp_segment = _make_segment(APP1, XMP_SIGNATURE + new_packet)
+        if xmp_index is None:
+            new_segments.insert(insert_index, xmp_segment)
+        else:
+            new_segments[xmp_index] = xmp_segment
+
+    source_stat = os.stat(source)
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix='.phoshare-', suffix='.tmp',
+                                        dir=os.path.dirname(target))
+    try:
+        output = os.fdopen(tmp_fd, 'wb')
+        try:
+            output.write('\xff\xd8')
+            output.write(''.join(new_segments))
+            for pos in xrange(image_start, len(data), _COPY_BUFFER_SIZE):
+                output.write(data[pos:min(pos + _COPY_BUFFER_SIZE,
+                                          len(data))])
+        finally:
+            output.close()
+        shutil.copymode(source, tmp_path)
+        os.utime(tmp_path, (source_stat.st_atime, source_stat.st_mtime))
+        os.rename(tmp_path, target)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def update_metadata(image_file, new_caption, new_keywords, new_datetime,
+                    new_rating, new_gps, new_rectangles, new_persons):
+    """Updates the metadata of a JPEG file in-process. Takes the same
+       arguments as exiftool.update_iptcdata().
+
+    Returns:
+        True if the file was updated, False if the update failed, or None if
+        the file needs to be updated with exiftool.
+    """
+    if not is_jpeg_file(image_file):
+        return None
+    try:
+        write_metadata(image_file, image_file, new_caption, new_keywords,
+                       new_datetime, new_rating, new_gps, new_rectangles,
+                       new_persons)
+        return True
+    except (MalformedError, struct.error):
+        return None
+    except EnvironmentError, ex:
+        su.perr("Failed to update IPTC data in image %s: %s" % (
+            image_file, ex))
+        return False
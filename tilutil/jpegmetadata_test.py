@@ -0,0 +1,244 @@
+"""This module tests jpegmetadata.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import tilutil.imageutils as imageutils
+import tilutil.jpegmetadata as jpegmetadata
+
+# Entropy coded image data stand-in: SOS segment, some data, EOI.
+_IMAGE_DATA = '\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00' + 'x' * 100 + (
+    '\xff\xd9')
+
+_XMP = """<?xpacket begin='\xef\xbb\xbf' id='W5M0MpCehiHzreSzNTczkc9d'?>
+<x:xmpmeta xmlns:x='adobe:ns:meta/'>
+<rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>
+ <rdf:Description rdf:about=''
+  xmlns:xmp='http://ns.adobe.com/xap/1.0/' xmp:Rating='4'/>
+ <rdf:Description rdf:about=''
+  xmlns:MP='http://ns.microsoft.com/photo/1.2/'
+  xmlns:MPRI='http://ns.microsoft.com/photo/1.2/t/RegionInfo#'
+  xmlns:MPReg='http://ns.microsoft.com/photo/1.2/t/Region#'>
+  <MP:RegionInfo rdf:parseType='Resource'>
+   <MPRI:Regions>
+    <rdf:Bag>
+     <rdf:li MPReg:PersonDisplayName='Jane'
+       MPReg:Rectangle='0.1, 0.2, 0.3, 0.4'/>
+     <rdf:li rdf:parseType='Resource'>
+      <MPReg:PersonDisplayName>John</MPReg:PersonDisplayName>
+      <MPReg:Rectangle>0.5, 0.5, 0.25, 0.25</MPReg:Rectangle>
+     </rdf:li>
+    </rdf:Bag>
+   </MPRI:Regions>
+  </MP:RegionInfo>
+ </rdf:Description>
+</rdf:RDF>
+</x:xmpmeta>
+<?xpacket end='w'?>"""
+
+def _segment(marker, data):
+    """Builds a JPEG marker segment."""
+    return struct.pack('>BBH', 0xff, marker, len(data) + 2) + data
+
+def _ifd(entries, offset, next_ifd=0):
+    """Builds a big endian TIFF IFD at offset.
+
+    Args:
+        entries: list of (tag, type, count, value data).
+    Returns:
+        IFD data, including values that don't fit into the entries.
+    """
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    ifd = struct.pack('>H', len(entries))
+    extra = ''
+    for tag, field_type, count, value in entries:
+        if len(value) > 4:
+            ifd += struct.pack('>HHLL', tag, field_type, count,
+                               data_offset + len(extra))
+            extra += value
+        else:
+            ifd += struct.pack('>HHL', tag, field_type, count) + value.ljust(
+                4, '\x00')
+    return ifd + struct.pack('>L', next_ifd) + extra
+
+def _exif():
+    """Builds an EXIF segment with a date and a GPS location."""
+    exif_ifd = _ifd([(0x9003, 2, 20, '2010:05:06 07:08:09\x00')], 100)
+    gps_ifd = _ifd([(1, 2, 2, 'S\x00'),
+                    (2, 5, 3, struct.pack('>6L', 37, 1, 30, 1, 36, 1)),
+                    (3, 2, 2, 'W\x00'),
+                    (4, 5, 3, struct.pack('>6L', 122, 1, 15, 1, 0, 1))], 200)
+    ifd0 = _ifd([(0x8769, 4, 1, struct.pack('>L', 100)),
+                 (0x8825, 4, 1, struct.pack('>L', 200))], 8)
+    tiff = 'MM\x00\x2a' + struct.pack('>L', 8) + ifd0
+    tiff = tiff.ljust(100, '\x00') + exif_ifd
+    tiff = tiff.ljust(200, '\x00') + gps_ifd
+    return jpegmetadata.EXIF_SIGNATURE + tiff
+
+def _photoshop(datasets):
+    """Builds an APP13 segment with IPTC datasets."""
+    iptc = ''
+    for (record, dataset), value in datasets:
+        iptc += struct.pack('>BBBH', 0x1c, record, dataset, len(value)) + value
+    resource = '8BIM' + struct.pack('>H', 0x0404) + '\x00\x00' + struct.pack(
+        '>L', len(iptc)) + iptc
+    if len(iptc) % 2:
+        resource += '\x00'
+    return jpegmetadata.PHOTOSHOP_SIGNATURE + resource
+
+def make_jpeg(segments):
+    """Builds the contents of a JPEG file with the given segments."""
+    return '\xff\xd8' + ''.join(segments) + _IMAGE_DATA
+
+
+class JpegMetadataTest(unittest.TestCase):
+    """Unit tests for jpegmetadata.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, data):
+        path = os.path.join(self.folder, name)
+        image = open(path, 'wb')
+        image.write(data)
+        image.close()
+        return path
+
+    def test_read_iptc_data(self):
+        """Tests jpegmetadata.read_iptc_data."""
+        path = self._write('test.jpg', make_jpeg([
+            _segment(0xe0, 'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'),
+            _segment(jpegmetadata.APP1, _exif()),
+            _segment(jpegmetadata.APP1, jpegmetadata.XMP_SIGNATURE + _XMP),
+            _segment(jpegmetadata.APP13, _photoshop([
+                ((1, 90), '\x1b%G'),
+                ((2, 25), 'one'),
+                ((2, 25), 'caf\xc3\xa9'),
+                ((2, 120), 'A caption')]))]))
+        (keywords, caption, date, rating, gps, rectangles,
+         names) = jpegmetadata.read_iptc_data(path)
+        self.assertEquals([u'one', u'caf\xe9'], keywords)
+        self.assertEquals(u'A caption', caption)
+        self.assertEquals(datetime.datetime(2010, 5, 6, 7, 8, 9), date)
+        self.assertEquals(4, rating)
+        self.assertEquals('(-37.510000, -122.250000)', gps.to_string())
+        self.assertEquals([[0.1, 0.2, 0.3, 0.4], [0.5, 0.5, 0.25, 0.25]],
+                          rectangles)
+        self.assertEquals([u'Jane', u'John'], names)
+
+    def test_read_iptc_data_latin1(self):
+        """Tests that IPTC data without a character set is read as Latin-1."""
+        path = self._write('test.jpg', make_jpeg([
+            _segment(jpegmetadata.APP13, _photoshop([
+                ((2, 120), 'caf\xe9')]))]))
+        self.assertEquals(([], u'caf\xe9', None, 0, None, [], []),
+                          jpegmetadata.read_iptc_data(path))
+
+    def test_read_iptc_data_unsupported(self):
+        """Tests that files we can't parse are reported as None."""
+        self.assertEquals(None, jpegmetadata.read_iptc_data(
+            self._write('test.nef', make_jpeg([]))))
+        self.assertEquals(None, jpegmetadata.read_iptc_data(
+            self._write('empty.jpg', '')))
+        self.assertEquals(None, jpegmetadata.read_iptc_data(
+            self._write('bad.jpg', '\xff\xd8\xff\xe1\x01\x00Exif')))
+        self.assertEquals(None, jpegmetadata.read_iptc_data(
+            os.path.join(self.folder, 'missing.jpg')))
+        # Invalid UTF-8 in an element name.
+        xmp = _XMP.replace('<x:xmpmeta', '<x\xdbxmpmeta', 1)
+        self.assertEquals(None, jpegmetadata.read_iptc_data(
+            self._write('bad_xmp.jpg', make_jpeg([
+                _segment(jpegmetadata.APP1,
+                         jpegmetadata.XMP_SIGNATURE + xmp)]))))
+
+    def test_update_metadata(self):
+        """Tests that jpegmetadata.update_metadata changes can be read back."""
+        path = self._write('test.jpg', make_jpeg([
+            _segment(0xe0, 'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'),
+            _segment(jpegmetadata.APP1, _exif()),
+            _segment(jpegmetadata.APP1, jpegmetadata.XMP_SIGNATURE + _XMP),
+            _segment(jpegmetadata.APP13, _photoshop([
+                ((2, 25), 'old'),
+                ((2, 120), 'caf\xe9')]))]))
+        os.utime(path, (1000000000, 1000000000))
+        self.assertTrue(jpegmetadata.update_metadata(
+            path, None, [u'new', u'caf\xe9'],
+            datetime.datetime(2011, 1, 2, 3, 4, 5), 2,
+            imageutils.GpsLocation(48.8584, 2.2945), [[0.1, 0.1, 0.2, 0.2]],
+            [u'Ren\xe9']))
+        self.assertEquals(1000000000, int(os.path.getmtime(path)))
+        data = open(path, 'rb').read()
+        self.assertTrue(data.endswith(_IMAGE_DATA))
+        (keywords, caption, date, rating, gps, rectangles,
+         names) = jpegmetadata.read_iptc_data(path)
+        self.assertEquals([u'new', u'caf\xe9'], keywords)
+        self.assertEquals(u'caf\xe9', caption)
+        self.assertEquals(datetime.datetime(2011, 1, 2, 3, 4, 5), date)
+        self.assertEquals(2, rating)
+        self.assertEquals('(48.858400, 2.294500)', gps.to_string())
+        self.assertEquals([[0.1, 0.1, 0.2, 0.2]], rectangles)
+        self.assertEquals([u'Ren\xe9'], names)
+        self.assertEquals([], [name for name in os.listdir(self.folder)
+                               if name != 'test.jpg'])
+
+    def test_update_metadata_new_segments(self):
+        """Tests that missing APP13 and XMP segments are created."""
+        path = self._write('test.jpg', make_jpeg([
+            _segment(0xe0, 'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'),
+            _segment(0xdb, '\x00' * 65)]))
+        self.assertTrue(jpegmetadata.update_metadata(
+            path, u'A caption', [u'one'], None, 3, None, None, None))
+        self.assertEquals(([u'one'], u'A caption', None, 3, None, [], []),
+                          jpegmetadata.read_iptc_data(path))
+        segments, _ = jpegmetadata.read_segments(open(path, 'rb').read())
+        self.assertEquals([0xe0, jpegmetadata.APP1, jpegmetadata.APP13, 0xdb],
+                          [segment[0] for segment in segments])
+
+    def test_write_metadata_copy(self):
+        """Tests that jpegmetadata.write_metadata can write a tagged copy."""
+        data = make_jpeg([_segment(jpegmetadata.APP1, _exif())])
+        source = self._write('source.jpg', data)
+        target = os.path.join(self.folder, 'target.jpg')
+        jpegmetadata.write_metadata(source, target, u'A caption', None, None,
+                                    -1, None, None, None)
+        self.assertEquals(data, open(source, 'rb').read())
+        self.assertEquals(u'A caption',
+                          jpegmetadata.read_iptc_data(target)[1])
+        self.assertEquals(int(os.path.getmtime(source)),
+                          int(os.path.getmtime(target)))
+
+    def test_update_metadata_unsupported(self):
+        """Tests that updates we can't do natively are reported as None."""
+        data = make_jpeg([_segment(jpegmetadata.APP13, _photoshop([]))])
+        path = self._write('test.jpg', data)
+        self.assertEquals(None, jpegmetadata.update_metadata(
+            path, None, None, datetime.datetime(2011, 1, 2), -1, None, None,
+            None))
+        self.assertEquals(data, open(path, 'rb').read())
+        self.assertEquals(None, jpegmetadata.update_metadata(
+            self._write('test.nef', data), u'A caption', None, None, -1, None,
+            None, None))
+
+if __name__ == '__main__':
+    unittest.main()
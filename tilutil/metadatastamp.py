@@ -0,0 +1,122 @@
+"""Remembers a fingerprint of the metadata last written into a file.
+
+The fingerprint is stored in the user.phoshare.meta extended attribute of the
+file, or in a hidden sidecar file next to it on file systems that don't
+support extended attributes (or if the xattr module is not installed). The
+stored value includes the size and modification time of the file, so that a
+stamp becomes invalid when the file is changed by something else.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+
+try:
+    import xattr
+except ImportError:
+    xattr = None
+
+ATTRIBUTE_NAME = 'user.phoshare.meta'
+
+_SIDECAR_SUFFIX = '.phoshare-meta'
+
+_logger = logging.getLogger('google.metadatastamp')
+
+
+def get_sidecar_path(path):
+    """Returns the path of the hidden sidecar file for a file."""
+    folder, name = os.path.split(path)
+    return os.path.join(folder, '.' + name + _SIDECAR_SUFFIX)
+
+
+def _make_value(fingerprint, stat):
+    """Combines a fingerprint with the size and time stamp of a file."""
+    return '%s %d %d' % (fingerprint, stat.st_size, int(stat.st_mtime))
+
+
+def _read_value(path):
+    """Reads the stored value of a file, or returns None."""
+    if xattr:
+        try:
+            return xattr.getxattr(path, ATTRIBUTE_NAME)
+        except (IOError, OSError):
+            # Attribute not set, or not supported by the file system.
+            pass
+    try:
+        sidecar = open(get_sidecar_path(path), 'rb')
+        try:
+            return sidecar.read()
+        finally:
+            sidecar.close()
+    except IOError:
+        return None
+
+
+def read_stamp(path):
+    """Returns the fingerprint stored for a file, or None if there is none or
+       if the file was changed since the fingerprint was stored."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    value = _read_value(path)
+    if not value:
+        return None
+    fingerprint = value.split(' ', 1)[0]
+    if value != _make_value(fingerprint, stat):
+        return None
+    return fingerprint
+
+
+def write_stamp(path, fingerprint):
+    """Stores a fingerprint for a file.
+
+    Returns:
+        True if the fingerprint was stored.
+    """
+    try:
+        value = _make_value(fingerprint, os.stat(path))
+    except OSError, ex:
+        _logger.debug(u'Cannot stamp %s: %s', path, ex)
+        return False
+    if xattr:
+        try:
+            xattr.setxattr(path, ATTRIBUTE_NAME, value)
+            remove_sidecar(path)
+            return True
+        except (IOError, OSError), ex:
+            _logger.debug(u'Cannot set %s on %s: %s', ATTRIBUTE_NAME, path,
+                          ex)
+    try:
+        sidecar = open(get_sidecar_path(path), 'wb')
+        try:
+            sidecar.write(value)
+        finally:
+            sidecar.close()
+        return True
+    except IOError, ex:
+        _logger.debug(u'Cannot write stamp for %s: %s', path, ex)
+        return False
+
+
+def remove_sidecar(path):
+    """Removes the sidecar file of a file, if there is one."""
+    sidecar_path = get_sidecar_path(path)
+    if os.path.exists(sidecar_path):
+        try:
+            os.remove(sidecar_path)
+        except OSError, ex:
+            _logger.debug(u'Cannot remove %s: %s', sidecar_path, ex)
@@ -0,0 +1,65 @@
+"""This module tests metadatastamp.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tilutil.metadatastamp as metadatastamp
+
+class MetadataStampTest(unittest.TestCase):
+    """Unit tests for metadatastamp.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'test.jpg')
+        self._write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, data):
+        image = open(self.path, 'wb')
+        image.write(data)
+        image.close()
+
+    def test_stamp(self):
+        """Tests reading and writing stamps."""
+        self.assertEquals(None, metadatastamp.read_stamp(self.path))
+        self.assertTrue(metadatastamp.write_stamp(self.path, 'abc'))
+        self.assertEquals('abc', metadatastamp.read_stamp(self.path))
+        self.assertTrue(metadatastamp.write_stamp(self.path, 'def'))
+        self.assertEquals('def', metadatastamp.read_stamp(self.path))
+
+    def test_stamp_invalidated(self):
+        """Tests that a stamp is ignored after the file changed."""
+        os.utime(self.path, (1000000000, 1000000000))
+        metadatastamp.write_stamp(self.path, 'abc')
+        self._write('changed')
+        os.utime(self.path, (1000000000, 1000000000))
+        self.assertEquals(None, metadatastamp.read_stamp(self.path))
+
+    def test_remove_sidecar(self):
+        """Tests that removing the sidecar file forgets the stamp."""
+        metadatastamp.write_stamp(self.path, 'abc')
+        metadatastamp.remove_sidecar(self.path)
+        if not metadatastamp.xattr:
+            self.assertEquals(None, metadatastamp.read_stamp(self.path))
+        self.assertEquals(['test.jpg'], os.listdir(self.folder))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+"""Perceptual hashes of images, for finding images that look alike.
+
+An image is reduced to 32x32 gray pixels, and transformed with a DCT. The
+hash has one bit for each of the 8x8 lowest frequencies (without the
+average), set if the coefficient is above the median. Small edits, scaling
+and recompression change only a few bits, so similar images have hashes
+with a small Hamming distance.
+
+Images are decoded with "sips", many files per call, and the hashes of a
+batch are computed with NumPy array operations. Requires NumPy; if it is not
+installed, numpy is None in this module.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import math
+import os
+import shutil
+import struct
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import tilutil.systemutils as su
+
+_SIPS_TOOL = u"sips"
+
+# Images are reduced to _SIZE x _SIZE pixels, and the hash uses the lowest
+# _HASH_SIZE x _HASH_SIZE frequencies.
+_SIZE = 32
+_HASH_SIZE = 8
+
+# Number of files converted by one sips call.
+_BATCH_SIZE = 200
+
+class _NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+_logger = logging.getLogger('google.phash')
+_logger.addHandler(_NullHandler())
+
+
+def _get_dct_matrix(size):
+    """Returns the orthonormal DCT-II matrix of a size."""
+    matrix = numpy.zeros((size, size))
+    for k in range(size):
+        scale = math.sqrt((1.0 if k == 0 else 2.0) / size)
+        for n in range(size):
+            matrix[k, n] = scale * math.cos(math.pi * (2 * n + 1) * k /
+                                            (2.0 * size))
+    return matrix
+
+
+def hash_pixels(pixels):
+    """Computes the perceptual hashes of a stack of gray images.
+
+    Args:
+      pixels: array of shape (images, 32, 32).
+    Returns:
+      list of hashes (64 bit ints).
+    """
+    dct = _get_dct_matrix(_SIZE)
+    # D . X . D^T for every image at once.
+    coefficients = numpy.matmul(numpy.matmul(dct, pixels), dct.T)
+    low = coefficients[:, :_HASH_SIZE, :_HASH_SIZE].reshape(
+        len(pixels), _HASH_SIZE * _HASH_SIZE)
+    # The first coefficient is the average brightness; leave it out of the
+    # median.
+    medians = numpy.median(low[:, 1:], axis=1)
+    bits = low > medians[:, numpy.newaxis]
+    weights = numpy.left_shift(numpy.uint64(1),
+                               numpy.arange(63, -1, -1, dtype=numpy.uint64))
+    return [int(value) for value in
+            numpy.bitwise_or.reduce(numpy.where(bits, weights,
+                                                numpy.uint64(0)), axis=1)]
+
+
+def read_bmp(data):
+    """Reads an uncompressed 24 or 32 bit BMP file (as written by sips) into
+       an array of gray values, top row first."""
+    if data[:2] != 'BM':
+        raise ValueError('Not a BMP file')
+    offset = struct.unpack('<I', data[10:14])[0]
+    width, height = struct.unpack('<ii', data[18:26])
+    bits = struct.unpack('<H', data[28:30])[0]
+    if bits not in (24, 32):
+        raise ValueError('Unsupported BMP with %d bits per pixel' % (bits))
+    channels = bits // 8
+    row_size = (width * channels + 3) & ~3
+    rows = numpy.frombuffer(data, dtype=numpy.uint8, offset=offset,
+                            count=row_size * abs(height))
+    rows = rows.reshape(abs(height), row_size)[:, :width * channels]
+    pixels = rows.reshape(abs(height), width, channels).astype(numpy.float64)
+    # Pixels are stored as blue, green, red.
+    gray = (0.114 * pixels[:, :, 0] + 0.587 * pixels[:, :, 1] +
+            0.299 * pixels[:, :, 2])
+    if height > 0:
+        # Bottom row first.
+        gray = gray[::-1]
+    return gray
+
+
+def _convert_batch(paths, folder):
+    """Converts images to _SIZE x _SIZE BMP files with a single sips call.
+       Returns a map from path to gray pixel array for the images that could
+       be converted."""
+    in_folder = os.path.join(folder, 'in')
+    out_folder = os.path.join(folder, 'out')
+    os.mkdir(in_folder)
+    os.mkdir(out_folder)
+    try:
+        names = {}
+        for i, path in enumerate(paths):
+            # Links with unique names, as thumbnails in different folders
+            # can have the same name.
+            name = '%06d%s' % (i, os.path.splitext(path)[1])
+            os.symlink(os.path.abspath(path), os.path.join(in_folder, name))
+            names['%06d' % (i)] = path
+        args = [_SIPS_TOOL, '-s', 'format', 'bmp', '-z', str(_SIZE),
+                str(_SIZE)]
+        args.extend([os.path.join(in_folder, name)
+                     for name in sorted(os.listdir(in_folder))])
+        args.extend(['--out', out_folder])
+        try:
+            su.execandcapture(args)
+        except OSError, e:
+            _logger.info(u'Cannot run %s: %s', _SIPS_TOOL, e)
+            return {}
+        result = {}
+        for name in os.listdir(out_folder):
+            path = names.get(name[:6])
+            if path is None:
+                continue
+            try:
+                bmp_file = open(os.path.join(out_folder, name), 'rb')
+                try:
+                    pixels = read_bmp(bmp_file.read())
+                finally:
+                    bmp_file.close()
+            except (IOError, ValueError, struct.error), e:
+                _logger.info(u'Cannot read thumbnail of %s: %s', path, e)
+                continue
+            if pixels.shape == (_SIZE, _SIZE):
+                result[path] = pixels
+        return result
+    finally:
+        shutil.rmtree(in_folder)
+        shutil.rmtree(out_folder)
+
+
+def hash_files(paths):
+    """Computes the perceptual hashes of image files. Returns a map from path
+       to hash as a hex string, for the files that could be decoded."""
+    result = {}
+    folder = tempfile.mkdtemp()
+    try:
+        for start in range(0, len(paths), _BATCH_SIZE):
+            pixels = _convert_batch(paths[start:start + _BATCH_SIZE], folder)
+            if not pixels:
+                continue
+            batch = sorted(pixels)
+            hashes = hash_pixels(numpy.array([pixels[p] for p in batch]))
+            for path, value in zip(batch, hashes):
+                result[path] = '%016x' % (value)
+    finally:
+        shutil.rmtree(folder)
+    return result
+
+
+def hamming_distance(hash1, hash2):
+    """Returns the number of bits that differ between two hashes."""
+    return bin(hash1 ^ hash2).count('1')
+
+
+class BKTree(object):
+    """Burkhard-Keller tree of hashes, for finding the hashes within a Hamming
+       distance of a hash without comparing it to all of them."""
+
+    def __init__(self):
+        # Nodes are [hash, items, {distance: child node}].
+        self._root = None
+
+    def add(self, value, item):
+        """Adds an item with a hash."""
+        if self._root is None:
+            self._root = [value, [item], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def find(self, value, max_distance):
+        """Returns the items with hashes within max_distance of value."""
+        result = []
+        if self._root is None:
+            return result
+        pending = [self._root]
+        while pending:
+            node = pending.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                result.extend(node[1])
+            # By the triangle inequality, only children at these distances
+            # can have matches.
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    pending.append(child)
+        return result
+
+
+def group_similar(hashes, max_distance):
+    """Groups items around leaders. Each item that is not in a group yet
+       leads a group of the items that are not in a group yet and whose
+       hashes are within max_distance of its hash, so that all items of a
+       group are similar to its first item (and not just through a chain of
+       other items).
+
+    Args:
+      hashes: list of (item, hash) tuples, preferred leaders first.
+      max_distance: largest Hamming distance of similar hashes.
+    Returns:
+      list of groups with more than one item. Groups are in the order of
+      their leaders, and items in the order of hashes, leader first.
+    """
+    tree = BKTree()
+    for i, (_item, value) in enumerate(hashes):
+        tree.add(value, i)
+    grouped = set()
+    groups = []
+    for i, (_item, value) in enumerate(hashes):
+        if i in grouped:
+            continue
+        # Items before i that are not in a group are not within max_distance
+        # of it, or i would be in their group.
+        members = sorted([j for j in tree.find(value, max_distance)
+                          if j not in grouped])
+        grouped.update(members)
+        if len(members) > 1:
+            groups.append([hashes[j][0] for j in members])
+    return groups
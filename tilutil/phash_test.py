@@ -0,0 +1,124 @@
+"""This module tests phash.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import random
+import struct
+import unittest
+
+import tilutil.phash as phash
+
+numpy = phash.numpy
+
+
+def _make_bmp(rows):
+    """Returns a bottom-up 24 bit BMP file of rows of (red, green, blue)."""
+    height = len(rows)
+    width = len(rows[0])
+    row_size = (width * 3 + 3) & ~3
+    pixels = ''
+    for row in reversed(rows):
+        data = ''.join([struct.pack('BBB', blue, green, red)
+                        for red, green, blue in row])
+        pixels += data + '\0' * (row_size - len(data))
+    header = struct.pack('<2sIHHI', 'BM', 54 + len(pixels), 0, 0, 54)
+    info = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0,
+                       len(pixels), 2835, 2835, 0, 0)
+    return header + info + pixels
+
+
+def _make_image(generator):
+    """Returns a random smooth 32x32 gray image."""
+    image = numpy.kron(generator.uniform(0, 255, (8, 8)), numpy.ones((4, 4)))
+    for _ in range(3):
+        image = (image + numpy.roll(image, 1, 0) + numpy.roll(image, -1, 0) +
+                 numpy.roll(image, 1, 1) + numpy.roll(image, -1, 1)) / 5.0
+    return image
+
+
+class PHashTest(unittest.TestCase):
+    """Unit tests for phash.py code."""
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_hash_pixels(self):
+        """Tests that similar images have close hashes, and different images
+           do not."""
+        generator = numpy.random.RandomState(42)
+        image = _make_image(generator)
+        noisy = image + generator.normal(0, 3, image.shape)
+        brighter = image * 1.2 + 10
+        other = _make_image(generator)
+        hashes = phash.hash_pixels(numpy.array([image, noisy, brighter,
+                                                other]))
+        self.assertTrue(phash.hamming_distance(hashes[0], hashes[1]) <= 4)
+        self.assertEquals(hashes[0], hashes[2])
+        self.assertTrue(phash.hamming_distance(hashes[0], hashes[3]) > 16)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_read_bmp(self):
+        """Tests reading a bottom-up BMP with padded rows."""
+        rows = [[(255, 255, 255), (0, 0, 0), (255, 0, 0)],
+                [(0, 255, 0), (0, 0, 255), (10, 10, 10)]]
+        gray = phash.read_bmp(_make_bmp(rows))
+        self.assertEquals((2, 3), gray.shape)
+        self.assertAlmostEquals(255, gray[0, 0])
+        self.assertAlmostEquals(0, gray[0, 1])
+        self.assertAlmostEquals(0.299 * 255, gray[0, 2])
+        self.assertAlmostEquals(0.587 * 255, gray[1, 0])
+        self.assertAlmostEquals(0.114 * 255, gray[1, 1])
+        self.assertAlmostEquals(10, gray[1, 2])
+        self.assertRaises(ValueError, phash.read_bmp, 'GIF89a' + '\0' * 60)
+
+    def test_bk_tree(self):
+        """Compares tree queries with a scan of all hashes."""
+        generator = random.Random(42)
+        hashes = [generator.getrandbits(64) for _ in range(300)]
+        # Some hashes close to others.
+        hashes.extend([value ^ (1 << generator.randrange(64))
+                       for value in hashes[:50]])
+        tree = phash.BKTree()
+        for i, value in enumerate(hashes):
+            tree.add(value, i)
+        for value in hashes[:20] + [generator.getrandbits(64)]:
+            for max_distance in (0, 3, 20):
+                expected = [i for i, other in enumerate(hashes)
+                            if phash.hamming_distance(value, other) <=
+                            max_distance]
+                self.assertEquals(expected,
+                                  sorted(tree.find(value, max_distance)))
+
+    def test_group_similar(self):
+        """Tests grouping around the first items."""
+        hashes = [('a', 0x0), ('b', 0xff00), ('c', 0x3), ('d', 0xf),
+                  ('e', 0xff01), ('f', 0xffffffff)]
+        self.assertEquals([['a', 'c'], ['b', 'e']],
+                          phash.group_similar(hashes, 2))
+        self.assertEquals([['a', 'c', 'd']], phash.group_similar(hashes[:4], 4))
+        self.assertEquals([['d', 'a', 'c']], phash.group_similar(
+            [hashes[3]] + hashes[:3], 4))
+        self.assertEquals([], phash.group_similar(hashes, 0))
+
+    def test_group_similar_chain(self):
+        """Tests that a chain of close hashes is not one group."""
+        hashes = [('a', 0x0), ('b', 0x3), ('c', 0xf), ('d', 0x3f),
+                  ('e', 0xff)]
+        self.assertEquals([['a', 'b'], ['c', 'd']],
+                          phash.group_similar(hashes, 2))
+        self.assertEquals([['b', 'a', 'c'], ['d', 'e']],
+                          phash.group_similar(hashes[1:2] + hashes[:1] +
+                                              hashes[2:], 2))
+
+if __name__ == '__main__':
+    unittest.main()
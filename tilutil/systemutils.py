@@ -23,6 +23,7 @@ import logging
 import os
 import subprocess
 import sys
+import threading
 import unicodedata
 
 _sysenc = sys.getfilesystemencoding()
@@ -34,17 +35,28 @@ class _NullHandler(logging.Handler):
 _logger = logging.getLogger("google.systemutils")
 _logger.addHandler(_NullHandler())
 
-def execandcombine(command):
+def execandcombine(command, input_data=None):
     """execute a shell command, and return all output in a single string."""
-    data = execandcapture(command)
+    data = execandcapture(command, input_data)
     return "\n".join(data)
 
 
-def execandcapture(command):
-    """execute a shell command, and return output lines in a sequence."""
+def execandcapture(command, input_data=None):
+    """execute a shell command, and return output lines in a sequence.
+
+    If input_data is set, it is written to the standard input of the command.
+    """
     pipe = None
     try:
         _logger.debug(u' '.join(command))
+        if input_data is not None:
+            process = subprocess.Popen(command, shell=False,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output = process.communicate(input_data)[0]
+            return [line.strip().replace("\r", "\n")
+                    for line in output.splitlines()]
         pipe = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE,
                                 stderr=subprocess.STDOUT).stdout
         data = []
@@ -111,19 +123,72 @@ def fsdec(value):
         return ""
     return value.decode(_sysenc)
 
-def pout(msg):
-    '''Prints a message to sys.stdout, taking care of character encodings.'''
+# pout() and perr() hold this lock while printing, so that messages from
+# several threads don't get mixed up.
+_output_lock = threading.Lock()
+# Per thread list of captured messages (see start_capture()).
+_captured = threading.local()
+
+def _write(stream, msg):
+    """Prints or captures a message for pout() and perr()."""
     try:
-        print fsenc(msg)
+        text = fsenc(msg)
     except UnicodeError, e:
-        print '%s (ignored)' % str(e)
+        text = '%s (ignored)' % str(e)
+    messages = getattr(_captured, 'messages', None)
+    if messages is not None:
+        messages.append((stream, text))
+    else:
+        write_captured([(stream, text)])
+
+def pout(msg):
+    '''Prints a message to sys.stdout, taking care of character encodings.'''
+    _write(sys.stdout, msg)
          
 def perr(msg):
     '''Prints a message to sys.stderr, taking care of character encodings.'''
-    try:
-        print >> sys.stderr, fsenc(msg)
-    except UnicodeError, e:
-        print >> sys.stderr, '%s (ignored)' % str(e)
+    _write(sys.stderr, msg)
+
+def start_capture():
+    """Makes pout() and perr() collect the messages of the current thread
+       until end_capture() is called, instead of printing them. Log records
+       of a CapturingStreamHandler are collected too."""
+    _captured.messages = []
+
+def end_capture():
+    """Stops capturing messages in the current thread, and returns the
+       messages captured since start_capture()."""
+    messages = getattr(_captured, 'messages', None) or []
+    _captured.messages = None
+    return messages
+
+def write_captured(messages):
+    """Prints messages returned by end_capture()."""
+    with _output_lock:
+        for stream, text in messages:
+            print >> stream, text
+
+
+class CapturingStreamHandler(logging.StreamHandler):
+    """Logging handler that collects the records of a thread that captures
+       its messages (see start_capture()), so that they are printed in order
+       with the other messages of the thread."""
+
+    def emit(self, record):
+        messages = getattr(_captured, 'messages', None)
+        if messages is None:
+            with _output_lock:
+                logging.StreamHandler.emit(self, record)
+            return
+        try:
+            text = self.format(record)
+            if isinstance(text, unicode):
+                text = fsenc(text)
+        except Exception:
+            self.handleError(record)
+            return
+        messages.append((self.stream, text))
+
          
 def getfilebasename(file_path):
     """returns the name of a file, without the extension. "/a/b/c.txt" -> "c".
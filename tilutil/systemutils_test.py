@@ -0,0 +1,78 @@
+"""This module tests systemutils.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import StringIO
+import sys
+import threading
+import unittest
+
+import tilutil.systemutils as su
+
+class SystemUtilsTest(unittest.TestCase):
+    """Unit tests for systemutils.py code."""
+
+    def test_capture(self):
+        """Tests that captured messages are kept per thread."""
+        saved = (sys.stdout, sys.stderr)
+        captured = {}
+        def worker(name):
+            su.start_capture()
+            su.pout(u'%s out' % (name))
+            su.perr(u'%s err' % (name))
+            captured[name] = su.end_capture()
+        try:
+            sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+            threads = [threading.Thread(target=worker, args=(name,))
+                       for name in ('a', 'b')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            su.pout(u'main')
+            self.assertEquals('main\n', sys.stdout.getvalue())
+            su.write_captured(captured['b'])
+            su.write_captured(captured['a'])
+            self.assertEquals('main\nb out\na out\n', sys.stdout.getvalue())
+            self.assertEquals('b err\na err\n', sys.stderr.getvalue())
+        finally:
+            sys.stdout, sys.stderr = saved
+        self.assertEquals([], su.end_capture())
+
+    def test_capturing_stream_handler(self):
+        """Tests that log records are captured with the other messages."""
+        saved = sys.stdout
+        output = StringIO.StringIO()
+        logger = logging.getLogger('google.systemutils_test')
+        handler = su.CapturingStreamHandler(output)
+        logger.addHandler(handler)
+        try:
+            sys.stdout = output
+            su.start_capture()
+            su.pout(u'first')
+            logger.warning(u'logged')
+            su.pout(u'last')
+            captured = su.end_capture()
+            logger.warning('not captured')
+            su.write_captured(captured)
+        finally:
+            sys.stdout = saved
+            logger.removeHandler(handler)
+        self.assertEquals('not captured\nfirst\nlogged\nlast\n',
+                          output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
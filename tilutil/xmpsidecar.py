@@ -0,0 +1,239 @@
+"""Reads and writes the metadata Phoshare maintains in XMP sidecar files.
+
+A sidecar file has the name of its image with an .xmp extension
+("IMG_0001.xmp" for "IMG_0001.jpg"), and holds the caption (dc:description),
+keywords (dc:subject), date (exif:DateTimeOriginal), rating (xmp:Rating), GPS
+location (exif:GPSLatitude, exif:GPSLongitude) and face regions (Microsoft
+Photo regions), so that metadata updates don't have to rewrite the image.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import os
+import tempfile
+import time
+
+from xml.parsers import expat
+
+import tilutil.imageutils as imageutils
+import tilutil.jpegmetadata as jpegmetadata
+
+SIDECAR_EXTENSION = '.xmp'
+
+_SIDECAR_HEADER = ("<x:xmpmeta xmlns:x='adobe:ns:meta/'>\n"
+                   "<rdf:RDF xmlns:rdf='%s'>\n" % (jpegmetadata.NS_RDF))
+_SIDECAR_TRAILER = "\n</rdf:RDF>\n</x:xmpmeta>\n"
+
+_DESCRIPTION = jpegmetadata.NS_DC + ' description'
+_SUBJECT = jpegmetadata.NS_DC + ' subject'
+_DATE = jpegmetadata.NS_EXIF + ' DateTimeOriginal'
+_LATITUDE = jpegmetadata.NS_EXIF + ' GPSLatitude'
+_LONGITUDE = jpegmetadata.NS_EXIF + ' GPSLongitude'
+_RATING = jpegmetadata.NS_XMP + ' Rating'
+_RECTANGLE = jpegmetadata.NS_MP_REGION + ' Rectangle'
+_PERSON = jpegmetadata.NS_MP_REGION + ' PersonDisplayName'
+
+
+def get_sidecar_path(path):
+    """Returns the path of the sidecar file for an image file."""
+    return os.path.splitext(path)[0] + SIDECAR_EXTENSION
+
+
+def is_sidecar_of(sidecar_path, path):
+    """Tests if sidecar_path is the sidecar file of an image file."""
+    return sidecar_path == get_sidecar_path(path)
+
+
+class _SidecarReader(object):
+    """Collects the values of XMP properties. Values in rdf:Bag, rdf:Seq and
+       rdf:Alt lists are assigned to the property that contains the list."""
+
+    def __init__(self):
+        self.values = {}
+        self._stack = []
+        self._text = None
+
+    def parse(self, data):
+        """Parses a sidecar file.
+
+        Raises:
+            jpegmetadata.MalformedError: if the file is not well-formed XML.
+        """
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._character_data
+        try:
+            parser.Parse(data, True)
+        except expat.ExpatError, ex:
+            raise jpegmetadata.MalformedError(str(ex))
+        return self.values
+
+    def _add_value(self, name, value):
+        self.values.setdefault(name, []).append(value)
+
+    def _start_element(self, name, attributes):
+        for attribute, value in attributes.items():
+            if not attribute.startswith(jpegmetadata.NS_RDF):
+                self._add_value(attribute, value)
+        self._stack.append(name)
+        self._text = []
+
+    def _end_element(self, name):
+        self._stack.pop()
+        if self._text is not None:
+            # Leaf element: find the property it belongs to.
+            if name.startswith(jpegmetadata.NS_RDF):
+                for parent in reversed(self._stack):
+                    if not parent.startswith(jpegmetadata.NS_RDF):
+                        self._add_value(parent, u''.join(self._text))
+                        break
+            else:
+                self._add_value(name, u''.join(self._text))
+        self._text = None
+
+    def _character_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+
+def _parse_xmp_coordinate(value):
+    """Converts an XMP GPS coordinate ("DDD,MM.mmmK" or "DDD,MM,SSK") into
+       degrees."""
+    ref = value[-1:].upper()
+    parts = [float(part) for part in value[:-1].split(',')]
+    degrees = parts[0]
+    if len(parts) > 1:
+        degrees += parts[1] / 60.0
+    if len(parts) > 2:
+        degrees += parts[2] / 3600.0
+    if ref in ('S', 'W'):
+        degrees = -degrees
+    return degrees
+
+
+def _parse_xmp_date(value):
+    """Converts an XMP date into a datetime, ignoring fractions of seconds and
+       time zones."""
+    date_time = time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    return datetime.datetime(date_time.tm_year, date_time.tm_mon,
+                             date_time.tm_mday, date_time.tm_hour,
+                             date_time.tm_min, date_time.tm_sec)
+
+
+def read_sidecar(path):
+    """Reads the metadata of an image from its sidecar file.
+
+    Args:
+        path: path of the image file.
+    Returns:
+        (keywords, caption, date_time_original, rating, gps,
+        region_rectangles, region_names) tuple like exiftool.get_iptc_data()
+        returns, with empty values if there is no sidecar file. Returns None
+        if the sidecar file cannot be read.
+    """
+    sidecar_path = get_sidecar_path(path)
+    if not os.path.exists(sidecar_path):
+        return ([], None, None, 0, None, [], [])
+    try:
+        sidecar = open(sidecar_path, 'rb')
+        try:
+            values = _SidecarReader().parse(sidecar.read())
+        finally:
+            sidecar.close()
+        caption = values.get(_DESCRIPTION, [None])[0]
+        date = None
+        if _DATE in values:
+            date = _parse_xmp_date(values[_DATE][0])
+        rating = int(values.get(_RATING, [0])[0])
+        gps = None
+        if _LATITUDE in values and _LONGITUDE in values:
+            gps = imageutils.GpsLocation(
+                _parse_xmp_coordinate(values[_LATITUDE][0]),
+                _parse_xmp_coordinate(values[_LONGITUDE][0]))
+        rectangles = [[float(c) for c in rectangle.split(',')]
+                      for rectangle in values.get(_RECTANGLE, [])]
+    except (IOError, ValueError, jpegmetadata.MalformedError):
+        return None
+    return (values.get(_SUBJECT, []), caption, date, rating, gps, rectangles,
+            values.get(_PERSON, []))
+
+
+def write_sidecar(path, caption, keywords, date, rating, gps, rectangles,
+                  persons):
+    """Writes the sidecar file of an image, replacing any previous version.
+
+    Args:
+        path: path of the image file.
+        caption, keywords, date, rating, gps, rectangles, persons: the
+            metadata, in the format read_sidecar() returns.
+    Raises:
+        EnvironmentError: if the file cannot be written.
+    """
+    description = jpegmetadata.get_xmp_description(
+        rating, rectangles, persons, caption=caption, keywords=keywords,
+        date=date, gps=gps)
+    sidecar_path = get_sidecar_path(path)
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix='.phoshare-', suffix='.tmp',
+                                        dir=os.path.dirname(sidecar_path))
+    try:
+        output = os.fdopen(tmp_fd, 'wb')
+        try:
+            output.write(_SIDECAR_HEADER)
+            if description:
+                output.write(description)
+            output.write(_SIDECAR_TRAILER)
+        finally:
+            output.close()
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, sidecar_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def update_sidecar(path, iptc_data, new_caption, new_keywords, new_datetime,
+                   new_rating, new_gps, new_rectangles, new_persons):
+    """Applies metadata changes to the sidecar file of an image.
+
+    Args:
+        path: path of the image file.
+        iptc_data: current metadata, as returned by read_sidecar().
+        new_caption, new_keywords, new_datetime, new_rating, new_gps,
+        new_rectangles, new_persons: changes, see exiftool.update_iptcdata().
+    Raises:
+        EnvironmentError: if the file cannot be written.
+    """
+    (keywords, caption, date, rating, gps, rectangles,
+     persons) = iptc_data
+    if new_caption is not None:
+        caption = new_caption
+    if new_keywords is not None:
+        keywords = new_keywords
+    if new_datetime:
+        date = new_datetime
+    if new_rating >= 0:
+        rating = new_rating
+    if new_gps:
+        gps = new_gps
+    if new_rectangles is not None:
+        rectangles = new_rectangles
+    if new_persons is not None:
+        persons = new_persons
+    write_sidecar(path, caption, keywords, date, rating, gps, rectangles,
+                  persons)
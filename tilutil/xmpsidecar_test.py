@@ -0,0 +1,73 @@
+"""This module tests xmpsidecar.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import tilutil.imageutils as imageutils
+import tilutil.xmpsidecar as xmpsidecar
+
+class XmpSidecarTest(unittest.TestCase):
+    """Unit tests for xmpsidecar.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, u'image.nef')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_get_sidecar_path(self):
+        """Tests xmpsidecar.get_sidecar_path."""
+        self.assertEquals('/a/b/IMG_1.xmp',
+                          xmpsidecar.get_sidecar_path('/a/b/IMG_1.JPG'))
+        self.assertTrue(xmpsidecar.is_sidecar_of('/a/IMG_1.xmp',
+                                                 '/a/IMG_1.tif'))
+        self.assertFalse(xmpsidecar.is_sidecar_of('/a/IMG_1.xmp',
+                                                  '/a/IMG_2.tif'))
+
+    def test_read_write(self):
+        """Tests that values written to a sidecar can be read back."""
+        self.assertEquals(([], None, None, 0, None, [], []),
+                          xmpsidecar.read_sidecar(self.path))
+        xmpsidecar.write_sidecar(
+            self.path, u'Line 1\nA & B', [u'one', u'caf\xe9'],
+            datetime.datetime(2010, 5, 6, 7, 8, 9), 4,
+            imageutils.GpsLocation(-37.51, -122.25),
+            [[0.1, 0.2, 0.3, 0.4]], [u'Jane'])
+        (keywords, caption, date, rating, gps, rectangles,
+         names) = xmpsidecar.read_sidecar(self.path)
+        self.assertEquals([u'one', u'caf\xe9'], keywords)
+        self.assertEquals(u'Line 1\nA & B', caption)
+        self.assertEquals(datetime.datetime(2010, 5, 6, 7, 8, 9), date)
+        self.assertEquals(4, rating)
+        self.assertTrue(gps.is_same(imageutils.GpsLocation(-37.51, -122.25)))
+        self.assertEquals([[0.1, 0.2, 0.3, 0.4]], rectangles)
+        self.assertEquals([u'Jane'], names)
+        self.assertEquals([u'image.xmp'], os.listdir(self.folder))
+
+    def test_read_invalid(self):
+        """Tests that unreadable sidecar files are reported as None."""
+        sidecar = open(xmpsidecar.get_sidecar_path(self.path), 'wb')
+        sidecar.write('<x:xmpmeta')
+        sidecar.close()
+        self.assertEquals(None, xmpsidecar.read_sidecar(self.path))
+
+if __name__ == '__main__':
+    unittest.main()